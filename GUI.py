@@ -1,35 +1,9 @@
+import argparse
+import os
 import tkinter as tk
 from tkinter import ttk
 
-# Function to parse the log file
-def parse_log_file(filepath):
-    with open(filepath, 'r') as file:
-        lines = file.readlines()
-
-    cycles = {}
-    integer_registers_used = set()
-    mem_registers_used = set()
-
-    # mem_registers = set()
-    mem_registers = {f'M{i*8}': '0' for i in range(0, 31)}  # Initialize mem registers
-    # current_cycle = None
-    for line in lines:
-        if line.startswith('Cycle'):
-            current_cycle = int(line.split()[1][:-1])
-            cycles[current_cycle] = {'reservation_stations': [], 'register_values': []}
-        elif line.startswith("reservation_stations:"):
-            reservation_stations = eval(line.split(':', 1)[1].strip())
-            for rs in reservation_stations:
-                parts = rs.split(', ')
-                if parts[1] != "Idle":
-                    integer_registers_used.update(filter(lambda r: r.startswith('R'), parts[4:7]))  # src1, src2, dest
-                    mem_registers_used.update(filter(lambda r: r.startswith('M'), parts[4:7]))  # src1, src2, dest
-            cycles[current_cycle]['reservation_stations'] = reservation_stations
-        elif line.startswith("register_values:"):
-            register_values = eval(line.split(':', 1)[1].strip())
-            cycles[current_cycle]['register_values'] = register_values
-
-    return cycles, integer_registers_used, mem_registers_used
+from cyclelog import LiveCycleLog, open_cycle_log
 
 # Function to create a styled Treeview for table-like data presentation
 def create_table(parent, columns, show_header=True, height=100):
@@ -39,14 +13,39 @@ def create_table(parent, columns, show_header=True, height=100):
         tree.column(col, anchor="center", width=100)  # Set a default width
     return tree
 
+# Columns of the reservation station table
+RS_COLUMNS = ["Instr", "Name", "Stage", "Cycles Left", "Src1", "Src2", "Dest", "Vj", "Vk", "Qj", "Qk"]
+
+# Playback refreshes the tables at most this often, stepping several cycles per refresh when needed
+PLAY_INTERVAL_MS = 20
+
+def station_row(rs):
+    # Split a station line into (name, row values); idle stations only have a name, stage and counter
+    parts = rs.split(', ')
+    if len(parts) == 3:
+        name = parts[0]
+        return name, ("", name, parts[1], parts[2]) + ("",) * (len(RS_COLUMNS) - 4)
+    return parts[1], tuple(parts)
+
 # Main GUI class
 class TomasuloGUI:
-    def __init__(self, root, log_filepath):
+    def __init__(self, root, log_filepath=None, connect=None):
         self.root = root
         self.root.title("Tomasulo Simulator GUI")
-        self.cycles_data, self.integer_registers_used, self.mem_registers_used = parse_log_file(log_filepath)
-        self.current_cycle = 1
+        # Cycles are decoded on demand from the memory-mapped log, or streamed by a simulation server
+        self.live = connect is not None
+        self.cycles_data = LiveCycleLog(connect) if self.live else open_cycle_log(log_filepath)
+        self.integer_registers_used = self.cycles_data.integer_registers_used
+        self.mem_registers_used = self.cycles_data.mem_registers_used
+        self.current_cycle = self.cycles_data.first_cycle
+        self.displayed = {}            # (table, row id) -> values currently shown
+        self.highlighted = set()       # (table, row id) of rows changed by the last update
+        self.playing = False
+        self.play_position = 0.0       # Fractional cycle position while playing
+        self.following = True          # A live view shows each new cycle while it is on the latest one
         self.setup_gui()
+        if self.live:
+            self.root.after(PLAY_INTERVAL_MS, self.poll_live)
 
     def setup_gui(self):
         # Create frames
@@ -63,14 +62,36 @@ class TomasuloGUI:
         self.next_button = tk.Button(self.control_frame, text="Next", command=self.next_cycle)
         self.next_button.pack(side=tk.LEFT)
 
+        self.event_button = tk.Button(self.control_frame, text="Next Event", command=self.next_event)
+        self.event_button.pack(side=tk.LEFT)
+
         self.cycle_label = tk.Label(self.control_frame, text="Current Cycle:")
         self.cycle_label.pack(side=tk.LEFT)
 
         self.reset_button = tk.Button(self.control_frame, text="Reset", command=self.reset_cycle)
         self.reset_button.pack(side=tk.LEFT)
 
+        # Jump to a cycle
+        self.jump_entry = tk.Entry(self.control_frame, width=10)
+        self.jump_entry.pack(side=tk.LEFT)
+        self.jump_entry.bind("<Return>", lambda event: self.jump_to_cycle())
+        self.jump_button = tk.Button(self.control_frame, text="Go", command=self.jump_to_cycle)
+        self.jump_button.pack(side=tk.LEFT)
+
+        # Timed playback, in cycles per second
+        self.play_button = tk.Button(self.control_frame, text="Play", command=self.toggle_play)
+        self.play_button.pack(side=tk.LEFT)
+        self.speed = tk.Spinbox(self.control_frame, from_=1, to=1000, increment=10, width=6)
+        self.speed.delete(0, tk.END)
+        self.speed.insert(0, "10")
+        self.speed.pack(side=tk.LEFT)
+        tk.Label(self.control_frame, text="cycles/s").pack(side=tk.LEFT)
+
+        if self.live:
+            self.setup_live_controls()
+
         # Add tables for reservation stations, integer registers, and floating point registers
-        self.rs_table = create_table(self.data_frame, ["Instr", "Name", "Stage", "Cycles Left", "Src1", "Src2", "Dest", "Vj", "Vk", "Qj", "Qk"])
+        self.rs_table = create_table(self.data_frame, RS_COLUMNS)
         self.rs_table.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
         self.int_reg_table = create_table(self.data_frame, ["Int Register", "Value"])
@@ -79,43 +100,161 @@ class TomasuloGUI:
         self.mem_reg_table = create_table(self.data_frame, ["Memory Value", "Value"])
         self.mem_reg_table.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
 
-        # Load initial cycle data
-        self.load_cycle_data()
-
-    def load_cycle_data(self):
-        # Clear existing data in tables
         for table in [self.rs_table, self.int_reg_table, self.mem_reg_table]:
-            for row in table.get_children():
-                table.delete(row)
+            table.tag_configure("changed", background="#fff2a8")
+
+        # Load initial cycle data (an empty log, from an aborted run, has none)
+        if self.current_cycle in self.cycles_data:
+            self.load_cycle_data()
+
+    def update_row(self, table, row_id, values, changed):
+        # Insert the row the first time it is seen, afterwards only touch it when its values change
+        key = (table, row_id)
+        shown = self.displayed.get(key)
+        if shown is None:
+            table.insert("", "end", iid=row_id, values=values)
+        elif shown != values:
+            table.item(row_id, values=values, tags=("changed",))
+            changed.add(key)
+        self.displayed[key] = values
 
-        # Load data for the current cycle
+    def load_cycle_data(self):
+        # Show the current cycle, updating only the cells that differ from what is displayed
         cycle_data = self.cycles_data[self.current_cycle]
+        changed = set()
         for rs in cycle_data['reservation_stations']:
-            self.rs_table.insert("", "end", values=rs.split(', '))
+            name, values = station_row(rs)
+            self.update_row(self.rs_table, name, values, changed)
         for reg in cycle_data['register_values']:
             reg_name, reg_value = reg.split(', ')
             if reg_name in self.integer_registers_used:
-                self.int_reg_table.insert("", "end", values=(reg_name, reg_value))
+                self.update_row(self.int_reg_table, reg_name, (reg_name, reg_value), changed)
             elif reg_name in self.mem_registers_used:
-                self.mem_reg_table.insert("", "end", values=(reg_name, reg_value))
+                self.update_row(self.mem_reg_table, reg_name, (reg_name, reg_value), changed)
+        # Rows highlighted by the previous update and unchanged now go back to normal
+        for table, row_id in self.highlighted - changed:
+            table.item(row_id, tags=())
+        self.highlighted = changed
         # Update the cycle label
         self.cycle_label['text'] = f"Current Cycle: {self.current_cycle}"
-    def next_cycle(self):
-        if self.current_cycle < len(self.cycles_data):
-            self.current_cycle += 1
+
+    def show_cycle(self, cycle):
+        if cycle in self.cycles_data and cycle != self.current_cycle:
+            self.current_cycle = cycle
             self.load_cycle_data()
 
+    def next_cycle(self):
+        self.show_cycle(self.current_cycle + 1)
+
     def prev_cycle(self):
-        if self.current_cycle > 1:
-            self.current_cycle -= 1
-            self.load_cycle_data()
+        self.show_cycle(self.current_cycle - 1)
+
+    def next_event(self):
+        # Skip cycles in which only execution counters change
+        cycle = self.cycles_data.next_event(self.current_cycle)
+        self.show_cycle(cycle if cycle is not None else self.cycles_data.last_cycle)
+
+    def jump_to_cycle(self):
+        try:
+            cycle = int(self.jump_entry.get())
+        except ValueError:
+            return
+        if self.live and cycle > self.cycles_data.last_cycle:
+            # Let the server simulate up to it; the view follows
+            self.cycles_data.send("run_to", cycle=cycle)
+            self.following = True
+            return
+        self.show_cycle(min(max(cycle, self.cycles_data.first_cycle), self.cycles_data.last_cycle))
 
     def reset_cycle(self):
-        self.current_cycle = 1
-        self.load_cycle_data()
+        self.show_cycle(self.cycles_data.first_cycle)
+
+    def toggle_play(self):
+        self.playing = not self.playing
+        self.play_button['text'] = "Pause" if self.playing else "Play"
+        if self.playing:
+            self.play_position = self.current_cycle
+            self.root.after(PLAY_INTERVAL_MS, self.play_step)
+
+    def play_step(self):
+        # Advance by speed * interval cycles, drawing only the last one
+        if not self.playing:
+            return
+        try:
+            speed = float(self.speed.get())
+        except ValueError:
+            speed = 10.0
+        self.play_position += speed * PLAY_INTERVAL_MS / 1000
+        target = min(int(self.play_position), self.cycles_data.last_cycle)
+        self.show_cycle(target)
+        if target >= self.cycles_data.last_cycle:
+            self.toggle_play()
+            return
+        self.root.after(PLAY_INTERVAL_MS, self.play_step)
+
+    # Live simulation
+    def setup_live_controls(self):
+        # Run control of the simulation server
+        self.live_frame = tk.Frame(self.root)
+        self.live_frame.pack(side=tk.TOP, fill=tk.X, before=self.data_frame)
+        for text, command in (("Run", "run"), ("Pause", "pause"), ("Step", "step")):
+            tk.Button(self.live_frame, text=text, command=lambda command=command: self.send_command(command)).pack(side=tk.LEFT)
+
+        # Breakpoint at a cycle ("120") or at the issue of an instruction ("pc 6")
+        self.break_entry = tk.Entry(self.live_frame, width=10)
+        self.break_entry.pack(side=tk.LEFT)
+        self.break_entry.bind("<Return>", lambda event: self.add_breakpoint())
+        tk.Button(self.live_frame, text="Break", command=self.add_breakpoint).pack(side=tk.LEFT)
+        tk.Button(self.live_frame, text="Clear", command=lambda: self.cycles_data.send("clear")).pack(side=tk.LEFT)
+
+        self.status_label = tk.Label(self.live_frame, text="")
+        self.status_label.pack(side=tk.LEFT)
+
+    def send_command(self, command):
+        self.following = True
+        self.cycles_data.send(command)
+
+    def add_breakpoint(self):
+        text = self.break_entry.get().strip().lower()
+        try:
+            if text.startswith("pc"):
+                self.cycles_data.send("break", pc=int(text[2:]))
+            else:
+                self.cycles_data.send("break", cycle=int(text))
+        except ValueError:
+            return
+        self.break_entry.delete(0, tk.END)
+
+    def poll_live(self):
+        # Follow the latest streamed cycle, unless the user moved back to look at an earlier one
+        log = self.cycles_data
+        last_cycle = log.last_cycle
+        if self.following and not self.playing:
+            self.show_cycle(last_cycle)
+        elif self.current_cycle not in log:
+            self.show_cycle(log.first_cycle)
+        self.following = self.current_cycle == last_cycle
+
+        status = log.status
+        text = f"Server: {status.get('state', '?')}" if log.connected else "Server: disconnected"
+        if status.get("reason"):
+            text += f" ({status['reason']})"
+        breakpoints = status.get("breakpoints", {})
+        if breakpoints.get("cycles") or breakpoints.get("pcs"):
+            text += f", breakpoints: cycles {breakpoints['cycles']}, pcs {breakpoints['pcs']}"
+        if log.error:
+            text += f" - {log.error}"
+        self.status_label['text'] = text
+        self.root.after(PLAY_INTERVAL_MS, self.poll_live)
 
 # Run the GUI application
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the cycles of a Tomasulo run")
+    parser.add_argument("log", nargs="?", help="Trace or text log (default: log.trc of the last run, else log.txt)")
+    parser.add_argument("--connect", help="Attach to a simulation server (python simserver.py) at a socket path or host:port")
+    args = parser.parse_args()
+    # Show the given log, or the binary trace of the last run if there is one
+    log_filepath = args.log or ('log.trc' if os.path.exists('log.trc') else 'log.txt')
     root = tk.Tk()
-    gui = TomasuloGUI(root, 'log.txt')
+    gui = TomasuloGUI(root, log_filepath, args.connect)
     root.mainloop()
@@ -1,15 +1,98 @@
-import json
+import hashlib
+import operator
 import os
+import re
+from enum import IntEnum
+
+from events import (BranchResolvedEvent, CommitEvent, CompleteEvent, CycleEndEvent, EventBus, ExecuteStartEvent,
+                    IssueEvent, OperandCaptureEvent, SquashEvent, StallEvent, WriteBackEvent)
+from profiler import Profiler
+from memory import MEMORY_SIZE, NAMED_WORDS, WORD_SIZE, Memory
+from speculation import ReorderBuffer, TwoBitPredictor, make_predictor
+from tracefile import TraceWriter, export_json, export_text, format_station
 
 
 # TOMASULO Algorithms
+# Opcodes understood by the decoder
+class Opcode(IntEnum):
+    ADD = 0
+    SUB = 1
+    MUL = 2
+    DIV = 3
+    DADDI = 4
+    DSUBI = 5
+    MULI = 6
+    DIVI = 7
+    LOAD = 8
+    STORE = 9
+    BRANCH = 10
+    BEQZ = 11
+    BNEQZ = 12
+
+BRANCH_OPCODES = frozenset([Opcode.BRANCH, Opcode.BEQZ, Opcode.BNEQZ])
+MEMORY_OPCODES = frozenset([Opcode.LOAD, Opcode.STORE])
+
+# Result computed on the write stage for each opcode, as a function of (Vj, Vk)
+OPERATIONS = {
+    Opcode.ADD: operator.add,
+    Opcode.SUB: operator.sub,
+    Opcode.MUL: operator.mul,
+    Opcode.DIV: operator.truediv,
+    Opcode.DADDI: operator.add,
+    Opcode.DSUBI: operator.sub,
+    Opcode.MULI: operator.mul,
+    Opcode.DIVI: operator.truediv,
+}
+
+# Whether a branch is taken, as a function of the value of its source register
+BRANCH_CONDITIONS = {
+    Opcode.BRANCH: lambda value: True,
+    Opcode.BEQZ: lambda value: value == 0,
+    Opcode.BNEQZ: lambda value: value != 0,
+}
+
+
+# Fixed register file layout shared by the decoder and the manager
+def register_names():
+    names = [f"R{i}" for i in range(1, 32)]
+    names += [f"I{i}" for i in range(0, 101)]
+    names.append("X")
+    return names
+
+REGISTER_NAMES = register_names()
+REGISTER_INDEX = {name: index for index, name in enumerate(REGISTER_NAMES)}
+
+# Modules whose code decides what a simulation does; caches of results and of generated code are keyed by them
+SIMULATOR_MODULES = ("Tomasulo.py", "memory.py", "speculation.py", "events.py", "functional.py", "loopmemo.py",
+                     "specialize.py", "assembler.py")
+
+
+def source_hash(modules=SIMULATOR_MODULES):
+    # SHA-256 of the source of modules of this directory
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in modules:
+        with open(os.path.join(directory, name), "rb") as source:
+            digest.update(source.read())
+    return digest.hexdigest()
+
+
+# Memory operand "<offset>(<base register>)"
+_address_operand = re.compile(r"(-?\d+)\((\w+)\)$")
+
+
 # Class for representing an instruction
 class Instruction:
+    __slots__ = ("decoded", "instruction_str", "op", "opcode", "dest", "src1", "src2", "immediate",
+                 "Vj", "Vk", "Qj", "Qk", "A", "index")
+
     def __init__(self, instruction_str):
         # Initialize instruction components
+        self.decoded = None  # DecodedInstruction this was created from, if any
         self.instruction_str = instruction_str.replace(',', '')  # Remove commas from instruction string
         # Initialize placeholders for various parts of the instruction
         self.op = None      # Operation type (e.g., ADD, SUB)
+        self.opcode = None  # Opcode, set when created from the decoded program
         self.dest = None    # Destination register
         self.src1 = None    # Source register 1
         self.src2 = None    # Source register 2
@@ -22,6 +105,25 @@ class Instruction:
         self.A = None       # Used for address calculation in memory operations
         self.parse_instruction()  # Parse the instruction string
 
+    @classmethod
+    def from_decoded(cls, decoded):
+        # Create a fresh in-flight instruction from a decoded program entry, without re-parsing
+        instruction = cls.__new__(cls)
+        instruction.decoded = decoded
+        instruction.instruction_str = decoded.text
+        instruction.op = decoded.op
+        instruction.opcode = decoded.opcode
+        instruction.dest = decoded.dest
+        instruction.src1 = decoded.src1
+        instruction.src2 = decoded.src2
+        instruction.immediate = decoded.immediate
+        instruction.Vj = None
+        instruction.Vk = None
+        instruction.Qj = None
+        instruction.Qk = None
+        instruction.A = decoded.target
+        return instruction
+
     def parse_instruction(self):
         # Parse the instruction and set the operation and operand fields
         parts = self.instruction_str.split()
@@ -33,77 +135,241 @@ class Instruction:
         elif self.op in ["DADDI", "DSUBI", "MULI", "DIVI"]:
             self.dest, self.src1, self.immediate = parts[1], parts[2], parts[3][1:]
         elif self.op in ["STORE", "LOAD"]:
-            self.dest, self.src1, self.src2 = parts[1], parts[2], parts[3]
+            # "LOAD R2, M16, R3" or "LOAD R2, 16(R3)"; "STORE M16, R5, R3" or "STORE 16(R3), R5"
+            self.dest, self.src1 = parts[1], parts[2]
+            self.src2 = parts[3] if len(parts) > 3 else None
         elif self.op in ["BRANCH", "BEQZ", "BNEQZ"]:
-            self.src1, self.A, self.src2, self.dest = parts[1], int(''.join(filter(str.isdigit, parts[2]))), "X", "X"
+            # The target is an instruction index; labels are resolved by the assembler (see assembler.py)
+            if not parts[2].isdigit():
+                raise ValueError(f"Branch target {parts[2]!r} is not an instruction index in {self.instruction_str!r}")
+            self.src1, self.A, self.src2, self.dest = parts[1], int(parts[2]), "X", "X"
     def set_instruction_index(self, index):
         self.index = index
 
-# Class for representing a register in the processor
+
+# Class for one entry of the decoded program table
+class DecodedInstruction:
+    __slots__ = ("text", "op", "opcode", "dest", "src1", "src2", "immediate", "target",
+                 "dest_index", "src1_index", "src2_index")
+
+    def __init__(self, instruction_str):
+        # Parse once through Instruction, then resolve everything the issue stage needs
+        try:
+            parsed = Instruction(instruction_str)
+        except IndexError:
+            raise ValueError(f"Missing operands in instruction: {instruction_str!r}") from None
+        if parsed.op not in Opcode.__members__ or parsed.dest is None:
+            raise ValueError(f"Cannot decode instruction: {instruction_str!r}")
+        self.text = parsed.instruction_str
+        self.op = parsed.op
+        self.opcode = Opcode[parsed.op]
+        self.dest = parsed.dest
+        self.src1 = parsed.src1
+        self.src2 = parsed.src2
+        self.immediate = int(parsed.immediate) if parsed.immediate is not None else None
+        self.target = parsed.A      # Branch target index (None for non-branches)
+        if self.opcode == Opcode.LOAD:
+            # Vj is the base register and Vk the offset
+            base, self.immediate = parse_address(self.src1, self.src2, instruction_str)
+            self.dest_index = resolve_register(self.dest, instruction_str)
+            self.src1_index = resolve_register(base, instruction_str)
+            self.src2_index = None
+        elif self.opcode == Opcode.STORE:
+            # Vj is the stored value, Vk the base register and the immediate the offset; no register is written
+            base, self.immediate = parse_address(self.dest, self.src2, instruction_str)
+            self.dest_index = None
+            self.src1_index = resolve_register(self.src1, instruction_str)
+            self.src2_index = resolve_register(base, instruction_str)
+        else:
+            self.dest_index = resolve_register(self.dest, instruction_str)
+            self.src1_index = resolve_register(self.src1, instruction_str)
+            self.src2_index = resolve_register(self.src2, instruction_str) if self.src2 is not None else None
+
+    def key(self):
+        # Everything that determines the behaviour of this instruction, independent of its spelling
+        return (int(self.opcode), self.dest_index, self.src1_index, self.src2_index, self.immediate, self.target)
+
+
+def resolve_register(name, instruction_str):
+    # Map a register name to its slot in the register file
+    try:
+        return REGISTER_INDEX[name]
+    except KeyError:
+        raise ValueError(f"Unknown register {name!r} in instruction {instruction_str!r}") from None
+
+
+def parse_address(operand, base, instruction_str):
+    # (base register, byte offset) of a memory operand: "M<offset>" with an optional base register, or "<offset>(<base>)"
+    if operand.startswith("M") and operand[1:].isdigit():
+        return base or "X", int(operand[1:])
+    match = _address_operand.match(operand)
+    if match and base is None:
+        return match.group(2), int(match.group(1))
+    raise ValueError(f"Cannot decode memory operand {operand!r} in instruction {instruction_str!r}")
+
+
+def decode_program(instructions):
+    # Decode a list of instruction strings into the program table used by the issue stage
+    return [DecodedInstruction(instruction) for instruction in instructions]
+
+
+def apply_initial_values(register_values, memory, initial_values):
+    # Set registers and memory words from strings like "R1 80" or "M8 16"
+    for value in initial_values:
+        register_name, new_value = value.split()
+        if register_name.startswith('M') and register_name[1:].isdigit():
+            # Memory word at the given byte address
+            memory.store(int(register_name[1:]), int(new_value))
+        elif register_name in REGISTER_INDEX and register_name != "X":
+            # Determine the type of the value (int or float) and update the register
+            new_value = float(new_value) if register_name.startswith('F') else int(new_value)
+            register_values[REGISTER_INDEX[register_name]] = new_value
+        else:
+            raise ValueError(f"Register {register_name} not found.")
+
+
+def named_memory_words(program, memory_size):
+    # Addresses of the memory words logged by name as "M<address>": the first NAMED_WORDS words and
+    # every address the decoded program names without a base register
+    addresses = set(range(0, min(NAMED_WORDS * WORD_SIZE, memory_size - WORD_SIZE + 1), WORD_SIZE))
+    for decoded in program:
+        if decoded.opcode in MEMORY_OPCODES:
+            base = decoded.src1_index if decoded.opcode == Opcode.LOAD else decoded.src2_index
+            address = decoded.immediate
+            if base == REGISTER_INDEX["X"] and address % WORD_SIZE == 0 and 0 <= address <= memory_size - WORD_SIZE:
+                addresses.add(address)
+    return sorted(addresses)
+
+
+def used_register_names(program):
+    # Names of the registers the instructions of a decoded program read or write (base registers included), and
+    # "M<address>" for the memory words they address without a base register, as the GUI shows them
+    used = set()
+    for decoded in program:
+        used.update(REGISTER_NAMES[index] for index in (decoded.dest_index, decoded.src1_index, decoded.src2_index)
+                    if index is not None)
+        if decoded.opcode in MEMORY_OPCODES:
+            base = decoded.src1_index if decoded.opcode == Opcode.LOAD else decoded.src2_index
+            if base == REGISTER_INDEX["X"]:
+                used.add(f"M{decoded.immediate}")
+    return sorted(used)
+
+# Name-based view of one register, backed by the arrays of a RegisterFile
 class Register:
-    def __init__(self, name, reg_type='int', value=0):
-        self.name = name            # Register name
-        self.reg_type = reg_type    # Register type (integer or float)
-        self.is_being_written = False  # Flag to indicate if the register is being written to
-        self.writing_station = None
-        self.value = value          # The value stored in the register
-
-    # Set the register as being written to
-    def set_write_status(self, station = None):
-        self.is_being_written = True
-        self.writing_station = station
+    __slots__ = ("register_file", "index", "name")
+
+    def __init__(self, register_file, index):
+        self.register_file = register_file
+        self.index = index                  # Slot in the register file arrays
+        self.name = REGISTER_NAMES[index]   # Register name
+
+    @property
+    def value(self):
+        # The value stored in the register
+        return self.register_file.values[self.index]
+
+    @value.setter
+    def value(self, value):
+        self.register_file.values[self.index] = value
+
+    @property
+    def reg_type(self):
+        return 'float' if self.name.startswith('F') else 'int'
+
+    @property
+    def is_being_written(self):
+        return self.register_file.producers[self.index] >= 0
+
+    @property
+    def writing_station(self):
+        # Name of the station producing the register's next value, or None
+        tag = self.register_file.producers[self.index]
+        return self.register_file.station_names[tag] if tag >= 0 else None
+
+    # Set the register as being written to by the named station
+    def set_write_status(self, station):
+        self.register_file.producers[self.index] = self.register_file.station_names.index(station)
 
     # Clear the write status of the register
     def clear_write_status(self):
-        self.is_being_written = False
-        self.writing_station = None
+        self.register_file.producers[self.index] = -1
 
     # Get the current write status of the register
     def get_write_status(self):
         return self.is_being_written
 
+
+# Register values and producer tags as flat arrays indexed like REGISTER_NAMES
+class RegisterFile:
+    def __init__(self):
+        self.values = [0] * len(REGISTER_NAMES)      # Current value of every register
+        self.producers = [-1] * len(REGISTER_NAMES)  # Tag of the station that will write each register, -1 if none
+        self.station_names = []                      # Station name of each tag
+        # I registers hold their own number
+        for i in range(0, 101):
+            self.values[REGISTER_INDEX[f"I{i}"]] = i
+
+    # Dictionary-style access by register name, for the logs, the GUI and simulate()
+    def __getitem__(self, name):
+        return Register(self, REGISTER_INDEX[name])
+
+    def __contains__(self, name):
+        return name in REGISTER_INDEX
+
+    def __iter__(self):
+        return iter(REGISTER_NAMES)
+
+    def __len__(self):
+        return len(REGISTER_NAMES)
+
+    def keys(self):
+        return list(REGISTER_NAMES)
+
+    def items(self):
+        return [(name, Register(self, index)) for index, name in enumerate(REGISTER_NAMES)]
+
 # Class for representing a reservation station
 class ReservationStation:
-    def __init__(self, name, op_type, execution_time, op_types = []):
+    __slots__ = ("name", "tag", "op_type", "op_types", "execution_time", "is_writing", "busy_cycles", "issue_cycle",
+                 "sequence", "rob_entry", "busy", "instruction", "stage", "remaining_cycles", "consumers")
+
+    def __init__(self, name, op_type, execution_time, op_types = [], tag = -1):
         self.name = name               # Station name
+        self.tag = tag                 # Index of the station, used as its producer tag in the register file
         self.op_type = op_type         # Operation type handled by this station
-        self.op_types = op_types
+        self.op_types = frozenset(op_types)
         self.execution_time = execution_time  # Time needed to execute an operation
         self.is_writing = False        # Flag to indicate if the station is in the write stage
+        self.busy_cycles = 0           # Cycles this station has spent holding an instruction
+        self.issue_cycle = 0           # Cycle in which the current instruction was issued
+        self.sequence = 0              # Issue order of the current instruction (program order of in-flight ones)
         self.reset()                   # Reset the station to its initial state
     
     def assign_station(self, type):
         return True if type in self.op_types else False
     
-    def perform_write(self, registers):
-        # Assuming 'self.instruction' is an instance of the 'Instruction' class
-        # and contains the operation (op), destination (dest), and source registers (src1, src2)
-        op = self.instruction.op
-        dest = self.instruction.dest
-        src1 = self.instruction.src1
-        src2 = self.instruction.src2
-
-        # Assuming 'self.registers' is a dictionary storing the values of the registers
-        if op == "ADD":
-            registers[dest].value = self.instruction.Vj + self.instruction.Vk
-        elif op == "SUB":
-            registers[dest].value = self.instruction.Vj - self.instruction.Vk
-        elif op == "MUL":
-            registers[dest].value = self.instruction.Vj * self.instruction.Vk
-        elif op == "DIV":
-            registers[dest].value = self.instruction.Vj / self.instruction.Vk
-        elif op == "DADDI":
-            registers[dest].value = self.instruction.Vj + self.instruction.Vk
-        elif op == "DSUBI":
-            registers[dest].value = self.instruction.Vj - self.instruction.Vk
-        elif op == "MULI":
-            registers[dest].value = self.instruction.Vj * self.instruction.Vk
-        elif op == "DIVI":
-            registers[dest].value = self.instruction.Vj / self.instruction.Vk
-        elif op in ["LOAD", "STORE"]:
-            registers[dest].value = self.instruction.Vj
-        # elif op in ["BRANCH", "BEQZ", "BNEQZ"]:
-        #     self.branching_station = None
+    def compute_result(self, memory):
+        # Result of the instruction: the word a LOAD reads at address A, the value a STORE writes,
+        # or the opcode table applied to (Vj, Vk)
+        instruction = self.instruction
+        opcode = instruction.opcode
+        if opcode == Opcode.LOAD:
+            return memory.load(instruction.A)
+        if opcode == Opcode.STORE:
+            return instruction.Vj
+        operation = OPERATIONS.get(opcode)
+        return operation(instruction.Vj, instruction.Vk) if operation is not None else None
+
+    def perform_write(self, register_values, memory):
+        # Compute the result, store it in the destination register (or memory) and return it
+        result = self.compute_result(memory)
+        instruction = self.instruction
+        if instruction.opcode == Opcode.STORE:
+            memory.store(instruction.A, result)
+            return None
+        if instruction.decoded.dest_index is not None:
+            register_values[instruction.decoded.dest_index] = result
+        return result
 
     # Load an instruction into the reservation station
     def load_instruction(self, instruction, index):
@@ -118,228 +384,600 @@ class ReservationStation:
         self.instruction = None        # Clear the instruction
         self.stage = "Idle"            # Set the stage to 'Idle'
         self.remaining_cycles = 0      # Reset remaining cycles
+        self.rob_entry = None          # Reorder buffer entry of the instruction, when speculating
+        self.consumers = []            # (station, operand slot) pairs waiting for this station's result
+
+    def trace_fields(self):
+        # Displayed state of the station, in tracefile.STATION_FIELDS order
+        if self.instruction:
+            instruction = self.instruction
+            src2 = instruction.src2 if instruction.src2 != None else instruction.immediate
+            return (instruction.instruction_str, self.stage, self.remaining_cycles, instruction.src1, src2,
+                    instruction.dest, instruction.Vj, instruction.Vk, instruction.Qj, instruction.Qk)
+        return (None, "Idle", self.remaining_cycles, None, None, None, None, None, None, None)
 
     def __str__(self):
         # String representation of the reservation station's status
-        # stage = self.stage if self.instruction else "Idle"
-        if self.instruction:
-            stage = self.stage
-            if self.instruction.src2 != None:
-                return f"{self.instruction.instruction_str}, {self.name}, {stage}, {self.remaining_cycles}, {self.instruction.src1}, {self.instruction.src2}, {self.instruction.dest}, {self.instruction.Vj}, {self.instruction.Vk}, {self.instruction.Qj}, {self.instruction.Qk}"
-            else:
-                return f"{self.instruction.instruction_str}, {self.name}, {stage}, {self.remaining_cycles}, {self.instruction.src1}, {self.instruction.immediate}, {self.instruction.dest}, {self.instruction.Vj}, {self.instruction.Vk}, {self.instruction.Qj}, {self.instruction.Qk}"
-        else:
-            stage = "Idle"
-            return f"{self.name}, {stage}, {self.remaining_cycles}"
+        return format_station(self.name, self.trace_fields())
 
 
 # Manager class for handling multiple reservation stations
 class ReservationStationManager:
-    def __init__(self, station_counts, execution_times, optypes, initial_values):
+    def __init__(self, station_counts, execution_times, optypes, initial_values, memory=None, rob_size=0,
+                 predictor=None, issue_width=1, cdb_width=1, arbitration="oldest"):
+        self.memory = memory if memory is not None else Memory()  # Data memory read by LOAD and written by STORE
+        # With a reorder buffer, instructions issue past predicted branches and commit in order;
+        # without one, every branch stops the issue stage until it resolves
+        self.rob = ReorderBuffer(rob_size) if rob_size else None
+        self.predictor = predictor if predictor is not None else TwoBitPredictor()
         self.stations = {}             # Dictionary to store reservation stations
         self.instruction_queue = []    # Queue for holding instructions to be issued
+        self.program = []              # Decoded instruction queue
         self.instruction_queue_index = 0 # Index
-        self.issue_stage_station = None  # Current station in the issue stage
-        self.issue_stage_stations = []
-        self.write_stage_station = None  # Current station in the write stage
+        self.ready_stations = []       # Issued stations with all operands captured, starting execution next
+        self.write_stage_stations = [] # Stations in the write stage, each holding a common data bus
+        self.issue_width = issue_width # Instructions issued per cycle at most
+        self.cdb_width = cdb_width     # Number of common data buses (results written back per cycle)
+        if arbitration not in ARBITRATION_POLICIES:
+            raise ValueError(f"Unknown arbitration policy {arbitration!r} (expected one of {', '.join(ARBITRATION_POLICIES)})")
+        self.arbitration = arbitration # How finished stations are ordered when they outnumber the buses
+        self.last_granted = -1         # Tag of the station granted a bus most recently (round-robin)
+        self.cdb_stall_cycles = 0      # Station-cycles lost waiting for a common data bus
         self.branching_station = None # Current station in the branch
+        self.issued_instructions = 0   # Number of instructions issued so far (re-issues after a branch included)
+        self.cycle = 0                 # Number of cycles simulated so far
+        self.issue_stall_cycles = 0    # Cycles in which the next instruction in the queue could not issue
+        self.branches = 0              # Branches resolved (committed, when speculating)
+        self.branches_taken = 0
+        self.mispredictions = 0        # Branches whose predicted direction was wrong
+        self.squashed_instructions = 0 # Instructions issued down a mispredicted path and discarded
+        self.hooks = None              # EventBus of the subscribers to pipeline events; None while there are none
         self.initialise_registers(initial_values)  # Initialize registers with given values
         self.create_stations(station_counts, execution_times, optypes)  # Create the reservation stations
 
     def initialise_registers(self, initial_values):
-        # Initialize general and floating-point registers and set their initial values
-        # General registers
-        self.registers = {f"R{i}": Register(f"R{i}") for i in range(1, 32)}
-        # Floating-point registers
-        self.registers.update({f"I{i}": Register(f"I{i}", 'int', i) for i in range(0, 101)})
-        self.registers.update({f"M{i*8}": Register(f"M{i*8}", 'int', i) for i in range(0, 31)})
-
-
-        for value in initial_values:
-            # Update register values as per the provided initial values
-            register_name, new_value = value.split()
-            if register_name in self.registers:
-                # Determine the type of the value (int or float) and update the register
-                new_value = float(new_value) if register_name.startswith('F') else int(new_value)
-                self.registers[register_name].value = new_value
-            else:
-                print(f"Register {register_name} not found.")
-        self.registers["X"]  = Register("X")
+        # Initialize the register file and set the given initial values
+        self.registers = RegisterFile()
+        # The arrays themselves, used directly by the pipeline stages
+        self.register_values = self.registers.values
+        self.register_producers = self.registers.producers
+        apply_initial_values(self.register_values, self.memory, initial_values)
 
     def create_stations(self, station_counts, execution_times, optypes):
         # Create reservation stations based on the given counts and execution times
+        self.station_list = []         # Stations by tag
         for op_type, count in station_counts.items():
             for i in range(count):
                 name = f"{op_type}_{i+1}"
-                self.stations[name] = ReservationStation(name, op_type, execution_times[op_type], optypes[op_type])
+                station = ReservationStation(name, op_type, execution_times[op_type], optypes[op_type],
+                                             len(self.station_list))
+                self.stations[name] = station
+                self.station_list.append(station)
+        self.registers.station_names = [station.name for station in self.station_list]
+
+    def flush_stations(self, sequence):
+        # Release every station holding an instruction issued after `sequence`; returns how many were released
+        flushed = 0
+        for station in self.station_list:
+            if station.busy and station.sequence > sequence:
+                self.release_station(station)
+                flushed += 1
+        return flushed
 
-    def flush_stations(self, flush_index):
-        for name, station in self.stations.items():
-                if station.busy and station.instruction.index > flush_index:
-                    station.reset()
+    def squash(self, sequence):
+        # Discard every instruction issued after `sequence` (a mispredicted branch)
+        squashed = self.rob.squash_after(sequence)
+        self.squashed_instructions += squashed
+        if self.hooks is not None and self.hooks.wants(SquashEvent):
+            self.hooks.publish(SquashEvent(self.cycle, sequence, squashed))
+        self.flush_stations(sequence)
+        self.ready_stations = [station for station in self.ready_stations if station.busy]
+        self.write_stage_stations = [station for station in self.write_stage_stations if station.busy]
+        for station in self.station_list:
+            if station.busy:
+                station.consumers = [(consumer, slot) for consumer, slot in station.consumers if consumer.busy]
+        # Rebuild the register rename map from the surviving entries
+        producers = self.register_producers
+        for index in range(len(producers)):
+            producers[index] = -1
+        for entry in self.rob:
+            if entry.dest_index is not None:
+                producers[entry.dest_index] = entry.tag
+
+    def release_station(self, station):
+        # Free a station, accounting for the cycles it was occupied
+        station.busy_cycles += self.cycle - station.issue_cycle
+        station.reset()
 
     def add_instruction(self, instructions):
-        # Add an instruction to the queue
+        # Add an instruction to the queue and decode it once for the issue stage; an assembled program
+        # (see assembler.py) brings its own lazily decoded table instead
         self.instruction_queue = instructions
+        decoded = getattr(instructions, "decoded", None)
+        self.program = decoded if decoded is not None else decode_program(instructions)
 
-    def try_issue_instruction(self):
-        # Try to issue the first instruction in the queue if there are no WAW hazards
-        if self.branching_station:
+    def named_memory_words(self):
+        return named_memory_words(self.program, self.memory.size)
+
+    def used_register_names(self):
+        return used_register_names(self.program)
+
+    def find_issue_station(self):
+        # Return (decoded instruction, free station) for the queue head if it can issue now, else None
+        if self.rob is None:
+            if self.branching_station:
+                return None
+        elif self.rob.full():
             return None
-        if self.instruction_queue_index != len(self.instruction_queue):
-            instruction = Instruction(self.instruction_queue[self.instruction_queue_index])
-            write_Reg = self.registers[instruction.dest]
-            if write_Reg.get_write_status():
+        if self.instruction_queue_index != len(self.program):
+            decoded = self.program[self.instruction_queue_index]
+            # The reorder buffer renames destinations, so only the non-speculative machine stalls on WAW hazards
+            if self.rob is None and decoded.dest_index is not None and self.register_producers[decoded.dest_index] >= 0:
                 return None  # Stall due to WAW hazard
 
-            for name, station in self.stations.items():
-                if station.assign_station(instruction.op) and not station.busy:
-                    self.instruction_queue_index+=1
-                    station.load_instruction(instruction, self.instruction_queue_index)
-                    print(station.name)
-                    if instruction.op not in ["BRANCH", "BEQZ", "BNEQZ"]:
-                        self.registers[instruction.dest].set_write_status(station.name)
-                    else:
-                        self.branching_station = station
-                    station.busy = True
-                    return station
+            for station in self.station_list:
+                if not station.busy and decoded.op in station.op_types:
+                    return decoded, station
         return None
 
-    def execute_cycle(self):
-        # Execute a cycle, handling the stages of each reservation station
-        # Clear the write stage station and update the register status
-        if self.write_stage_station:
-            self.write_stage_station.perform_write(self.registers)
-            reg = self.write_stage_station.instruction.dest
-            self.registers[reg].clear_write_status()
-            self.write_stage_station.reset()
-            self.write_stage_station = None
-
-        
-        # TODO: add support for immediate values
-
-        start_next_issue = True
-        # Handle the issue stage station
-        print(self.issue_stage_stations)
-        for issue_station in self.issue_stage_stations:
-            if issue_station:
-                #Stall execution if RAW hazard
-                # Immediate Processing Case
-                print(issue_station)
-                if issue_station.instruction.src1 and not self.registers[issue_station.instruction.src1].get_write_status() and \
-                    issue_station.instruction.src2 == None:
-                    issue_station.instruction.Vj = self.registers[issue_station.instruction.src1].value
-                    issue_station.instruction.Vk = int(issue_station.instruction.immediate)
-                    issue_station.instruction.Qj = None
-                    issue_station.instruction.Qk = None
-                    issue_station.stage = 'Execute'
-                    self.issue_stage_stations.remove(issue_station)
-                # Normal Processing Case, when no RAW hazard
-                elif not self.registers[issue_station.instruction.src1].get_write_status() and \
-                    not self.registers[issue_station.instruction.src2].get_write_status():
-                    issue_station.instruction.Vj = self.registers[issue_station.instruction.src1].value
-                    issue_station.instruction.Vk = self.registers[issue_station.instruction.src2].value
-                    issue_station.instruction.Qj = None
-                    issue_station.instruction.Qk = None
-                    issue_station.stage = 'Execute'
-                    self.issue_stage_stations.remove(issue_station)
-                else:
-                    if self.registers[issue_station.instruction.src1].writing_station == issue_station.name:
-                        issue_station.instruction.Vj = self.registers[issue_station.instruction.src1].value
-                        issue_station.instruction.Qj = None
-
-                    if issue_station.instruction.src2 and self.registers[issue_station.instruction.src2].writing_station == issue_station.name:
-                        issue_station.instruction.Vk = self.registers[issue_station.instruction.src2].value
-                        issue_station.instruction.Qk = None
-
-                    if issue_station.instruction.Qj == None and issue_station.instruction.Qk == None:
-                        issue_station.stage = 'Execute'
-                        self.issue_stage_stations.remove(issue_station)
-                    # else:
-                    #     start_next_issue = False  
-                
-
-        # Attempt to issue an instruction if possible
-        if start_next_issue:
-            try_issue_station = self.try_issue_instruction()
-            if try_issue_station:
-                self.issue_stage_stations.append(try_issue_station)
-                if self.registers[try_issue_station.instruction.src1].get_write_status():
-                    try_issue_station.instruction.Vj = try_issue_station.instruction.src1
-                    try_issue_station.instruction.Qj = self.registers[try_issue_station.instruction.src1].writing_station
-                else:
-                    try_issue_station.instruction.Vj = self.registers[try_issue_station.instruction.src1].value
-                    try_issue_station.instruction.Qj = None
-
-                if try_issue_station.instruction.src2 == None:
-                    try_issue_station.instruction.Vk = int(try_issue_station.instruction.immediate)
-                    try_issue_station.instruction.Qk = None
-                elif self.registers[try_issue_station.instruction.src2].get_write_status():
-                    try_issue_station.instruction.Vk = try_issue_station.instruction.src2
-                    try_issue_station.instruction.Qk = self.registers[try_issue_station.instruction.src2].writing_station
+    def issue_stall_reason(self):
+        # Why the instruction at the head of the queue cannot issue now:
+        # "branch", "rob_full", "waw" or "structural"; None if it can issue (or the queue is empty)
+        if self.instruction_queue_index == len(self.program):
+            return None
+        if self.rob is None:
+            if self.branching_station:
+                return "branch"
+        elif self.rob.full():
+            return "rob_full"
+        decoded = self.program[self.instruction_queue_index]
+        if self.rob is None and decoded.dest_index is not None and self.register_producers[decoded.dest_index] >= 0:
+            return "waw"
+        for station in self.station_list:
+            if not station.busy and decoded.op in station.op_types:
+                return None
+        return "structural"
+
+    def try_issue_instruction(self):
+        # Try to issue the first instruction in the queue if there are no WAW hazards
+        target = self.find_issue_station()
+        if target is None:
+            return None
+        decoded, station = target
+        instruction = Instruction.from_decoded(decoded)
+        self.instruction_queue_index+=1
+        station.load_instruction(instruction, self.instruction_queue_index)
+        station.issue_cycle = self.cycle
+        station.sequence = self.issued_instructions
+        self.issued_instructions += 1
+        if self.hooks is not None and self.hooks.wants(IssueEvent):
+            self.hooks.publish(IssueEvent(self.cycle, station, station.sequence, self.instruction_queue_index - 1,
+                                          instruction.instruction_str))
+        # Operands are read before the destination is claimed, so "ADD R1, R1, R2" does not wait on itself
+        self.read_operands(station)
+        if self.rob is not None:
+            self.allocate_rob_entry(station, decoded)
+        elif decoded.opcode in BRANCH_OPCODES:
+            self.branching_station = station
+        elif decoded.dest_index is not None:
+            self.register_producers[decoded.dest_index] = station.tag
+        station.busy = True
+        return station
+
+    def allocate_rob_entry(self, station, decoded):
+        # Give a newly issued instruction its reorder buffer entry; branches redirect the front end as predicted
+        entry = self.rob.allocate()
+        entry.sequence = station.sequence
+        entry.opcode = decoded.opcode
+        entry.pc = self.instruction_queue_index - 1
+        entry.dest_index = decoded.dest_index
+        entry.station = station
+        station.rob_entry = entry
+        if decoded.opcode in BRANCH_OPCODES:
+            entry.dest_index = None
+            predicted = decoded.opcode == Opcode.BRANCH or self.predictor.predict(entry.pc)
+            entry.predicted_taken = predicted
+            if predicted:
+                self.instruction_queue_index = decoded.target
+        elif decoded.dest_index is not None:
+            self.register_producers[decoded.dest_index] = entry.tag
+
+    def read_operands(self, station):
+        # Capture ready source values, or subscribe to the producing station's CDB broadcast
+        if self.rob is not None:
+            return self.read_renamed_operands(station)
+        instruction = station.instruction
+        decoded = instruction.decoded
+        producers = self.register_producers
+        tag = producers[decoded.src1_index]
+        if tag >= 0:
+            producer = self.station_list[tag]
+            instruction.Vj = decoded.src1
+            instruction.Qj = producer.name
+            producer.consumers.append((station, 'j'))
+        else:
+            instruction.Vj = self.register_values[decoded.src1_index]
+            instruction.Qj = None
+
+        if decoded.src2_index is None:
+            instruction.Vk = decoded.immediate
+            instruction.Qk = None
+        else:
+            tag = producers[decoded.src2_index]
+            if tag >= 0:
+                producer = self.station_list[tag]
+                instruction.Vk = decoded.src2
+                instruction.Qk = producer.name
+                producer.consumers.append((station, 'k'))
+            else:
+                instruction.Vk = self.register_values[decoded.src2_index]
+                instruction.Qk = None
+
+        if instruction.Qj is None and instruction.Qk is None:
+            self.ready_stations.append(station)
+        if self.hooks is not None and self.hooks.wants(OperandCaptureEvent):
+            self.publish_captures(station)
+
+    def publish_captures(self, station):
+        # Operands a station read when it was issued
+        instruction = station.instruction
+        if instruction.Qj is None:
+            self.hooks.publish(OperandCaptureEvent(self.cycle, station, 'j', instruction.Vj, None))
+        if instruction.Qk is None:
+            self.hooks.publish(OperandCaptureEvent(self.cycle, station, 'k', instruction.Vk, None))
+
+    def read_renamed_operands(self, station):
+        # read_operands with a reorder buffer: register tags name entries, whose results may be waiting to commit
+        instruction = station.instruction
+        decoded = instruction.decoded
+        value, producer = self.renamed_source(decoded.src1_index)
+        if producer is not None:
+            instruction.Vj = decoded.src1
+            instruction.Qj = producer.name
+            producer.consumers.append((station, 'j'))
+        else:
+            instruction.Vj = value
+            instruction.Qj = None
+
+        if decoded.src2_index is None:
+            instruction.Vk = decoded.immediate
+            instruction.Qk = None
+        else:
+            value, producer = self.renamed_source(decoded.src2_index)
+            if producer is not None:
+                instruction.Vk = decoded.src2
+                instruction.Qk = producer.name
+                producer.consumers.append((station, 'k'))
+            else:
+                instruction.Vk = value
+                instruction.Qk = None
+
+        if instruction.Qj is None and instruction.Qk is None:
+            self.ready_stations.append(station)
+        if self.hooks is not None and self.hooks.wants(OperandCaptureEvent):
+            self.publish_captures(station)
+
+    def renamed_source(self, index):
+        # (value, None) if register `index` can be read now, else (None, station that will produce it)
+        tag = self.register_producers[index]
+        if tag < 0:
+            return self.register_values[index], None
+        entry = self.rob.entries[tag]
+        if entry.done:
+            return entry.value, None
+        return None, entry.station
+
+    def commit(self):
+        # Retire the oldest reorder buffer entry if its result is available; returns whether it did
+        entry = self.rob.oldest()
+        if entry is None or not entry.done:
+            return False
+        if entry.error is not None:
+            raise entry.error
+        if entry.opcode == Opcode.STORE:
+            self.memory.store(entry.address, entry.value)
+        elif entry.opcode in BRANCH_OPCODES:
+            self.branches += 1
+            self.branches_taken += entry.taken
+            self.mispredictions += entry.taken != entry.predicted_taken
+            if entry.opcode != Opcode.BRANCH:
+                self.predictor.update(entry.pc, entry.taken)
+        elif entry.dest_index is not None:
+            self.register_values[entry.dest_index] = entry.value
+            if self.register_producers[entry.dest_index] == entry.tag:
+                self.register_producers[entry.dest_index] = -1
+        if self.hooks is not None and self.hooks.wants(CommitEvent):
+            self.hooks.publish(CommitEvent(self.cycle, entry.sequence, entry.pc))
+        self.rob.retire()
+        return True
+
+    def resolve_branch(self, station):
+        # Speculative branch resolution: squash and redirect the front end if the prediction was wrong
+        instruction = station.instruction
+        entry = station.rob_entry
+        entry.taken = BRANCH_CONDITIONS[instruction.opcode](instruction.Vj)
+        entry.done = True
+        if self.hooks is not None and self.hooks.wants(BranchResolvedEvent):
+            target = instruction.A if entry.taken else instruction.index
+            self.hooks.publish(BranchResolvedEvent(self.cycle, station, station.sequence, entry.taken,
+                                                   entry.predicted_taken, target))
+        if entry.taken != entry.predicted_taken:
+            self.squash(entry.sequence)
+            self.instruction_queue_index = instruction.A if entry.taken else instruction.index
+        self.release_station(station)
+
+    def broadcast(self, producer, value):
+        # Common data bus: hand the result to the stations waiting on the producer's tag only
+        if self.hooks is not None and self.hooks.wants(OperandCaptureEvent):
+            for consumer, slot in producer.consumers:
+                self.hooks.publish(OperandCaptureEvent(self.cycle, consumer, slot, value, producer))
+        for consumer, slot in producer.consumers:
+            instruction = consumer.instruction
+            if slot == 'j':
+                instruction.Vj = value
+                instruction.Qj = None
+            else:
+                instruction.Vk = value
+                instruction.Qk = None
+            if instruction.Qj is None and instruction.Qk is None:
+                self.ready_stations.append(consumer)
+        producer.consumers = []
+
+    def memory_address(self, station):
+        # Effective address of a load/store, or None while its base register value is not available
+        instruction = station.instruction
+        if instruction.opcode == Opcode.LOAD:
+            return instruction.Vj + instruction.Vk if instruction.Qj is None else None
+        return instruction.Vk + instruction.immediate if instruction.Qk is None else None
+
+    def memory_conflict(self, station):
+        # Whether an older load/store must access memory first: loads wait for older stores to the same or an
+        # unknown address, stores also for such older loads. Independent loads bypass pending stores.
+        address = self.memory_address(station)
+        is_store = station.instruction.opcode == Opcode.STORE
+        for other in self.station_list:
+            if other.busy and other.sequence < station.sequence and other.instruction.opcode in MEMORY_OPCODES:
+                if is_store or other.instruction.opcode == Opcode.STORE:
+                    other_address = self.memory_address(other)
+                    if other_address is None or other_address == address:
+                        return True
+        if self.rob is not None:
+            # Stores that have left their station only write memory when they commit
+            for entry in self.rob:
+                if entry.sequence >= station.sequence:
+                    break
+                if entry.opcode == Opcode.STORE and entry.done and entry.address == address:
+                    return True
+        return False
+
+    def quiet_cycles(self):
+        # Number of upcoming cycles in which nothing happens except executing stations counting down.
+        # Any write-back, operand capture, issue, completion or branch resolution ends the quiet stretch.
+        if self.write_stage_stations or self.ready_stations:
+            return 0
+        if self.find_issue_station() is not None:
+            return 0
+        if self.rob is not None and self.rob.count and self.rob.oldest().done:
+            return 0  # Commits this cycle
+
+        quiet = None
+        for station in self.station_list:
+            if station.stage != 'Execute':
+                continue
+            if station.remaining_cycles > 1:
+                if quiet is None or station.remaining_cycles - 1 < quiet:
+                    quiet = station.remaining_cycles - 1
+            elif station.instruction.opcode not in BRANCH_OPCODES or self.rob is not None:
+                return 0  # Completes and takes the write stage (or resolves) this cycle
+            else:
+                # A finished branch only waits while an older instruction still holds a station
+                for other in self.station_list:
+                    if other.busy and other.instruction.index < self.instruction_queue_index:
+                        break
                 else:
-                    try_issue_station.instruction.Vk =self.registers[ try_issue_station.instruction.src2].value
-                    try_issue_station.instruction.Qk = None
-       
+                    return 0
+        return quiet or 0
+
+    def skip_cycles(self, count):
+        # Advance through `count` quiet cycles (as reported by quiet_cycles) in one step
+        for station in self.station_list:
+            if station.stage == 'Execute' and station.remaining_cycles > 1:
+                station.remaining_cycles -= count
+        self.cycle += count
+        if self.instruction_queue_index != len(self.program):
+            self.issue_stall_cycles += count
+        if self.hooks is not None:
+            self.publish_cycle_end(0, count)
+
+    def execute_cycle(self):
+        # Execute a cycle and return whether every station is idle at its end
+        self.cycle += 1
+        issued = self.issued_instructions
+        all_stations_idle = self.process_cycle()
+        if self.issued_instructions == issued and self.instruction_queue_index != len(self.program):
+            self.issue_stall_cycles += 1
+        if self.hooks is not None:
+            self.publish_cycle_end(self.issued_instructions - issued, 1)
+        return all_stations_idle
+
+    def finished(self):
+        # Whether every instruction has been issued and has left the pipeline
+        return (self.instruction_queue_index == len(self.program)
+                and all(station.stage == "Idle" for station in self.station_list)
+                and (self.rob is None or not self.rob.count))
+
+    def publish_cycle_end(self, issued, count):
+        # Lost issue slots and the end of the cycle (or of `count` skipped cycles), for subscribers
+        hooks = self.hooks
+        if hooks.wants(StallEvent) and issued < self.issue_width and self.instruction_queue_index != len(self.program):
+            # Nothing blocking the queue head any more means the front end was just redirected by a branch
+            reason = self.issue_stall_reason() or "branch"
+            hooks.publish(StallEvent(self.cycle, reason, (self.issue_width - issued) * count, None))
+        if hooks.wants(CycleEndEvent):
+            hooks.publish(CycleEndEvent(self.cycle, issued, count))
+
+    def subscribe(self, callback, *event_types):
+        # Call callback(event) for each published event of the given types (every type if none are given)
+        if self.hooks is None:
+            self.hooks = EventBus()
+        self.hooks.subscribe(callback, *event_types)
+
+    def unsubscribe(self, callback):
+        if self.hooks is not None:
+            self.hooks.unsubscribe(callback)
+            if not self.hooks:
+                self.hooks = None
+
+    def process_cycle(self):
+        # Handle the stages of each reservation station for the current cycle
+        # Commit the oldest instructions when speculating, as many per cycle as can issue
+        if self.rob is not None:
+            for _ in range(self.issue_width):
+                if not self.commit():
+                    break
+
+        # Write back the results of the write stage stations and wake up their consumers
+        hooks = self.hooks
+        for station in self.write_stage_stations:
+            entry = station.rob_entry
+            if entry is None:
+                result = station.perform_write(self.register_values, self.memory)
+                dest_index = station.instruction.decoded.dest_index
+                if dest_index is not None and self.register_producers[dest_index] == station.tag:
+                    self.register_producers[dest_index] = -1
+            else:
+                # The result waits in the reorder buffer; errors on a mispredicted path must not stop the run
+                try:
+                    result = station.compute_result(self.memory)
+                except (ArithmeticError, IndexError, ValueError) as error:
+                    result = None
+                    entry.error = error
+                entry.value = result
+                entry.address = station.instruction.A
+                entry.done = True
+                entry.station = None
+                if entry.opcode == Opcode.STORE:
+                    result = None
+            if hooks is not None and hooks.wants(WriteBackEvent):
+                hooks.publish(WriteBackEvent(self.cycle, station, station.sequence, result))
+            self.broadcast(station, result)
+            self.release_station(station)
+        if self.write_stage_stations:
+            self.write_stage_stations = []
+
+        # Stations whose operands are all available start executing; loads and stores wait until
+        # no older access to the same address is pending
+        if self.ready_stations:
+            waiting = []
+            for station in self.ready_stations:
+                if station.instruction.opcode in MEMORY_OPCODES:
+                    if self.memory_conflict(station):
+                        waiting.append(station)
+                        continue
+                    address = self.memory_address(station)
+                    # A speculative access is only checked when it is used, as it may be squashed
+                    station.instruction.A = self.memory.check(address) if self.rob is None else address
+                station.stage = 'Execute'
+                if hooks is not None and hooks.wants(ExecuteStartEvent):
+                    hooks.publish(ExecuteStartEvent(self.cycle, station, station.sequence))
+            self.ready_stations = waiting
+
+        # Issue up to issue_width instructions, in order
+        if self.try_issue_instruction() is not None and self.issue_width > 1:
+            for _ in range(self.issue_width - 1):
+                if self.try_issue_instruction() is None:
+                    break
 
         all_stations_idle = True
+        finished = []                  # Stations that completed execution and compete for a common data bus
         # Process each reservation station
-        for name, station in self.stations.items():
+        for station in self.station_list:
             if station.instruction:
                 # Handle the execute stage
                 if station.stage == 'Execute':
                     if station.remaining_cycles > 1:
                         station.remaining_cycles -= 1
-                    elif not self.write_stage_station:
-                        if station.instruction.op not in ["BRANCH", "BEQZ", "BNEQZ"]:
-                            station.stage = 'Write'
-                            station.remaining_cycles -= 1
-                            self.write_stage_station = station
+                    else:
+                        if station.instruction.opcode not in BRANCH_OPCODES:
+                            finished.append(station)
+                        elif self.rob is not None:
+                            self.resolve_branch(station)
                         else:
-                        
-                            for name, station in self.stations.items():
-                                if station.busy and station.instruction.index < self.instruction_queue_index:
+                            # Resolve the branch once every older instruction has left its station
+                            for other in self.station_list:
+                                if other.busy and other.instruction.index < self.instruction_queue_index:
                                     all_stations_idle = False
                                     break
                             if not all_stations_idle:
-                                continue     
-                            elif station.instruction.op == "BRANCH":
-                                # self.flush_stations(self.instruction_queue_index)
-                                self.instruction_queue_index = station.instruction.A
-                                self.branching_station = None
-                                station.reset()
-                                self.execute_cycle()
-                            
-                            elif station.instruction.op == "BEQZ":
-                                if self.registers[station.instruction.src1].value == 0:
-                                    # self.flush_stations(self.instruction_queue_index)
-                                    self.instruction_queue_index = station.instruction.A
-                                self.branching_station = None
-                                station.reset()
-                                self.execute_cycle()
-
-                            elif station.instruction.op == "BNEQZ":
-                                if self.registers[station.instruction.src1].value != 0:
-                                    # self.flush_stations(self.instruction_queue_index)
-                                    self.instruction_queue_index = station.instruction.A
-                                station.reset()
-                                self.branching_station = None
-                                self.execute_cycle()
-
-
-
-                            # Perform Branch
-
+                                continue
+                            instruction = station.instruction
+                            self.branches += 1
+                            taken = BRANCH_CONDITIONS[instruction.opcode](instruction.Vj)
+                            if hooks is not None and hooks.wants(BranchResolvedEvent):
+                                target = instruction.A if taken else self.instruction_queue_index
+                                hooks.publish(BranchResolvedEvent(self.cycle, station, station.sequence, taken, None,
+                                                                  target))
+                            if taken:
+                                self.branches_taken += 1
+                                self.instruction_queue_index = instruction.A
+                            self.branching_station = None
+                            self.release_station(station)
+                            # Redirecting the front end is free: the rest of the cycle runs again, and may
+                            # issue into stations this loop has already passed
+                            if not self.process_cycle():
+                                all_stations_idle = False
 
             if station.stage != "Idle":
                 all_stations_idle = False
 
+        if finished:
+            self.arbitrate(finished)
+
+        if self.rob is not None and self.rob.count:
+            all_stations_idle = False
         return all_stations_idle
 
+    def arbitrate(self, finished):
+        # Grant the free common data buses to finished stations; the others stay in Execute and retry next cycle
+        # (a resolved branch re-runs the cycle, so some may already have been granted a bus)
+        finished = [station for station in finished if station.stage == 'Execute']
+        free = self.cdb_width - len(self.write_stage_stations)
+        hooks = self.hooks
+        if len(finished) > free:
+            finished = ARBITRATION_POLICIES[self.arbitration](self, finished)
+            self.cdb_stall_cycles += len(finished) - free
+            if hooks is not None and hooks.wants(StallEvent):
+                for station in finished[free:]:
+                    hooks.publish(StallEvent(self.cycle, "cdb", 1, station))
+        for station in finished[:free]:
+            station.stage = 'Write'
+            station.remaining_cycles -= 1
+            self.write_stage_stations.append(station)
+            self.last_granted = station.tag
+            if hooks is not None and hooks.wants(CompleteEvent):
+                hooks.publish(CompleteEvent(self.cycle, station, station.sequence))
+
     def get_station_statuses(self):
         # Return the current status of each reservation station
         return {name: str(station) for name, station in self.stations.items()}
 
+# Write-back arbitration: order in which finished stations are granted the common data buses
+def oldest_first(rs_manager, stations):
+    return sorted(stations, key=lambda station: station.sequence)
+
+
+def longest_latency_first(rs_manager, stations):
+    return sorted(stations, key=lambda station: (-station.execution_time, station.sequence))
+
+
+def round_robin(rs_manager, stations):
+    # Stations after the one granted most recently come first, in station order
+    count = len(rs_manager.station_list)
+    return sorted(stations, key=lambda station: (station.tag - rs_manager.last_granted - 1) % count)
+
+
+ARBITRATION_POLICIES = {"oldest": oldest_first, "longest_latency": longest_latency_first, "round_robin": round_robin}
+
 # Execution times and station counts for different instruction types
 execution_times = {"ADD": 4, "MUL": 1, "DIV": 40, "STORE": 3, "BRANCH": 3}
 station_counts = {"ADD": 2, "MUL": 2, "DIV": 1, "STORE": 2, "BRANCH": 1}
@@ -349,13 +987,26 @@ optypes = { "ADD": ["ADD", "SUB", "DADDI", "DSUBI"],
            "STORE": ["STORE", "LOAD"],
            "BRANCH": ["BRANCH", "BEQZ", "BNEQZ"]}
 
-# Initialize the Reservation Station Manager with initial register values
+# Data memory: size in bytes, and an optional file whose contents it starts with
+memory = {"size": MEMORY_SIZE, "file": None}
+
+# Speculation: reorder buffer entries (0 disables speculation) and the branch predictor
+# ("taken", "2bit" or "gshare") with its table size in address bits
+rob = {"size": 0, "predictor": "2bit", "predictor_bits": 10}
+
+# Instructions issued per cycle, common data buses, and the write-back arbitration policy
+# ("oldest", "longest_latency" or "round_robin")
+pipeline = {"issue_width": 1, "cdb_width": 1, "arbitration": "oldest"}
+
+# Machine used when a configuration does not override a setting
+DEFAULT_CONFIG = {"station_counts": station_counts, "execution_times": execution_times, "optypes": optypes,
+                  "memory": memory, "rob": rob, "pipeline": pipeline}
+
+# Initial register values of the demo program
 initial_values = ["R1 80", "R2 10", "R3 80", "R4 20", "R5 5", "R6 10", "R7 16",
                   "M0 10", "M8 16", "M16 32", "M24 64", "M32 128"]
 # initial_values = ["M0 8", "M8 16", "M16 32", "M24 64", "M32 128"]
 
-rs_manager = ReservationStationManager(station_counts, execution_times, optypes, initial_values)
-
 # List of instructions to be issued
 # instructions = ["SUB R1, R2, R3", "ADD R1, R2, R3", "ADD R7, R3, R3", "ADD R2, R7, R3", "MUL R4, R2, R6", "ADD R4, R8, R7"]
 # instructions = ["ADD R1, R1, R3", "ADD R4, R5, R3", "DSUBI R10, R1, #100"]
@@ -365,79 +1016,196 @@ instructions = ["LOAD R2, M0, X", "DADDI R4, R2, #10",  "ADD R1, R4, R3", "ADD R
 
 # instructions = ["LOAD R1, M8, X",  "DADDI R5, R5, #100", "STORE M8, R5, X", "DSUBI R10, R1, #100"]
 
-rs_manager.add_instruction(instructions)
 
+def run_simulation(rs_manager, engine="step", trace=True, base_file_name="log", verbose=False, max_cycles=None,
+                   cache_dir=None):
+    """
+    Runs rs_manager until every instruction has been processed and returns the number of cycles.
 
+    Args:
+    rs_manager: The reservation station manager object, with its instructions already added.
+    engine: "step" simulates every cycle, "skip" jumps over cycles where only execution counters change,
+            "memo" also replays the timing of repeating loop iterations (see loopmemo.py), "compiled" skips like
+            "skip" with code generated for the program and machine (see specialize.py); all give the same result.
+    trace: Whether to record the state of every cycle (skipped cycles included) in a binary trace.
+    base_file_name: The trace is written to base_file_name + ".trc".
+    verbose: Whether to print the status of every station after each simulated cycle.
+    max_cycles: Raise RuntimeError if the program has not finished after this many cycles.
+    cache_dir: Directory where the "compiled" engine caches the code it generates, or None (the default) to
+               generate and verify it for every run without writing anything.
+    """
+    if engine not in ("step", "skip", "memo", "compiled"):
+        raise ValueError(f"Unknown engine: {engine!r}")
+    writer = TraceWriter(f"{base_file_name}.trc", rs_manager) if trace else None
+    subscribers = []
+    if writer:
+        writer.record(rs_manager.cycle)
+        subscribers.append(lambda event: writer.record(event.cycle))
+    if verbose:
+        subscribers.append(lambda event: print_statuses(rs_manager, event.cycle))
+    for callback in subscribers:
+        rs_manager.subscribe(callback, CycleEndEvent)
+    specialized = False
+    if engine == "compiled" and not trace:
+        import specialize  # Imported here: specialize builds on this module
+        specialized = specialize.specialize(rs_manager, cache_dir)
+    try:
+        return _run_cycles(rs_manager, engine, trace, max_cycles)
+    finally:
+        if specialized:
+            specialize.uninstall(rs_manager)
+        for callback in subscribers:
+            rs_manager.unsubscribe(callback)
+        if writer:
+            writer.close()
 
-# Add all instructions to the manager's queue right away
 
+def print_statuses(rs_manager, cycle):
+    print(f"Cycle {cycle}:")
+    for station, status in rs_manager.get_station_statuses().items():
+        print(f"  {status} ")
 
-def log_rs_manager_state(rs_manager, cycle, base_file_name="log"):
-    """
-    Logs the state of rs_manager to a file. Creates a new file on the first iteration and appends to it on subsequent iterations.
 
-    Args:
-    rs_manager: The reservation station manager object.
-    cycle: The current cycle number.
-    base_file_name: The base name for the log file.
-    """
-    # Determine file names
-    text_file_name = f"{base_file_name}.txt"
-    json_file_name = f"{base_file_name}.json"
+def _run_cycles(rs_manager, engine, trace, max_cycles):
+    # Main loop of run_simulation; the trace is recorded by a subscriber to the end of every cycle.
+    # Counting starts from the manager's cycle, so a manager restored from a checkpoint resumes where it was.
+    cycle = rs_manager.cycle
+    if cycle and rs_manager.finished():
+        return cycle
+    memo = None
+    if engine == "memo" and rs_manager.rob is None and not trace:
+        from loopmemo import LoopMemo  # Imported here: loopmemo builds on functional, which imports this module
+        memo = LoopMemo(rs_manager)
 
-    # Extracting the state of each reservation station
-    stations_data_txt = []
-    for name, station in rs_manager.stations.items():
-        stations_data_txt.append(str(station))
-    stations_data_json = [str(station) for station in rs_manager.stations]
-    
-    # Extracting the values of all registers
-    registers_data_txt = [f"{name}, {reg.value}" for name, reg in rs_manager.registers.items()]
-
-    # Constructing the log data
-    log_data = {
-        # "cycle": cycle,
-        "reservation_stations": stations_data_txt,
-        "register_values": registers_data_txt
-    }
+    while True:
+        if max_cycles is not None and cycle >= max_cycles:
+            raise RuntimeError(f"Program did not finish within {max_cycles} cycles")
 
-    # Open the file in append mode if it's not the first cycle, else in write mode
-    mode = "a" if cycle > 1 else "w"
+        if engine != "step":
+            skipped = rs_manager.quiet_cycles()
+            if skipped:
+                # Quiet cycles are still recorded one by one when tracing
+                if trace:
+                    skipped = 1
+                elif max_cycles is not None:
+                    skipped = min(skipped, max_cycles - cycle)
+                rs_manager.skip_cycles(skipped)
+                cycle += skipped
+                continue
 
-    # Writing to the text file
-    with open(text_file_name, mode) as file:
-        file.write(f"Cycle {cycle}:\n")
-        for key, value in log_data.items():
-            file.write(f"{key}: {value}\n")
-        file.write("\n")  # Adding a newline for separation between cycles
+        cycle += 1
+        branches = rs_manager.branches
+        all_idle = rs_manager.execute_cycle()
 
-    # Writing to the JSON file
-    with open(json_file_name, mode) as file:
-        if cycle == 1:
-            file.write("[")  # Start of JSON array
-        else:
-            file.write(",\n")  # Separator between JSON objects
-        json.dump(log_data, file, indent=4)
-        if cycle == 1:
-            file.write("\n")  # End of JSON array
+        if all_idle and rs_manager.instruction_queue_index == len(rs_manager.instruction_queue):
+            return cycle
+        # Loop periods are only replayed while nothing observes the individual cycles
+        if memo is not None and rs_manager.branches != branches and rs_manager.hooks is None:
+            cycle += memo.visit(None if max_cycles is None else max_cycles - cycle)
 
-    print(f"Logged rs_manager data for cycle {cycle} to {text_file_name} and {json_file_name}")
 
-# Simulate execution cycles
-cycle = 0
-log_rs_manager_state(rs_manager, cycle)
+# Outcome of one simulation run
+class SimulationResult:
+    def __init__(self, cycles, registers, stats, profiler=None):
+        self.cycles = cycles          # Total number of cycles
+        self.registers = registers    # Final register values, and named memory words ("M<address>"), by name
+        self.stats = stats            # Counters collected during the run
+        self.profiler = profiler      # Profiler of the run, if it was profiled
 
-while True:
-    
-    log_rs_manager_state(rs_manager, cycle)
-    cycle += 1
-    all_idle = rs_manager.execute_cycle()
-    # print(f"Cycle {cycle}:")
-    for station, status in rs_manager.get_station_statuses().items():
-        print(f"  {status} ")
+    def as_dict(self):
+        result = {"cycles": self.cycles, "registers": self.registers, "stats": self.stats}
+        if self.profiler is not None:
+            result["profile"] = self.profiler.summary()
+        return result
+
+    def __repr__(self):
+        return f"SimulationResult(cycles={self.cycles}, stats={self.stats})"
+
+
+def make_config(config=None):
+    # Fill in the settings a configuration does not override from DEFAULT_CONFIG
+    return dict(DEFAULT_CONFIG, **(config or {}))
+
+
+def make_memory(config):
+    # Data memory described by the "memory" section of a configuration
+    return Memory(config["memory"].get("size", MEMORY_SIZE), config["memory"].get("file"))
+
+
+def make_manager(config, initial_values=(), memory=None):
+    # ReservationStationManager for a configuration completed by make_config, with no program added yet
+    speculation = dict(rob, **config["rob"])
+    predictor = make_predictor(speculation["predictor"], speculation["predictor_bits"])
+    widths = dict(pipeline, **config["pipeline"])
+    return ReservationStationManager(config["station_counts"], config["execution_times"], config["optypes"],
+                                     initial_values, memory if memory is not None else make_memory(config),
+                                     speculation["size"], predictor, widths["issue_width"], widths["cdb_width"],
+                                     widths["arbitration"])
+
+
+def collect_stats(rs_manager, cycles):
+    # Summary counters of a finished run
+    executed = rs_manager.issued_instructions - rs_manager.squashed_instructions
+    stats = {
+        "instructions_issued": rs_manager.issued_instructions,
+        "instructions_squashed": rs_manager.squashed_instructions,
+        "ipc": executed / cycles if cycles else 0.0,
+        "issue_stall_cycles": rs_manager.issue_stall_cycles,
+        "cdb_stall_cycles": rs_manager.cdb_stall_cycles,
+        "branches": rs_manager.branches,
+        "branches_taken": rs_manager.branches_taken,
+        "mispredictions": rs_manager.mispredictions,
+        "prediction_accuracy": 1 - rs_manager.mispredictions / rs_manager.branches if rs_manager.branches else 1.0,
+    }
+    busy_cycles = {}
+    station_count = {}
+    for name, station in rs_manager.stations.items():
+        busy_cycles[station.op_type] = busy_cycles.get(station.op_type, 0) + station.busy_cycles
+        station_count[station.op_type] = station_count.get(station.op_type, 0) + 1
+    total = len(rs_manager.stations) * cycles
+    stats["utilization"] = sum(busy_cycles.values()) / total if total else 0.0
+    stats["station_utilization"] = {op_type: busy_cycles[op_type] / (station_count[op_type] * cycles) if cycles else 0.0
+                                    for op_type in busy_cycles}
+    return stats
+
+
+def simulate(program, config=None, initial_values=(), engine="step", max_cycles=None, profile=False, cache_dir=None):
+    """
+    Simulates a program without logging or printing anything and returns a SimulationResult.
+
+    Args:
+    program: List of instruction strings, or an assembled program (see assembler.py).
+    config: Dictionary overriding any of "station_counts", "execution_times", "optypes", "memory", "rob" and
+            "pipeline" of DEFAULT_CONFIG.
+    initial_values: Initial register values, as strings like "R1 80".
+    engine: "step", "skip", "memo" or "compiled" (see run_simulation).
+    max_cycles: Raise RuntimeError if the program has not finished after this many cycles.
+    profile: Whether to attach a Profiler; it is returned as the result's profiler.
+    cache_dir: Directory where the "compiled" engine caches generated code; nothing is written if None.
+    """
+    config = make_config(config)
+    memory = make_memory(config)
+    try:
+        rs_manager = make_manager(config, initial_values, memory)
+        rs_manager.add_instruction(program if hasattr(program, "decoded") else list(program))
+        profiler = Profiler(rs_manager) if profile else None
+        cycles = run_simulation(rs_manager, engine=engine, trace=False, max_cycles=max_cycles, cache_dir=cache_dir)
+        registers = dict(zip(REGISTER_NAMES, rs_manager.register_values))
+        registers.update((f"M{address}", memory.load(address)) for address in rs_manager.named_memory_words())
+    finally:
+        memory.close()
+    return SimulationResult(cycles, registers, collect_stats(rs_manager, cycles), profiler)
+
+
+if __name__ == "__main__":
+    # Initialize the Reservation Station Manager with initial register values
+    rs_manager = ReservationStationManager(station_counts, execution_times, optypes, initial_values)
+    # Add all instructions to the manager's queue right away
+    rs_manager.add_instruction(instructions)
 
-    if all_idle and rs_manager.instruction_queue_index == len(rs_manager.instruction_queue):
-        log_rs_manager_state(rs_manager, cycle)
-        break
+    # Simulate execution cycles, then export the trace in the formats read by the GUI
+    run_simulation(rs_manager, verbose=True)
+    export_text("log.trc", "log.txt")
+    export_json("log.trc", "log.json")
 
-print("All instructions have been processed.")
+    print("All instructions have been processed.")
@@ -0,0 +1,369 @@
+# Assembler for program files, and lazily decoded programs for the simulator.
+#
+# Source syntax, one statement per line:
+#   loop:  ADD R1, R1, R2        ; labels end with ":", several may precede an instruction or stand alone
+#          BNEQZ R10, loop       # branch targets are labels or instruction indices
+#          .reg R1, 80           ; initial register value
+#          .word 0, 10, 16, 32   ; initial memory words from a byte address, one per WORD_SIZE bytes
+# Comments start with ";", "//", or a "#" that is not an immediate (not followed by a digit or sign).
+# ".text" and ".data" are accepted and ignored. Labels are resolved in a single pass over the source:
+# forward references are patched once the whole source has been read.
+#
+# The assembled program is a binary file: a header, one record per instruction (branch target and text),
+# an index of record offsets, and the initial values of the directives. AssembledProgram memory-maps it and
+# acts as a sequence of instruction strings; its `decoded` FetchWindow decodes only the instructions around
+# the ones being fetched, so the simulator never holds the whole program.
+
+import argparse
+import array
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+from collections import OrderedDict
+
+from memory import WORD_SIZE
+from Tomasulo import BRANCH_OPCODES, REGISTER_INDEX, DecodedInstruction, Opcode
+
+MAGIC = b"TOMASM\0\0"
+VERSION = 1
+
+_header = struct.Struct("<8sHQQQ")   # magic, version, instruction count, index offset, initial values offset
+_record = struct.Struct("<iH")       # branch target (-1 if none), text length; followed by the text
+_offset = struct.Struct("<Q")        # index entry: file offset of a record
+
+# Operands each opcode takes (a legacy third branch operand such as "#0" is accepted and dropped)
+OPERAND_COUNTS = {
+    Opcode.ADD: (3,), Opcode.SUB: (3,), Opcode.MUL: (3,), Opcode.DIV: (3,),
+    Opcode.DADDI: (3,), Opcode.DSUBI: (3,), Opcode.MULI: (3,), Opcode.DIVI: (3,),
+    Opcode.LOAD: (2, 3), Opcode.STORE: (2, 3),
+    Opcode.BRANCH: (2, 3), Opcode.BEQZ: (2, 3), Opcode.BNEQZ: (2, 3),
+}
+
+IMMEDIATE_OPCODES = frozenset([Opcode.DADDI, Opcode.DSUBI, Opcode.MULI, Opcode.DIVI])
+OPCODE_NAMES = dict(Opcode.__members__)
+BRANCH_NAMES = frozenset(opcode.name for opcode in BRANCH_OPCODES)
+
+# Distinct statements remembered as valid while assembling (generated programs repeat a few statements)
+VALIDATED_STATEMENTS = 1 << 16
+
+# Bytes of records buffered before they are written
+WRITE_BUFFER = 1 << 20
+
+# Instructions decoded at a time by a FetchWindow, and blocks it keeps
+FETCH_BLOCK = 1024
+FETCH_BLOCKS = 16
+
+_label = re.compile(r"\s*([A-Za-z_.$][\w.$]*)\s*:")
+_identifier = re.compile(r"[A-Za-z_.$][\w.$]*$")
+_immediate = re.compile(r"#[+-]?\d+$")
+_comment = re.compile(r";|//|#(?![\d+-])")
+_operand_separator = re.compile(r"[\s,]+")
+
+
+class AssemblyError(ValueError):
+    # An error in the source, reported with its location
+    def __init__(self, message, name="<program>", line=None):
+        super().__init__(f"{name}:{line}: {message}" if line is not None else f"{name}: {message}")
+
+
+def _integer(text, what):
+    try:
+        return int(text)
+    except ValueError:
+        raise ValueError(f"Expected {what}, got {text!r}") from None
+
+
+def assemble(lines, output_path, name="<program>"):
+    """
+    Assembles source lines into a program binary and returns the number of instructions.
+
+    Args:
+    lines: Iterable of source lines, e.g. an open file; it is read once.
+    output_path: Path of the binary written.
+    name: Name of the source, used in error messages.
+    """
+    labels = {}                # Label -> instruction index
+    fixups = []                # (file offset of a target field, label, line number) of forward references
+    offsets = array.array("Q")
+    initial_values = []
+    highest_target = (-1, None)  # Largest numeric branch target, and its line, checked once the length is known
+    validated = set()          # (statement, token count) already validated; branches without their target
+    buffer = bytearray()       # Records not yet written
+    position = _header.size    # File offset of the next record
+    with open(output_path, "wb") as output:
+        output.write(_header.pack(MAGIC, VERSION, 0, 0, 0))
+        for number, line in enumerate(lines, 1):
+            match = _comment.search(line)
+            statement = line[:match.start()] if match else line
+            # Labels name the next instruction
+            match = _label.match(statement)
+            while match:
+                label = match.group(1)
+                if label in labels:
+                    raise AssemblyError(f"Duplicate label {label!r}", name, number)
+                labels[label] = len(offsets)
+                statement = statement[match.end():]
+                match = _label.match(statement)
+            statement = statement.strip()
+            if not statement:
+                continue
+            try:
+                if statement.startswith("."):
+                    initial_values += _directive(statement)
+                    continue
+                target = -1
+                parts = _operand_separator.split(statement)
+                if parts[0] in BRANCH_NAMES and len(parts) > 2:
+                    # The target is kept apart from the text, and appended when the instruction is fetched
+                    statement = f"{parts[0]} {parts[1]},"
+                    if parts[2].isdigit():
+                        target = int(parts[2])
+                        highest_target = max(highest_target, (target, number))
+                    elif _identifier.match(parts[2]):
+                        target = labels.get(parts[2], -1)
+                        if target < 0:
+                            fixups.append((position + len(buffer), parts[2], number))
+                    else:
+                        raise ValueError(f"Branch target {parts[2]!r} is neither a label nor an instruction index")
+                else:
+                    statement = f"{parts[0]} {', '.join(parts[1:])}"
+                if (statement, len(parts)) not in validated:
+                    _validate(statement, parts, target)
+                    if len(validated) >= VALIDATED_STATEMENTS:
+                        validated.clear()
+                    validated.add((statement, len(parts)))
+            except ValueError as error:
+                raise AssemblyError(str(error), name, number) from None
+            text = statement.encode()
+            offsets.append(position + len(buffer))
+            buffer += _record.pack(target, len(text))
+            buffer += text
+            if len(buffer) >= WRITE_BUFFER:
+                output.write(buffer)
+                position += len(buffer)
+                buffer.clear()
+        output.write(buffer)
+
+        count = len(offsets)
+        if highest_target[0] > count:
+            raise AssemblyError(f"Branch target {highest_target[0]} is past the end of the program ({count} "
+                                f"instructions)", name, highest_target[1])
+        index_offset = output.tell()
+        if sys.byteorder != "little":
+            offsets.byteswap()
+        output.write(offsets.tobytes())
+        values_offset = output.tell()
+        output.write("\n".join(initial_values).encode())
+        for offset, label, number in fixups:
+            if label not in labels:
+                raise AssemblyError(f"Undefined label {label!r}", name, number)
+            output.seek(offset)
+            output.write(struct.pack("<i", labels[label]))
+        output.seek(0)
+        output.write(_header.pack(MAGIC, VERSION, count, index_offset, values_offset))
+    return count
+
+
+def _validate(statement, parts, target):
+    # Check the operation, the operand count and every operand of an instruction; raises ValueError
+    if parts[0] not in OPCODE_NAMES:
+        raise ValueError(f"Unknown operation {parts[0]!r}")
+    opcode = OPCODE_NAMES[parts[0]]
+    if len(parts) - 1 not in OPERAND_COUNTS[opcode]:
+        raise ValueError(f"{parts[0]} takes {' or '.join(map(str, OPERAND_COUNTS[opcode]))} operands, "
+                         f"got {len(parts) - 1}")
+    if opcode in BRANCH_OPCODES:
+        # Registers are validated on the decoded form; a pending target decodes like any index
+        statement = f"{statement} {max(target, 0)}"
+    elif opcode in IMMEDIATE_OPCODES and not _immediate.match(parts[3]):
+        raise ValueError(f"Expected an immediate like #10, got {parts[3]!r}")
+    DecodedInstruction(statement)
+
+
+def _directive(statement):
+    # Initial values ("R1 80", "M8 16") set by a directive
+    parts = _operand_separator.split(statement)
+    directive, operands = parts[0], parts[1:]
+    if directive in (".text", ".data"):
+        return []
+    if directive == ".reg":
+        if len(operands) != 2:
+            raise ValueError(".reg takes a register and a value")
+        if operands[0] not in REGISTER_INDEX or operands[0] == "X":
+            raise ValueError(f"Unknown register {operands[0]!r}")
+        return [f"{operands[0]} {_integer(operands[1], 'an integer value')}"]
+    if directive == ".word":
+        if len(operands) < 2:
+            raise ValueError(".word takes an address and at least one value")
+        address = _integer(operands[0], "a byte address")
+        if address < 0 or address % WORD_SIZE:
+            raise ValueError(f"Word address {address} is not a non-negative multiple of {WORD_SIZE}")
+        return [f"M{address + i * WORD_SIZE} {_integer(value, 'an integer value')}"
+                for i, value in enumerate(operands[1:])]
+    raise ValueError(f"Unknown directive {directive!r}")
+
+
+def assemble_file(path, output_path=None):
+    # Assemble a source file into output_path (default: the source path with a .bin extension); returns it
+    if output_path is None:
+        output_path = os.path.splitext(path)[0] + ".bin"
+    with open(path) as source:
+        assemble(source, output_path, path)
+    return output_path
+
+
+def is_binary(path):
+    with open(path, "rb") as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def open_program(path):
+    # AssembledProgram of a binary, or of a source file assembled into a temporary binary
+    if is_binary(path):
+        return AssembledProgram(path)
+    descriptor, binary = tempfile.mkstemp(suffix=".bin")
+    os.close(descriptor)
+    try:
+        assemble_file(path, binary)
+    except BaseException:
+        os.remove(binary)
+        raise
+    return AssembledProgram(binary, temporary=True)
+
+
+class AssembledProgram:
+    """
+    A program binary as a read-only sequence of instruction strings (branch targets resolved to indices),
+    accepted by ReservationStationManager.add_instruction and simulate like a list.
+
+    Attributes:
+    decoded: FetchWindow of the decoded instructions, used by the simulator.
+    initial_values: Initial register and memory values of the .reg and .word directives, e.g. ["R1 80"].
+    """
+
+    def __init__(self, path, temporary=False):
+        self.path = path
+        self.temporary = temporary     # Whether the binary is removed on close
+        self.file = open(path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.index_offset, values_offset = _header.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not an assembled program")
+        if version != VERSION:
+            raise ValueError(f"Unsupported program binary version {version}")
+        values = self.data[values_offset:].decode()
+        self.initial_values = values.split("\n") if values else []
+        self.decoded = FetchWindow(self)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("program index out of range")
+        return self.text(index)
+
+    def __iter__(self):
+        for index in range(self.count):
+            yield self.text(index)
+
+    def text(self, index):
+        # Instruction string of an index in range
+        offset, = _offset.unpack_from(self.data, self.index_offset + index * _offset.size)
+        target, length = _record.unpack_from(self.data, offset)
+        start = offset + _record.size
+        text = self.data[start:start + length].decode()
+        return f"{text} {target}" if target >= 0 else text
+
+    def close(self):
+        if self.data is not None:
+            self.decoded.blocks.clear()
+            self.data.close()
+            self.file.close()
+            self.data = None
+            if self.temporary:
+                os.remove(self.path)
+
+    def __del__(self):
+        if getattr(self, "data", None) is not None:
+            self.close()
+
+    def __reduce__(self):
+        # Worker processes reopen the binary, which stays owned by this object
+        return AssembledProgram, (self.path,)
+
+
+class FetchWindow:
+    # Decoded instructions of an AssembledProgram, decoded FETCH_BLOCK at a time as they are fetched; the
+    # FETCH_BLOCKS most recently used blocks are kept, so loops run from decoded instructions
+
+    def __init__(self, program, block_size=FETCH_BLOCK, blocks=FETCH_BLOCKS):
+        self.program = program
+        self.block_size = block_size
+        self.max_blocks = blocks
+        self.blocks = OrderedDict()    # Block number -> list of DecodedInstruction
+        self.start = 0                 # First index of the block fetched last
+        self.block = []
+
+    def __len__(self):
+        return self.program.count
+
+    def __getitem__(self, index):
+        offset = index - self.start
+        if 0 <= offset < len(self.block):
+            return self.block[offset]
+        return self.fetch(index)
+
+    def fetch(self, index):
+        if index < 0:
+            index += self.program.count
+        if not 0 <= index < self.program.count:
+            raise IndexError("program index out of range")
+        number = index // self.block_size
+        block = self.blocks.get(number)
+        if block is None:
+            start = number * self.block_size
+            block = self.decode(start, min(start + self.block_size, self.program.count))
+            self.blocks[number] = block
+            if len(self.blocks) > self.max_blocks:
+                self.blocks.popitem(last=False)
+        else:
+            self.blocks.move_to_end(number)
+        self.start = number * self.block_size
+        self.block = block
+        return block[index - self.start]
+
+    def decode(self, start, stop):
+        # Entries of the instructions from start to stop; subclasses keep other forms of the instructions
+        return [DecodedInstruction(self.program.text(i)) for i in range(start, stop)]
+
+    def __iter__(self):
+        # Streams through the program a block at a time without filling the window
+        for start in range(0, self.program.count, self.block_size):
+            yield from self.decode(start, min(start + self.block_size, self.program.count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Assemble a program into a binary loaded lazily by the simulator")
+    parser.add_argument("source", help="Assembly source file")
+    parser.add_argument("-o", "--output", help="Binary written (default: the source with a .bin extension)")
+    parser.add_argument("--list", action="store_true", help="Print the assembled instructions and initial values")
+    args = parser.parse_args()
+
+    try:
+        output = assemble_file(args.source, args.output)
+    except AssemblyError as error:
+        parser.exit(1, f"{error}\n")
+    program = AssembledProgram(output)
+    if args.list:
+        for value in program.initial_values:
+            print(f"  init  {value}")
+        for index, text in enumerate(program):
+            print(f"{index:6}  {text}")
+    print(f"{len(program)} instructions assembled into {output}")
+    program.close()
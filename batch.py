@@ -0,0 +1,70 @@
+import argparse
+import glob
+import os
+from multiprocessing import Pool
+
+from assembler import open_program
+from Tomasulo import simulate
+
+
+def load_program(path):
+    # Read a program file, assembly source or assembled binary (see assembler.py). The result is a sequence of
+    # instruction strings that the simulator decodes lazily; its initial_values hold those of the directives.
+    return open_program(path)
+
+
+def _simulate_job(job):
+    # Worker entry point; jobs are tuples of the arguments of simulate
+    return simulate(*job)
+
+
+def run_batch(jobs, processes=None, chunksize=1):
+    """
+    Runs many simulations over a process pool and returns their SimulationResults in input order.
+
+    Args:
+    jobs: Iterable of (program, config, initial_values) tuples, optionally followed by engine, max_cycles, profile
+          and cache_dir (see simulate).
+    processes: Number of worker processes (defaults to the number of CPUs). 1 runs everything in this process.
+    chunksize: Number of jobs handed to a worker at a time.
+    """
+    jobs = [tuple(job) for job in jobs]
+    if processes == 1 or len(jobs) <= 1:
+        return [_simulate_job(job) for job in jobs]
+    with Pool(processes) as pool:
+        return pool.map(_simulate_job, jobs, chunksize)
+
+
+def run_configs(program, configs, initial_values=(), engine="step", max_cycles=None, processes=None, cache_dir=None):
+    # Simulate one program on each machine configuration
+    return run_batch([(program, config, initial_values, engine, max_cycles, False, cache_dir) for config in configs],
+                     processes)
+
+
+def run_directory(directory, config=None, initial_values=(), pattern="*.s", engine="step", max_cycles=None,
+                  processes=None, cache_dir=None):
+    # Simulate every program file in a directory; returns (file name, SimulationResult) pairs sorted by name
+    paths = sorted(glob.glob(os.path.join(directory, pattern)))
+    programs = [load_program(path) for path in paths]
+    jobs = [(program, config, program.initial_values + list(initial_values), engine, max_cycles, False, cache_dir)
+            for program in programs]
+    results = run_batch(jobs, processes)
+    return [(os.path.basename(path), result) for path, result in zip(paths, results)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate every program in a directory")
+    parser.add_argument("directory")
+    parser.add_argument("--pattern", default="*.s", help="Glob pattern of program files (default: *.s)")
+    parser.add_argument("--engine", default="step", choices=["step", "skip", "memo", "compiled"])
+    parser.add_argument("--max-cycles", type=int, default=None)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--init", nargs="*", default=[], help='Initial register values, e.g. "R1 80"')
+    parser.add_argument("--cache-dir", default=".specialize_cache",
+                        help="Where the compiled engine caches generated code")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    for name, result in run_directory(args.directory, None, args.init, args.pattern, args.engine,
+                                      args.max_cycles, args.processes, None if args.no_cache else args.cache_dir):
+        print(f"{name}, {result.cycles}, {result.stats['instructions_issued']}")
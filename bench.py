@@ -0,0 +1,276 @@
+# Throughput benchmarks of the simulator itself, on synthetic kernels that each stress one part of it.
+# A baseline file records the simulated cycles, the throughput and the peak memory of every benchmark;
+# comparing against it fails when a benchmark simulates different cycles, gets slower or uses more memory
+# than the tolerance allows. Throughput depends on the machine and Python version, so a baseline is only
+# meaningful where it was recorded. Every result records the engine that actually ran it: the "compiled" engine
+# falls back to "skip" for kernels longer than specialize.MAX_INSTRUCTIONS.
+
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import specialize
+from Tomasulo import make_config, make_manager, run_simulation
+
+BASELINE_FILE = "bench_baseline.json"
+
+# Allowed relative loss of throughput, and growth of peak memory, before a comparison fails
+TOLERANCE = 0.2
+MEMORY_TOLERANCE = 0.25
+
+# Stations of the large configuration, per type
+LARGE_STATION_COUNTS = {"ADD": 32, "MUL": 32, "DIV": 16, "STORE": 32, "BRANCH": 4}
+
+# Registers written by the kernels (R20-R23 hold their constant inputs)
+_registers = [f"R{i}" for i in range(1, 20)]
+_wide_registers = _registers + [f"R{i}" for i in range(24, 32)] + [f"I{i}" for i in range(0, 101)]
+
+
+def raw_chain(length):
+    # Every instruction reads the result of the one before it
+    return [f"DADDI {_registers[(i + 1) % 8]}, {_registers[i % 8]}, #1" for i in range(length)]
+
+
+def independent_flood(length, registers=_registers):
+    # Independent operations of every station type, writing distinct registers in turn
+    operations = ["ADD {}, R20, R21", "MUL {}, R21, R22", "SUB {}, R22, R20", "DADDI {}, R23, #7"]
+    return [operations[i % len(operations)].format(registers[i % len(registers)]) for i in range(length)]
+
+
+def div_bound(length):
+    # Divisions, bound by the latency of the single divider
+    return [f"DIVI {_registers[i % 8]}, R20, #3" if i % 2 == 0 else f"DIV {_registers[i % 8]}, R21, R22"
+            for i in range(length)]
+
+
+def tight_loop(trips):
+    # A three-instruction loop body ending in a BNEQZ taken `trips` - 1 times
+    return [f"DADDI R9, X, #{trips}", "DADDI R1, R1, #1", "DSUBI R9, R9, #1", "BNEQZ R9, 1"]
+
+
+class Benchmark:
+    def __init__(self, name, program, config=None, initial_values=()):
+        self.name = name
+        self.program = program
+        self.config = config                       # Overrides of DEFAULT_CONFIG, as for simulate
+        self.initial_values = list(initial_values)
+
+
+def benchmarks(scale=1.0):
+    # The benchmark suite; `scale` multiplies the length of every kernel
+    def size(count):
+        return max(1, int(count * scale))
+
+    inputs = ["R20 1000", "R21 7", "R22 3", "R23 11"]
+    large = {"station_counts": LARGE_STATION_COUNTS,
+             "pipeline": {"issue_width": 4, "cdb_width": 4, "arbitration": "oldest"}}
+    return [
+        Benchmark("raw_chain", raw_chain(size(20000)), None, inputs),
+        Benchmark("independent_flood", independent_flood(size(40000)), None, inputs),
+        Benchmark("div_bound", div_bound(size(2000)), None, inputs),
+        Benchmark("tight_loop", tight_loop(size(20000)), None, inputs),
+        Benchmark("large_stations", independent_flood(size(40000), _wide_registers), large, inputs),
+    ]
+
+
+def engine_used(benchmark, engine):
+    # Engine that actually simulates a benchmark when `engine` is requested
+    if engine != "compiled":
+        return engine
+    rs_manager = make_manager(make_config(benchmark.config), benchmark.initial_values)
+    rs_manager.add_instruction(benchmark.program)
+    try:
+        return "compiled" if specialize.can_specialize(rs_manager) else "skip"
+    finally:
+        rs_manager.memory.close()
+
+
+def run_benchmark(benchmark, engine="step", max_cycles=None, cache_dir=None):
+    # Simulate a benchmark once; returns (cycles, instructions issued, seconds). cache_dir is the compiled
+    # engine's code cache (see run_simulation).
+    rs_manager = make_manager(make_config(benchmark.config), benchmark.initial_values)
+    rs_manager.add_instruction(benchmark.program)
+    length = len(rs_manager.program)
+    gc.collect()
+    start = time.perf_counter()
+    if engine == "step":
+        # ReservationStationManager.execute_cycle on its own, as run_simulation steps it
+        execute_cycle = rs_manager.execute_cycle
+        cycles = 0
+        while True:
+            cycles += 1
+            if execute_cycle() and rs_manager.instruction_queue_index == length:
+                break
+            if max_cycles is not None and cycles >= max_cycles:
+                raise RuntimeError(f"Benchmark {benchmark.name} did not finish within {max_cycles} cycles")
+    else:
+        cycles = run_simulation(rs_manager, engine=engine, trace=False, max_cycles=max_cycles, cache_dir=cache_dir)
+    seconds = time.perf_counter() - start
+    rs_manager.memory.close()
+    return cycles, rs_manager.issued_instructions, seconds
+
+
+def peak_memory(benchmark, engine="step", max_cycles=None, cache_dir=None):
+    # Peak bytes allocated while building and running a benchmark (a separate run: tracing slows it down)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        run_benchmark(benchmark, engine, max_cycles, cache_dir)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def measure(benchmark, engine="step", repeat=3, memory=True, max_cycles=None):
+    """
+    Runs a benchmark and returns its measurements as a dictionary: simulated cycles and instructions,
+    the best of `repeat` wall-clock times, cycles and instructions per second, the peak memory, and the engine
+    that ran it.
+
+    Args:
+    benchmark: The Benchmark to run.
+    engine: "step" times execute_cycle alone; "skip", "memo" and "compiled" time run_simulation.
+    repeat: Number of timed runs; the fastest one counts.
+    memory: Whether to measure the peak memory with tracemalloc, in one more run.
+    max_cycles: Raise RuntimeError if a run has not finished after this many cycles.
+    """
+    with tempfile.TemporaryDirectory() as cache_dir:
+        if engine == "compiled":
+            # Generating and verifying the specialized code happens once, then it is read from its cache
+            run_benchmark(benchmark, engine, max_cycles, cache_dir)
+        best = None
+        for _ in range(repeat):
+            cycles, instructions, seconds = run_benchmark(benchmark, engine, max_cycles, cache_dir)
+            if best is None or seconds < best:
+                best = seconds
+        return {
+            "cycles": cycles,
+            "instructions": instructions,
+            "seconds": best,
+            "cycles_per_second": cycles / best,
+            "instructions_per_second": instructions / best,
+            "peak_memory": peak_memory(benchmark, engine, max_cycles, cache_dir) if memory else None,
+            "engine": engine_used(benchmark, engine),
+        }
+
+
+def run_suite(names=None, engine="step", repeat=3, scale=1.0, memory=True, max_cycles=None):
+    # Measure every benchmark of the suite (or those named); returns {name: measurements}
+    suite = benchmarks(scale)
+    if names:
+        unknown = set(names) - {benchmark.name for benchmark in suite}
+        if unknown:
+            raise ValueError(f"Unknown benchmarks: {', '.join(sorted(unknown))}")
+        suite = [benchmark for benchmark in suite if benchmark.name in names]
+    return {benchmark.name: measure(benchmark, engine, repeat, memory, max_cycles) for benchmark in suite}
+
+
+def make_baseline(results, engine, scale):
+    return {"engine": engine, "scale": scale, "python": platform.python_version(), "machine": platform.machine(),
+            "benchmarks": results}
+
+
+def compare(results, baseline, tolerance=TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    # Regressions of results against a baseline, as messages (empty if there are none)
+    failures = []
+    for name, result in results.items():
+        expected = baseline["benchmarks"].get(name)
+        if expected is None:
+            continue
+        # Baselines recorded before results named their engine only name the requested one
+        expected_engine = expected.get("engine", baseline["engine"])
+        if result["engine"] != expected_engine:
+            failures.append(f"{name}: ran on the {result['engine']} engine, baseline on the {expected_engine} engine")
+            continue
+        if result["cycles"] != expected["cycles"]:
+            failures.append(f"{name}: simulates {result['cycles']} cycles, baseline {expected['cycles']} "
+                            f"(the kernel or the timing model changed; record a new baseline)")
+            continue
+        for key in ("cycles_per_second", "instructions_per_second"):
+            if result[key] < expected[key] * (1 - tolerance):
+                failures.append(f"{name}: {key} {result[key]:,.0f} is {100 * (1 - result[key] / expected[key]):.1f}% "
+                                f"below the baseline {expected[key]:,.0f}")
+        if (result["peak_memory"] is not None and expected.get("peak_memory") is not None
+                and result["peak_memory"] > expected["peak_memory"] * (1 + memory_tolerance)):
+            failures.append(f"{name}: peak memory {result['peak_memory']:,} bytes is "
+                            f"{100 * (result['peak_memory'] / expected['peak_memory'] - 1):.1f}% above the baseline "
+                            f"{expected['peak_memory']:,}")
+    return failures
+
+
+def format_results(results, baseline=None):
+    # Table of the results, with the change from the baseline throughput when there is one
+    lines = [f"{'benchmark':<20}{'cycles':>10}{'instructions':>14}{'cycles/s':>12}{'instr/s':>12}{'peak MB':>10}"
+             f"{'engine':>10}" + ("  vs baseline" if baseline else "")]
+    for name, result in results.items():
+        peak = f"{result['peak_memory'] / 2 ** 20:.1f}" if result["peak_memory"] is not None else "-"
+        line = (f"{name:<20}{result['cycles']:>10}{result['instructions']:>14}{result['cycles_per_second']:>12,.0f}"
+                f"{result['instructions_per_second']:>12,.0f}{peak:>10}{result['engine']:>10}")
+        expected = baseline["benchmarks"].get(name) if baseline else None
+        if expected is not None:
+            line += f"  {100 * (result['cycles_per_second'] / expected['cycles_per_second'] - 1):+.1f}%"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the simulator's throughput against a stored baseline")
+    parser.add_argument("names", nargs="*", help="Benchmarks to run (default: all)")
+    parser.add_argument("--engine", default="step", choices=["step", "skip", "memo", "compiled"])
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per benchmark; the fastest counts")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiplies the length of every kernel")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help=f"Baseline file (default: {BASELINE_FILE})")
+    parser.add_argument("--save", action="store_true", help="Record the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="Allowed throughput loss, e.g. 0.2")
+    parser.add_argument("--memory-tolerance", type=float, default=MEMORY_TOLERANCE,
+                        help="Allowed peak memory growth, e.g. 0.25")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory measurement")
+    parser.add_argument("--list", action="store_true", help="List the benchmarks and exit")
+    args = parser.parse_args()
+
+    if args.list:
+        for benchmark in benchmarks(args.scale):
+            stations = sum(make_config(benchmark.config)["station_counts"].values())
+            print(f"{benchmark.name:<20}{len(benchmark.program):>8} instructions{stations:>6} stations")
+        raise SystemExit(0)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.save:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if (baseline["engine"], baseline["scale"]) != (args.engine, args.scale):
+            parser.exit(2, f"Baseline {args.baseline} was recorded with --engine {baseline['engine']} "
+                           f"--scale {baseline['scale']}\n")
+    results = run_suite(args.names, args.engine, args.repeat, args.scale, not args.no_memory)
+    print(format_results(results, baseline))
+    for name, result in results.items():
+        if result["engine"] != args.engine:
+            print(f"WARNING {name}: the {args.engine} engine fell back to {result['engine']} (programs over "
+                  f"specialize.MAX_INSTRUCTIONS = {specialize.MAX_INSTRUCTIONS} instructions are not specialized)",
+                  file=sys.stderr)
+
+    if args.save:
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as file:
+                previous = json.load(file)
+            # Benchmarks not run this time keep their recorded results
+            if (previous["engine"], previous["scale"]) == (args.engine, args.scale):
+                results = dict(previous["benchmarks"], **results)
+        with open(args.baseline, "w") as file:
+            json.dump(make_baseline(results, args.engine, args.scale), file, indent=1)
+        print(f"Baseline written to {args.baseline}")
+    elif baseline is None:
+        print(f"No baseline at {args.baseline}; record one with --save")
+    else:
+        failures = compare(results, baseline, args.tolerance, args.memory_tolerance)
+        for failure in failures:
+            print(f"REGRESSION {failure}", file=sys.stderr)
+        if failures:
+            raise SystemExit(1)
+        print(f"No regression against {args.baseline}")
@@ -0,0 +1,288 @@
+import argparse
+import bisect
+import builtins
+import hashlib
+import io
+import os
+import pickle
+import struct
+import weakref
+import zlib
+
+from events import CycleEndEvent
+from Tomasulo import Instruction, Opcode
+
+# Checkpoint layout: MAGIC, version (u16), then a zlib-compressed pickle of plain values (numbers, strings,
+# tuples, lists, bytes) describing the dynamic state of a ReservationStationManager. Stations and reorder
+# buffer entries refer to each other by tag and instructions by program index, so the program and the
+# machine configuration are not stored: a checkpoint is restored into a manager built like the original.
+# Checkpoints are read by an unpickler that only builds those values (and the built-in exceptions a speculative
+# instruction may hold), so a crafted file cannot make restore_checkpoint run code.
+MAGIC = b"TOMCKPT\0"
+VERSION = 1
+
+_header = struct.Struct("<8sH")
+
+# Exceptions a checkpoint may hold: errors of speculatively executed instructions, re-raised at commit
+LOADABLE_ERRORS = (ArithmeticError, IndexError, ValueError)
+
+# Manager -> (instruction queue, digest) of the program digests computed so far
+_digests = weakref.WeakKeyDictionary()
+
+
+class _StateUnpickler(pickle.Unpickler):
+    # Refuses every global but the built-in exception types of LOADABLE_ERRORS
+    def find_class(self, module, name):
+        if module == "builtins":
+            value = getattr(builtins, name, None)
+            if isinstance(value, type) and issubclass(value, LOADABLE_ERRORS):
+                return value
+        raise pickle.UnpicklingError(f"Checkpoint refers to {module}.{name}, which is not a plain value")
+
+
+def program_digest(rs_manager):
+    # Identifies the program a checkpoint belongs to; computed once per manager and program, from the instruction
+    # texts, so an assembled program is not decoded for it
+    cached = _digests.get(rs_manager)
+    if cached is not None and cached[0] is rs_manager.instruction_queue:
+        return cached[1]
+    digest = hashlib.sha1()
+    for index, text in enumerate(rs_manager.instruction_queue):
+        # Same digest as hashing the decoded texts (commas removed) joined by newlines, without building the
+        # joined string
+        text = text.replace(",", "")
+        digest.update(f"\n{text}".encode() if index else text.encode())
+    _digests[rs_manager] = (rs_manager.instruction_queue, digest.hexdigest())
+    return _digests[rs_manager][1]
+
+
+def _tag(station):
+    return station.tag if station is not None else -1
+
+
+def save_checkpoint(rs_manager):
+    # Encode the state of rs_manager at the end of its current cycle as bytes
+    stations = []
+    for station in rs_manager.station_list:
+        instruction = station.instruction
+        if instruction is not None:
+            instruction = (instruction.index, instruction.Vj, instruction.Vk, instruction.Qj, instruction.Qk,
+                           instruction.A)
+        stations.append((station.busy, station.stage, station.remaining_cycles, station.busy_cycles,
+                         station.issue_cycle, station.sequence, station.rob_entry.tag if station.rob_entry else -1,
+                         [(consumer.tag, slot) for consumer, slot in station.consumers], instruction))
+    rob = None
+    if rs_manager.rob is not None:
+        entries = [(entry.sequence, int(entry.opcode) if entry.opcode is not None else None, entry.pc,
+                    entry.dest_index, _tag(entry.station), entry.value, entry.address, entry.done, entry.error,
+                    entry.predicted_taken, entry.taken)
+                   for entry in rs_manager.rob.entries]
+        rob = (rs_manager.rob.size, rs_manager.rob.head, rs_manager.rob.count, entries)
+    memory = rs_manager.memory
+    state = {
+        "program": program_digest(rs_manager),
+        "station_names": [station.name for station in rs_manager.station_list],
+        "counters": (rs_manager.cycle, rs_manager.instruction_queue_index, rs_manager.issued_instructions,
+                     rs_manager.issue_stall_cycles, rs_manager.branches, rs_manager.branches_taken,
+                     rs_manager.mispredictions, rs_manager.squashed_instructions, rs_manager.cdb_stall_cycles,
+                     rs_manager.last_granted),
+        "branching_station": _tag(rs_manager.branching_station),
+        "registers": (list(rs_manager.register_values), list(rs_manager.register_producers)),
+        "memory": (bytes(memory.data), bytes(memory.tags)),
+        "ready": [station.tag for station in rs_manager.ready_stations],
+        "write_stage": [station.tag for station in rs_manager.write_stage_stations],
+        "stations": stations,
+        "rob": rob,
+        "predictor": dict(vars(rs_manager.predictor)),
+    }
+    return _header.pack(MAGIC, VERSION) + zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL), 1)
+
+
+def restore_checkpoint(rs_manager, data):
+    # Put rs_manager back in the state encoded by save_checkpoint. It must run the same program on a machine
+    # with the same stations, memory size and reorder buffer; event subscribers stay attached.
+    # Raises pickle.UnpicklingError if data holds anything but the plain values save_checkpoint writes.
+    magic, version = _header.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not a simulator checkpoint")
+    if version != VERSION:
+        raise ValueError(f"Unsupported checkpoint version {version}")
+    state = _StateUnpickler(io.BytesIO(zlib.decompress(memoryview(data)[_header.size:]))).load()
+    if state["program"] != program_digest(rs_manager):
+        raise ValueError("Checkpoint was taken with a different program")
+    if state["station_names"] != [station.name for station in rs_manager.station_list]:
+        raise ValueError("Checkpoint was taken with different reservation stations")
+    memory = rs_manager.memory
+    data_bytes, tags = state["memory"]
+    if len(data_bytes) != memory.size:
+        raise ValueError(f"Checkpoint memory size {len(data_bytes)} does not match {memory.size}")
+    rob = state["rob"]
+    if (rob is None) != (rs_manager.rob is None) or (rob is not None and rob[0] != rs_manager.rob.size):
+        raise ValueError("Checkpoint was taken with a different reorder buffer")
+
+    (rs_manager.cycle, rs_manager.instruction_queue_index, rs_manager.issued_instructions,
+     rs_manager.issue_stall_cycles, rs_manager.branches, rs_manager.branches_taken, rs_manager.mispredictions,
+     rs_manager.squashed_instructions, rs_manager.cdb_stall_cycles, rs_manager.last_granted) = state["counters"]
+    values, producers = state["registers"]
+    rs_manager.register_values[:] = values
+    rs_manager.register_producers[:] = producers
+    memory.data[:] = data_bytes
+    memory.tags[:] = tags
+    vars(rs_manager.predictor).update(state["predictor"])
+
+    station_list = rs_manager.station_list
+    program = rs_manager.program
+    for station, saved in zip(station_list, state["stations"]):
+        (station.busy, station.stage, station.remaining_cycles, station.busy_cycles, station.issue_cycle,
+         station.sequence, rob_tag, consumers, instruction) = saved
+        station.consumers = [(station_list[tag], slot) for tag, slot in consumers]
+        station.rob_entry = rs_manager.rob.entries[rob_tag] if rob_tag >= 0 else None
+        if instruction is None:
+            station.instruction = None
+        else:
+            index, Vj, Vk, Qj, Qk, A = instruction
+            restored = Instruction.from_decoded(program[index - 1])
+            restored.index = index
+            restored.Vj, restored.Vk, restored.Qj, restored.Qk, restored.A = Vj, Vk, Qj, Qk, A
+            station.instruction = restored
+    tag = state["branching_station"]
+    rs_manager.branching_station = station_list[tag] if tag >= 0 else None
+    rs_manager.ready_stations = [station_list[tag] for tag in state["ready"]]
+    rs_manager.write_stage_stations = [station_list[tag] for tag in state["write_stage"]]
+
+    if rob is not None:
+        _, rs_manager.rob.head, rs_manager.rob.count, entries = rob
+        for entry, saved in zip(rs_manager.rob.entries, entries):
+            (entry.sequence, opcode, entry.pc, entry.dest_index, station_tag, entry.value, entry.address, entry.done,
+             entry.error, entry.predicted_taken, entry.taken) = saved
+            entry.opcode = Opcode(opcode) if opcode is not None else None
+            entry.station = station_list[station_tag] if station_tag >= 0 else None
+
+
+def write_checkpoint(path, rs_manager):
+    with open(path, "wb") as file:
+        file.write(save_checkpoint(rs_manager))
+
+
+def read_checkpoint(path, rs_manager):
+    with open(path, "rb") as file:
+        restore_checkpoint(rs_manager, file.read())
+
+
+def run_to_cycle(rs_manager, cycle):
+    # Advance rs_manager to the end of `cycle`, or until its program finishes; returns the cycle reached
+    while rs_manager.cycle < cycle and not rs_manager.finished():
+        quiet = rs_manager.quiet_cycles()
+        if quiet:
+            rs_manager.skip_cycles(min(quiet, cycle - rs_manager.cycle))
+            continue
+        all_idle = rs_manager.execute_cycle()
+        if all_idle and rs_manager.instruction_queue_index == len(rs_manager.program):
+            break
+    return rs_manager.cycle
+
+
+class AutoCheckpointer:
+    """
+    Checkpoints a manager every `interval` cycles while it runs, so that seek() can go back (or forward,
+    within what was simulated) to any cycle by restoring the nearest earlier checkpoint and simulating
+    at most `interval` cycles.
+
+    Checkpoints are kept in memory, or as files in `directory` if one is given; `keep` bounds how many
+    are kept (the oldest are dropped first).
+    """
+
+    def __init__(self, rs_manager, interval=10000, directory=None, keep=None):
+        if interval < 1:
+            raise ValueError(f"Checkpoint interval must be positive, got {interval}")
+        self.rs_manager = rs_manager
+        self.interval = interval
+        self.directory = directory
+        self.keep = keep
+        self.cycles = []               # Cycles of the checkpoints, in increasing order
+        self.checkpoints = {}          # Cycle -> checkpoint bytes, when kept in memory
+        self.next_cycle = rs_manager.cycle
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        rs_manager.subscribe(self.cycle_ended, CycleEndEvent)
+        self.take()                    # The starting state
+
+    def detach(self):
+        self.rs_manager.unsubscribe(self.cycle_ended)
+
+    def cycle_ended(self, event):
+        if event.cycle >= self.next_cycle:
+            self.take()
+
+    def path(self, cycle):
+        return os.path.join(self.directory, f"cycle_{cycle:012d}.ckpt")
+
+    def take(self):
+        # Checkpoint the current state now
+        cycle = self.rs_manager.cycle
+        if not self.cycles or self.cycles[-1] < cycle:
+            data = save_checkpoint(self.rs_manager)
+            if self.directory is not None:
+                with open(self.path(cycle), "wb") as file:
+                    file.write(data)
+            else:
+                self.checkpoints[cycle] = data
+            self.cycles.append(cycle)
+            if self.keep is not None and len(self.cycles) > self.keep:
+                self.drop(self.cycles.pop(0))
+        self.next_cycle = cycle - cycle % self.interval + self.interval
+
+    def drop(self, cycle):
+        if self.directory is not None:
+            os.remove(self.path(cycle))
+        else:
+            del self.checkpoints[cycle]
+
+    def load(self, cycle):
+        if self.directory is None:
+            return self.checkpoints[cycle]
+        with open(self.path(cycle), "rb") as file:
+            return file.read()
+
+    def seek(self, cycle):
+        # Bring the manager to the end of `cycle`; returns the cycle reached (earlier if the program ended).
+        # Later checkpoints stay valid: the simulation is deterministic.
+        position = bisect.bisect_right(self.cycles, cycle) - 1
+        if position < 0:
+            raise ValueError(f"No checkpoint at or before cycle {cycle}")
+        rs_manager = self.rs_manager
+        # Simulating forward from the current state is cheaper when it is already between the two
+        if not self.cycles[position] <= rs_manager.cycle <= cycle:
+            restore_checkpoint(rs_manager, self.load(self.cycles[position]))
+        return run_to_cycle(rs_manager, cycle)
+
+
+if __name__ == "__main__":
+    import json
+
+    from Tomasulo import make_config, make_manager, run_simulation
+    from batch import load_program
+
+    parser = argparse.ArgumentParser(description="Run a program, saving checkpoints, or resume it from one")
+    parser.add_argument("program", help="Program file, assembly source or assembled binary")
+    parser.add_argument("--init", nargs="*", default=[], help='Initial register values, e.g. "R1 80"')
+    parser.add_argument("--config", help="JSON file overriding parts of DEFAULT_CONFIG")
+    parser.add_argument("--directory", default="checkpoints", help="Where checkpoints are written")
+    parser.add_argument("--interval", type=int, default=100000, help="Cycles between checkpoints")
+    parser.add_argument("--resume", help="Checkpoint file to resume from (loaded as plain values only: a file "
+                                         "holding anything else is refused, never executed)")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+    program = load_program(args.program)
+    rs_manager = make_manager(make_config(config), program.initial_values + args.init)
+    rs_manager.add_instruction(program)
+    if args.resume:
+        read_checkpoint(args.resume, rs_manager)
+        print(f"Resuming at cycle {rs_manager.cycle}")
+    AutoCheckpointer(rs_manager, args.interval, args.directory)
+    cycles = run_simulation(rs_manager, engine="skip", trace=False)
+    print(f"Finished after {cycles} cycles")
@@ -0,0 +1,397 @@
+import bisect
+import json
+import mmap
+import os
+import re
+import socket
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+
+from simserver import encode_message, parse_address
+from tracefile import MAGIC, TraceReader, cycle_log_data
+
+# Decoded cycles kept in memory, and how many neighbours of a requested cycle are decoded with it
+CACHE_SIZE = 64
+NEIGHBOURS = 4
+# Latest cycles kept from a live simulation
+HISTORY_SIZE = 2000
+
+# Sidecar index of a text log (<log>.idx)
+#   INDEX_MAGIC, version (u16), source size (u64), source mtime in ns (u64), cycle count (u64),
+#   JSON length (u32), JSON with the used registers, padding to 8 bytes,
+#   u64 byte offset of every "Cycle N:" line, then u64 cycle number of every entry
+INDEX_MAGIC = b"TOMLOGIX"
+INDEX_VERSION = 1
+_index_header = struct.Struct("<8sHQQQI")
+
+_quoted = re.compile(r"""'((?:[^'\\]|\\.)*)'|"((?:[^"\\]|\\.)*)\"""")
+_escape = re.compile(r"\\(.)")
+
+
+def parse_string_list(text):
+    # Parse a printed list of strings such as "['ADD_1, Idle, 0', 'R1, 80']"
+    text = text.strip()
+    if not (text.startswith("[") and text.endswith("]")):
+        raise ValueError(f"Expected a list of strings, got {text[:40]!r}")
+    items = []
+    for single, double in _quoted.findall(text):
+        item = single or double
+        if "\\" in item:
+            item = _escape.sub(r"\1", item)
+        items.append(item)
+    return items
+
+
+def station_registers(station):
+    # Registers named by the src1/src2/dest fields of a busy station line
+    parts = station.split(", ")
+    if len(parts) < 7 or parts[1] == "Idle":
+        return []
+    return parts[4:7]
+
+
+def split_used_registers(names):
+    # (integer registers, memory registers) among register names
+    names = set(names)
+    return {name for name in names if name.startswith('R')}, {name for name in names if name.startswith('M')}
+
+
+def event_signature(data):
+    # What a cycle shows apart from execution counters counting down
+    stations = []
+    for station in data["reservation_stations"]:
+        parts = station.split(", ")
+        counter = 2 if len(parts) > 1 and parts[1] == "Idle" else 3
+        stations.append(tuple(parts[:counter] + parts[counter + 1:]))
+    return stations, data["register_values"]
+
+
+def program_registers(program):
+    # (integer registers, memory registers) named by the instructions of a program
+    # Imported here so the GUI can show text logs without importing the simulator
+    from Tomasulo import decode_program, used_register_names
+    return split_used_registers(used_register_names(decode_program(program)))
+
+
+class CycleLog:
+    # Common interface of the logs shown by the GUI: cycles are looked up by number and decoded on demand
+    def __init__(self):
+        self.cache = OrderedDict()
+
+    def next_event(self, cycle):
+        # First later cycle in which a station changes stage or operands, or a register changes; None if none
+        current = event_signature(self[cycle])
+        for later in range(cycle + 1, self.last_cycle + 1):
+            if later in self and event_signature(self[later]) != current:
+                return later
+        return None
+
+    def __contains__(self, cycle):
+        return self.first_cycle <= cycle <= self.last_cycle and self.has_cycle(cycle)
+
+    def has_cycle(self, cycle):
+        return True
+
+    def __len__(self):
+        return self.last_cycle - self.first_cycle + 1
+
+    def __getitem__(self, cycle):
+        # {"reservation_stations": [...], "register_values": [...]} of a cycle, as in log.txt
+        if cycle in self.cache:
+            self.cache.move_to_end(cycle)
+            return self.cache[cycle]
+        if cycle not in self:
+            raise KeyError(cycle)
+        self.load(cycle)
+        return self.cache[cycle]
+
+    def remember(self, cycle, data):
+        self.cache[cycle] = data
+        self.cache.move_to_end(cycle)
+        while len(self.cache) > CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+
+class TextCycleLog(CycleLog):
+    """
+    A log.txt file, memory-mapped, with a sidecar index of the byte offset of every cycle.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+        self.file = open(path, "rb")
+        # An empty log (from an aborted run or a program without cycles) cannot be mapped; it has no cycles
+        if os.fstat(self.file.fileno()).st_size:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.buffer = b""
+        if not self.load_index():
+            self.build_index()
+            self.load_index()
+
+    def load_index(self):
+        # Map the sidecar index; False if it is missing or older than the log
+        index_path = self.path + ".idx"
+        if not os.path.exists(index_path):
+            return False
+        stat = os.stat(self.path)
+        index_file = open(index_path, "rb")
+        index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, size, mtime, count, json_length = _index_header.unpack_from(index, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION or size != stat.st_size or mtime != stat.st_mtime_ns:
+            index.close()
+            index_file.close()
+            return False
+        start = _index_header.size
+        used = json.loads(index[start:start + json_length])
+        self.integer_registers_used, self.mem_registers_used = split_used_registers(used)
+        start += json_length
+        start += -start % 8
+        self.index_file, self.index = index_file, index
+        view = memoryview(index)
+        self.offsets = view[start:start + 8 * count].cast("Q")
+        self.cycles = view[start + 8 * count:start + 16 * count].cast("Q")
+        self.first_cycle = self.cycles[0] if count else 0
+        self.last_cycle = self.cycles[count - 1] if count else -1
+        return True
+
+    def build_index(self):
+        # One pass over the log: offset of every cycle and the registers named by busy stations
+        buffer = self.buffer
+        offsets = array("Q")
+        cycles = array("Q")
+        used = set()
+        seen_lines = set()
+        position = 0 if buffer[:6] == b"Cycle " else buffer.find(b"\nCycle ")
+        if position > 0:
+            position += 1
+        while position >= 0:
+            end = buffer.find(b"\n", position)
+            if end < 0:
+                end = len(buffer)
+            offsets.append(position)
+            cycles.append(int(buffer[position + 6:end].rstrip(b":\r")))
+            next_position = buffer.find(b"\nCycle ", end)
+            stations_start = buffer.find(b"reservation_stations: ", end, next_position if next_position >= 0 else len(buffer))
+            if stations_start >= 0:
+                stations_end = buffer.find(b"\n", stations_start)
+                line = buffer[stations_start + 22:stations_end if stations_end >= 0 else len(buffer)]
+                # Consecutive cycles mostly repeat the same stations, so each line is only parsed once
+                if line not in seen_lines:
+                    seen_lines.add(line)
+                    for station in parse_string_list(line.decode()):
+                        used.update(station_registers(station))
+            position = next_position + 1 if next_position >= 0 else -1
+
+        stat = os.stat(self.path)
+        used_json = json.dumps(sorted(used)).encode()
+        header = _index_header.pack(INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns, len(offsets), len(used_json))
+        padding = b"\0" * (-(len(header) + len(used_json)) % 8)
+        with open(self.path + ".idx", "wb") as file:
+            file.write(header + used_json + padding)
+            file.write(offsets.tobytes())
+            file.write(cycles.tobytes())
+
+    def has_cycle(self, cycle):
+        position = bisect.bisect_left(self.cycles, cycle)
+        return position < len(self.cycles) and self.cycles[position] == cycle
+
+    def load(self, cycle):
+        # Decode the requested cycle and its neighbours
+        position = bisect.bisect_left(self.cycles, cycle)
+        for i in range(max(0, position - NEIGHBOURS), min(len(self.cycles), position + NEIGHBOURS + 1)):
+            if self.cycles[i] not in self.cache:
+                self.remember(self.cycles[i], self.decode(i))
+        self.cache.move_to_end(cycle)
+
+    def decode(self, i):
+        start = self.offsets[i]
+        end = self.offsets[i + 1] if i + 1 < len(self.offsets) else len(self.buffer)
+        data = {"reservation_stations": [], "register_values": []}
+        for line in self.buffer[start:end].decode().splitlines():
+            key, _, value = line.partition(": ")
+            if key in data:
+                data[key] = parse_string_list(value)
+        return data
+
+    def close(self):
+        for name in ("offsets", "cycles"):
+            if hasattr(self, name):
+                getattr(self, name).release()
+        if hasattr(self, "index"):
+            self.index.close()
+            self.index_file.close()
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+
+class TraceCycleLog(CycleLog):
+    """
+    A binary trace (see tracefile), decoded from the nearest keyframe; used registers come from its program.
+    """
+
+    def __init__(self, path):
+        super().__init__()
+        self.reader = TraceReader(path)
+        self.first_cycle = self.reader.first_cycle if self.reader.first_cycle is not None else 0
+        self.last_cycle = self.reader.last_cycle if self.reader.last_cycle is not None else -1
+        if self.reader.used_registers is not None:
+            self.integer_registers_used, self.mem_registers_used = split_used_registers(self.reader.used_registers)
+        else:
+            self.integer_registers_used, self.mem_registers_used = program_registers(self.reader.program)
+
+    def load(self, cycle):
+        # Decode forward from the keyframe, keeping the requested cycle and its neighbours
+        reader = self.reader
+        position = bisect.bisect_right(reader.keyframe_cycles, cycle - NEIGHBOURS) - 1
+        if position < 0:
+            position = 0
+        registers = [None] * len(reader.register_names)
+        stations = [None] * len(reader.station_names)
+        for kind, record_cycle, start, end in reader.scan(reader.index[position][1], registers, stations):
+            if record_cycle > cycle + NEIGHBOURS:
+                break
+            if record_cycle >= cycle - NEIGHBOURS and record_cycle not in self.cache:
+                self.remember(record_cycle, cycle_log_data(reader, stations, registers))
+        self.cache.move_to_end(cycle)
+
+    def next_event(self, cycle):
+        # Same as CycleLog.next_event, in a single pass over the binary records
+        reader = self.reader
+        position = bisect.bisect_right(reader.keyframe_cycles, cycle) - 1
+        if position < 0:
+            raise KeyError(cycle)
+        registers = [None] * len(reader.register_names)
+        stations = [None] * len(reader.station_names)
+        current = None
+        for kind, record_cycle, start, end in reader.scan(reader.index[position][1], registers, stations):
+            if record_cycle < cycle:
+                continue
+            # Field 2 is the execution counter
+            signature = ([fields[:2] + fields[3:] for fields in stations], list(registers))
+            if current is None:
+                current = signature
+            elif signature != current:
+                return record_cycle
+        return None
+
+    def close(self):
+        self.reader.close()
+
+
+class LiveCycleLog(CycleLog):
+    """
+    The cycles streamed by a simulation server (see simserver), received on a background thread.
+    Only the latest HISTORY_SIZE cycles are kept; send() controls the simulation.
+    """
+
+    def __init__(self, address):
+        super().__init__()
+        kind, *where = parse_address(address)
+        if kind == "tcp":
+            self.socket = socket.create_connection(tuple(where))
+        else:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(where[0])
+        self.file = self.socket.makefile("rb")
+        self.lock = threading.Lock()
+        self.history = OrderedDict()   # Cycle -> log data, oldest first
+        self.status = {}               # Latest status message of the server
+        self.error = None              # Latest error reported by the server
+        self.connected = True
+        hello = self.receive()
+        if hello.get("type") != "hello":
+            raise ValueError(f"{address} is not a simulation server")
+        self.station_names = hello["stations"]
+        self.register_names = hello["registers"]
+        self.integer_registers_used, self.mem_registers_used = split_used_registers(hello["used_registers"])
+        self.stations = []
+        self.registers = []
+        # The server starts every client with a keyframe, so there is a cycle to show once it arrives
+        while not self.history:
+            self.handle(self.receive())
+        self.thread = threading.Thread(target=self.listen, daemon=True)
+        self.thread.start()
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError("The simulation server closed the connection")
+        return json.loads(line)
+
+    def handle(self, message):
+        kind = message["type"]
+        if kind == "keyframe":
+            self.stations = message["stations"]
+            self.registers = message["registers"]
+        elif kind == "delta":
+            for i, value in message["registers"]:
+                self.registers[i] = value
+            for i, changes in message["stations"]:
+                fields = list(self.stations[i])
+                for bit, value in changes:
+                    fields[bit] = value
+                self.stations[i] = fields
+        elif kind == "status":
+            self.status = message
+            return
+        elif kind == "error":
+            self.error = message["message"]
+            return
+        else:
+            return
+        data = cycle_log_data(self, self.stations, self.registers)
+        with self.lock:
+            self.history[message["cycle"]] = data
+            self.history.move_to_end(message["cycle"])
+            while len(self.history) > HISTORY_SIZE:
+                self.history.popitem(last=False)
+
+    def listen(self):
+        try:
+            while True:
+                self.handle(self.receive())
+        except Exception as error:
+            # Anything but the server closing the connection, or close(), is shown with the server status
+            if self.connected and not isinstance(error, ConnectionError):
+                self.error = f"Lost the simulation server: {error!r}"
+        finally:
+            self.connected = False
+
+    def send(self, command, **arguments):
+        # Send a command such as send("run_to", cycle=500) to the server
+        if self.connected:
+            self.socket.sendall(encode_message(dict(arguments, command=command)))
+
+    @property
+    def first_cycle(self):
+        with self.lock:
+            return next(iter(self.history))
+
+    @property
+    def last_cycle(self):
+        with self.lock:
+            return next(reversed(self.history))
+
+    def has_cycle(self, cycle):
+        with self.lock:
+            return cycle in self.history
+
+    def __getitem__(self, cycle):
+        with self.lock:
+            return self.history[cycle]
+
+    def close(self):
+        self.connected = False
+        self.socket.close()
+
+
+def open_cycle_log(path):
+    # Open a binary trace or a text log, whichever the file is
+    with open(path, "rb") as file:
+        magic = file.read(len(MAGIC))
+    return TraceCycleLog(path) if magic == MAGIC else TextCycleLog(path)
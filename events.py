@@ -0,0 +1,109 @@
+# Typed events published by ReservationStationManager, and the bus delivering them to subscribers.
+# Events are only built when something subscribed to their type, so an unobserved run pays nothing for them.
+
+
+class Event:
+    __slots__ = ("cycle",)
+    fields = ()
+
+    def __init__(self, cycle, *values):
+        self.cycle = cycle
+        for name, value in zip(self.fields, values):
+            setattr(self, name, value)
+
+    def as_dict(self):
+        # JSON-friendly form; stations are given by name
+        data = {"event": type(self).__name__, "cycle": self.cycle}
+        for name in self.fields:
+            value = getattr(self, name)
+            data[name] = getattr(value, "name", value)
+        return data
+
+    def __repr__(self):
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.fields)
+        return f"{type(self).__name__}(cycle={self.cycle}, {values})"
+
+
+class IssueEvent(Event):
+    # An instruction entered a reservation station
+    __slots__ = fields = ("station", "sequence", "pc", "instruction")
+
+
+class OperandCaptureEvent(Event):
+    # A station obtained a source operand, at issue (producer None) or from a CDB broadcast
+    __slots__ = fields = ("station", "slot", "value", "producer")
+
+
+class ExecuteStartEvent(Event):
+    __slots__ = fields = ("station", "sequence")
+
+
+class CompleteEvent(Event):
+    # A station finished executing and was granted a common data bus
+    __slots__ = fields = ("station", "sequence")
+
+
+class WriteBackEvent(Event):
+    # A result was broadcast on a common data bus (value is None for stores)
+    __slots__ = fields = ("station", "sequence", "value")
+
+
+class BranchResolvedEvent(Event):
+    # predicted_taken is None when the machine does not speculate
+    __slots__ = fields = ("station", "sequence", "taken", "predicted_taken", "target")
+
+
+class StallEvent(Event):
+    # reason: "waw", "structural", "branch" or "rob_full" for lost issue slots (station None),
+    # or "cdb" for a finished station that lost write-back arbitration (slots 1)
+    __slots__ = fields = ("reason", "slots", "station")
+
+
+class CommitEvent(Event):
+    __slots__ = fields = ("sequence", "pc")
+
+
+class SquashEvent(Event):
+    # Every instruction issued after `sequence` was discarded
+    __slots__ = fields = ("sequence", "count")
+
+
+class CycleEndEvent(Event):
+    # End of a cycle, or of `count` identical cycles jumped over by the skip engine
+    __slots__ = fields = ("issued", "count")
+
+
+EVENT_TYPES = (IssueEvent, OperandCaptureEvent, ExecuteStartEvent, CompleteEvent, WriteBackEvent,
+               BranchResolvedEvent, StallEvent, CommitEvent, SquashEvent, CycleEndEvent)
+
+
+class EventBus:
+    """
+    Delivers events to the callbacks subscribed to their type, in subscription order.
+    """
+
+    def __init__(self):
+        self.subscribers = {}          # Event type -> callbacks
+
+    def subscribe(self, callback, *event_types):
+        # Call callback(event) for the given event types, or for every type if none are given
+        for event_type in event_types or EVENT_TYPES:
+            self.subscribers.setdefault(event_type, []).append(callback)
+
+    def unsubscribe(self, callback):
+        for event_type in list(self.subscribers):
+            callbacks = [other for other in self.subscribers[event_type] if other != callback]
+            if callbacks:
+                self.subscribers[event_type] = callbacks
+            else:
+                del self.subscribers[event_type]
+
+    def wants(self, event_type):
+        return event_type in self.subscribers
+
+    def publish(self, event):
+        for callback in self.subscribers.get(type(event), ()):
+            callback(event)
+
+    def __bool__(self):
+        return bool(self.subscribers)
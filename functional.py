@@ -0,0 +1,312 @@
+import argparse
+import json
+import math
+
+from assembler import FetchWindow
+from events import BranchResolvedEvent, CommitEvent, WriteBackEvent
+from Tomasulo import (BRANCH_CONDITIONS, OPERATIONS, REGISTER_NAMES, DecodedInstruction, Opcode, RegisterFile,
+                      apply_initial_values, decode_program, make_config, make_manager, make_memory,
+                      named_memory_words, simulate)
+
+# Kinds of the instructions compiled for FunctionalSimulator.run
+ALU = 0
+ALU_IMMEDIATE = 1
+LOAD = 2
+STORE = 3
+BRANCH = 4
+
+
+class FunctionalSimulator:
+    """
+    Architectural model of the ISA without any timing: runs the decoded program one instruction at a time,
+    with the operations, memory semantics and branch conditions of the timing model.
+
+    Used to fast-forward through long runs, to start detailed timing windows from (detailed_manager),
+    and as the golden model the final state of the timing model is checked against (check_result).
+    """
+
+    def __init__(self, program, initial_values=(), memory=None):
+        # An assembled program is decoded as it is fetched, like in ReservationStationManager.add_instruction
+        decoded = getattr(program, "decoded", None)
+        self.instructions = program if decoded is not None else list(program)
+        self.program = decoded if decoded is not None else decode_program(self.instructions)
+        self.code = compile_program(self.program)
+        self.memory = memory if memory is not None else make_memory(make_config())
+        self.registers = RegisterFile()
+        self.register_values = self.registers.values
+        apply_initial_values(self.register_values, self.memory, initial_values)
+        self.pc = 0                    # Index of the next instruction to execute
+        self.executed = 0              # Instructions executed so far
+        self.branches = 0
+        self.branches_taken = 0
+
+    @property
+    def done(self):
+        return self.pc >= len(self.code)
+
+    def run(self, count=None):
+        # Execute up to `count` instructions (every remaining one if None); returns how many were executed
+        code = self.code
+        values = self.register_values
+        memory = self.memory
+        end = len(code)
+        limit = -1 if count is None else count
+        pc = self.pc
+        executed = branches = taken = 0
+        try:
+            while pc < end and executed != limit:
+                kind, function, dest, src1, src2, immediate, target = code[pc]
+                if kind == ALU:
+                    values[dest] = function(values[src1], values[src2])
+                elif kind == ALU_IMMEDIATE:
+                    values[dest] = function(values[src1], immediate)
+                elif kind == LOAD:
+                    values[dest] = memory.load(values[src1] + immediate)
+                elif kind == STORE:
+                    memory.store(values[src2] + immediate, values[src1])
+                else:
+                    branches += 1
+                    if function(values[src1]):
+                        taken += 1
+                        pc = target - 1
+                pc += 1
+                executed += 1
+        finally:
+            # An instruction that raised is not counted, and pc stays on it
+            self.pc = pc
+            self.executed += executed
+            self.branches += branches
+            self.branches_taken += taken
+        return executed
+
+    def register_dict(self):
+        # Final registers and named memory words, as in SimulationResult.registers
+        registers = dict(zip(REGISTER_NAMES, self.register_values))
+        registers.update((f"M{address}", self.memory.load(address))
+                         for address in named_memory_words(self.program, self.memory.size))
+        return registers
+
+    def detailed_manager(self, config=None):
+        # ReservationStationManager starting from the current architectural state, with an empty pipeline
+        # and its own copy of the memory
+        rs_manager = make_manager(make_config(config), (), self.memory.copy())
+        rs_manager.add_instruction(self.instructions)
+        rs_manager.register_values[:] = self.register_values
+        rs_manager.instruction_queue_index = self.pc
+        return rs_manager
+
+
+def compile_instruction(decoded):
+    # (kind, function, dest, src1, src2, immediate, target) tuple run by FunctionalSimulator.run
+    opcode = decoded.opcode
+    if opcode == Opcode.LOAD:
+        return (LOAD, None, decoded.dest_index, decoded.src1_index, None, decoded.immediate, None)
+    if opcode == Opcode.STORE:
+        return (STORE, None, None, decoded.src1_index, decoded.src2_index, decoded.immediate, None)
+    if opcode in BRANCH_CONDITIONS:
+        return (BRANCH, BRANCH_CONDITIONS[opcode], None, decoded.src1_index, None, None, decoded.target)
+    kind = ALU if decoded.src2_index is not None else ALU_IMMEDIATE
+    return (kind, OPERATIONS[opcode], decoded.dest_index, decoded.src1_index, decoded.src2_index,
+            decoded.immediate, None)
+
+
+class CompiledWindow(FetchWindow):
+    # compile_instruction of the instructions of an assembled program, compiled a block at a time as they are
+    # executed, with the blocks kept like those of its FetchWindow
+    def decode(self, start, stop):
+        return [compile_instruction(DecodedInstruction(self.program.text(i))) for i in range(start, stop)]
+
+
+def compile_program(decoded):
+    # compile_instruction of every instruction of a decoded program; the FetchWindow of an assembled program
+    # (see assembler.py) is compiled a block at a time as its instructions are executed instead
+    if isinstance(decoded, FetchWindow):
+        return CompiledWindow(decoded.program)
+    return [compile_instruction(instruction) for instruction in decoded]
+
+
+def measure_window(rs_manager, instructions, warmup=0, engine="skip"):
+    """
+    Runs rs_manager until warmup + instructions instructions have completed (committed, with a reorder buffer)
+    or the program ends, and returns (cycles, instructions) of the part after the warmup.
+
+    Args:
+    rs_manager: Manager with its program added, usually from FunctionalSimulator.detailed_manager.
+    instructions: Number of instructions to time.
+    warmup: Instructions completed first, to fill the pipeline and train the predictor; their cycles are not counted.
+    engine: "step" or "skip" (see run_simulation).
+    """
+    target = warmup + instructions
+    marks = {0: 0}                      # Number of completed instructions -> cycle in which it was reached
+    completed = [0]
+
+    def count(event):
+        completed[0] += 1
+        if completed[0] in (warmup, target):
+            marks[completed[0]] = event.cycle
+
+    event_types = (CommitEvent,) if rs_manager.rob is not None else (WriteBackEvent, BranchResolvedEvent)
+    rs_manager.subscribe(count, *event_types)
+    try:
+        while completed[0] < target:
+            if engine == "skip":
+                skipped = rs_manager.quiet_cycles()
+                if skipped:
+                    rs_manager.skip_cycles(skipped)
+                    continue
+            all_idle = rs_manager.execute_cycle()
+            if all_idle and rs_manager.instruction_queue_index == len(rs_manager.program):
+                break
+    finally:
+        rs_manager.unsubscribe(count)
+    if completed[0] <= warmup:
+        return 0, 0
+    end = marks.get(target, rs_manager.cycle)
+    return end - marks[warmup], min(completed[0], target) - warmup
+
+
+# One detailed timing window
+class Sample:
+    __slots__ = ("start", "instructions", "cycles")
+
+    def __init__(self, start, instructions, cycles):
+        self.start = start                # Instructions executed before the window
+        self.instructions = instructions  # Instructions timed
+        self.cycles = cycles
+
+    @property
+    def cpi(self):
+        return self.cycles / self.instructions
+
+    def as_dict(self):
+        return {"start": self.start, "instructions": self.instructions, "cycles": self.cycles, "cpi": self.cpi}
+
+
+# Outcome of a sampled run
+class SamplingResult:
+    def __init__(self, instructions, samples, registers):
+        self.instructions = instructions  # Instructions executed by the functional model
+        self.samples = samples            # Sample of every detailed window
+        self.registers = registers        # Final registers and named memory words, by name
+        cpis = [sample.cpi for sample in samples]
+        self.cpi = sum(cpis) / len(cpis) if cpis else 0.0
+        # Half-width of the 95% confidence interval of the CPI (0 with fewer than two samples)
+        if len(cpis) > 1:
+            variance = sum((cpi - self.cpi) ** 2 for cpi in cpis) / (len(cpis) - 1)
+            self.cpi_error = 1.96 * math.sqrt(variance / len(cpis))
+        else:
+            self.cpi_error = 0.0
+        self.estimated_cycles = round(self.cpi * instructions)
+
+    def as_dict(self):
+        return {"instructions": self.instructions, "cpi": self.cpi, "cpi_error": self.cpi_error,
+                "estimated_cycles": self.estimated_cycles, "samples": [sample.as_dict() for sample in self.samples],
+                "registers": self.registers}
+
+    def __repr__(self):
+        return (f"SamplingResult(instructions={self.instructions}, cpi={self.cpi:.4f}±{self.cpi_error:.4f}, "
+                f"estimated_cycles={self.estimated_cycles}, samples={len(self.samples)})")
+
+
+def sample(program, config=None, initial_values=(), interval=100000, window=1000, warmup=1000, start=0,
+           engine="skip", max_instructions=None):
+    """
+    Runs a program on the functional model and times a detailed window every `interval` instructions,
+    then extrapolates the total number of cycles from the mean CPI of the windows. Returns a SamplingResult.
+
+    Args:
+    program: List of instruction strings, or an assembled program (see assembler.py).
+    config: Machine configuration used for the detailed windows (see simulate).
+    initial_values: Initial register values, as strings like "R1 80".
+    interval: Instructions from the start of one window to the start of the next.
+    window: Instructions timed in each window.
+    warmup: Instructions simulated in detail before each window without being timed.
+    start: Instructions fast-forwarded before the first window.
+    engine: "step" or "skip", for the detailed windows.
+    max_instructions: Stop after this many instructions even if the program has not finished.
+    """
+    if interval < 1 or window < 1:
+        raise ValueError("Sampling interval and window must be positive")
+    config = make_config(config)
+    memory = make_memory(config)
+    try:
+        functional = FunctionalSimulator(program, initial_values, memory)
+        functional.run(start if max_instructions is None else min(start, max_instructions))
+        samples = []
+        while not functional.done and (max_instructions is None or functional.executed < max_instructions):
+            # The window runs on copies of the state; the functional model then moves on from the same point
+            cycles, timed = measure_window(functional.detailed_manager(config), window, warmup, engine)
+            if timed:
+                samples.append(Sample(functional.executed, timed, cycles))
+            step = interval if max_instructions is None else min(interval, max_instructions - functional.executed)
+            functional.run(step)
+        registers = functional.register_dict()
+    finally:
+        memory.close()
+    return SamplingResult(functional.executed, samples, registers)
+
+
+def check_result(program, result, config=None, initial_values=()):
+    # Compare the final registers and named memory words of a SimulationResult with the functional model;
+    # returns {name: (expected, actual)} for every difference
+    memory = make_memory(make_config(config))
+    try:
+        functional = FunctionalSimulator(program, initial_values, memory)
+        functional.run()
+        expected = functional.register_dict()
+    finally:
+        memory.close()
+    mismatches = {}
+    for name, value in expected.items():
+        actual = result.registers.get(name)
+        if actual != value or type(actual) is not type(value):
+            mismatches[name] = (value, actual)
+    return mismatches
+
+
+def verify(program, config=None, initial_values=(), engine="step", max_cycles=None):
+    # Simulate a program in detail and check it against the functional model; returns (SimulationResult, mismatches)
+    result = simulate(program, config, initial_values, engine, max_cycles)
+    return result, check_result(program, result, config, initial_values)
+
+
+if __name__ == "__main__":
+    from batch import load_program
+
+    parser = argparse.ArgumentParser(description="Estimate the cycles of a long run by sampled detailed simulation")
+    parser.add_argument("program", help="Program file, assembly source or assembled binary")
+    parser.add_argument("--init", nargs="*", default=[], help='Initial register values, e.g. "R1 80"')
+    parser.add_argument("--config", help="JSON file overriding parts of DEFAULT_CONFIG")
+    parser.add_argument("--interval", type=int, default=100000, help="Instructions between windows")
+    parser.add_argument("--window", type=int, default=1000, help="Instructions timed per window")
+    parser.add_argument("--warmup", type=int, default=1000, help="Detailed instructions before each window")
+    parser.add_argument("--start", type=int, default=0, help="Instructions fast-forwarded before the first window")
+    parser.add_argument("--max-instructions", type=int, default=None)
+    parser.add_argument("--check", action="store_true",
+                        help="Also simulate the whole run in detail and check it against the functional model")
+    parser.add_argument("--json", help="Write the sampling result to this file")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+    program = load_program(args.program)
+    initial_values = program.initial_values + args.init
+    result = sample(program, config, initial_values, args.interval, args.window, args.warmup, args.start,
+                    max_instructions=args.max_instructions)
+    print(f"Instructions: {result.instructions}")
+    print(f"Samples: {len(result.samples)}")
+    print(f"CPI: {result.cpi:.4f} ± {result.cpi_error:.4f}")
+    print(f"Estimated cycles: {result.estimated_cycles}")
+    if args.check:
+        detailed, mismatches = verify(program, config, initial_values, engine="skip")
+        print(f"Detailed cycles: {detailed.cycles} (estimate off by "
+              f"{100 * (result.estimated_cycles - detailed.cycles) / detailed.cycles:+.2f}%)")
+        for name, (expected, actual) in mismatches.items():
+            print(f"  {name}: functional model {expected!r}, timing model {actual!r}")
+        if mismatches:
+            raise SystemExit(1)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result.as_dict(), file, indent=1)
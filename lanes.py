@@ -0,0 +1,476 @@
+# Lane-parallel simulation of one program over many sets of initial values.
+#
+# The timing of a run depends on its data only through the path the program takes and through which of the
+# memory accesses that can be in flight together share an address (see loopmemo.py). simulate_lanes executes
+# the program once for all input sets at a time, with every register held as a NumPy array of one value per
+# lane: lanes stay together until a branch sends them different ways, and the arithmetic of each instruction
+# runs lane-wide with the semantics of the scalar model. Lanes that end with the same path and address
+# relations then share a single detailed timing simulation.
+import argparse
+import json
+import operator
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from functional import ALU, ALU_IMMEDIATE, LOAD, STORE, compile_program
+from loopmemo import EXECUTION_ERRORS
+from memory import FLOAT_WORD, INT_WORD, WORD_SIZE
+from Tomasulo import (REGISTER_NAMES, RegisterFile, SimulationResult, apply_initial_values,
+                      decode_program, make_config, make_memory, named_memory_words, simulate)
+
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+# Integers up to this size convert to float exactly, so numpy's float division matches Python's int / int
+EXACT_FLOAT_INT = 1 << 53
+# Multiplier of the per-lane timing key hash
+KEY_MULTIPLIER = 0x100000001B3
+# Operations that access memory, as named in the "optypes" of a configuration
+MEMORY_OPERATIONS = ("LOAD", "STORE")
+
+
+def lane_array(values):
+    # Array of Python numbers: int64 or float64 when they all fit, otherwise an object array of the numbers
+    if all(value.__class__ is int and INT64_MIN <= value <= INT64_MAX for value in values):
+        return numpy.array(values, dtype=numpy.int64)
+    if all(value.__class__ is float for value in values):
+        return numpy.array(values, dtype=numpy.float64)
+    array = numpy.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def python_lanes(function, a, b):
+    # function applied lane by lane to Python numbers; returns (result, {position: exception} or None)
+    values = []
+    errors = {}
+    for i, (x, y) in enumerate(zip(a.tolist(), b.tolist())):
+        try:
+            values.append(function(x, y))
+        except EXECUTION_ERRORS as error:
+            errors[i] = error
+            values.append(0)
+    return lane_array(values), errors or None
+
+
+def lane_apply(function, a, b):
+    # function(a, b) for every lane, with the results and errors Python numbers would give;
+    # returns (result, {position: exception} or None)
+    if a.dtype != object and b.dtype != object:
+        integers = a.dtype.kind == "i" and b.dtype.kind == "i"
+        with numpy.errstate(all="ignore"):
+            if function is operator.truediv:
+                exact = not integers or not (((a > EXACT_FLOAT_INT) | (a < -EXACT_FLOAT_INT)).any()
+                                             or ((b > EXACT_FLOAT_INT) | (b < -EXACT_FLOAT_INT)).any())
+                if exact:
+                    zero = b == 0
+                    errors = None
+                    if zero.any():
+                        errors = python_lanes(function, a[zero], b[zero])[1]
+                        errors = dict(zip(numpy.flatnonzero(zero).tolist(), errors.values()))
+                    return numpy.true_divide(a, b), errors
+            elif not integers:
+                return function(a, b), None
+            else:
+                result = function(a, b)
+                if function is operator.add:
+                    overflow = ((a ^ result) & (b ^ result)) < 0
+                elif function is operator.sub:
+                    overflow = ((a ^ b) & (a ^ result)) < 0
+                else:
+                    overflow = numpy.abs(a.astype(numpy.float64) * b) >= 2.0 ** 62
+                if not overflow.any():
+                    return result, None
+    return python_lanes(function, a, b)
+
+
+class LaneMemory:
+    """
+    Data memory of every lane. Only the words some lane touches get a row, holding the 8 bytes of the word
+    in each lane (as int64) and its tag; the others still have the contents of the shared initial memory.
+    """
+
+    def __init__(self, memory, lanes):
+        self.memory = memory           # Initial contents, shared by all lanes, and the address checks
+        self.lanes = lanes
+        # Copied so the initial memory can be closed (a mapped file cannot while arrays view it)
+        self.initial = numpy.frombuffer(memory.data, dtype="<i8", count=memory.size // WORD_SIZE).copy()
+        self.initial_tags = numpy.frombuffer(memory.tags, dtype=numpy.uint8).copy()
+        self.row_of_word = numpy.full(memory.size // WORD_SIZE, -1, dtype=numpy.int64)
+        self.bits = numpy.zeros((0, lanes), dtype=numpy.int64)
+        self.tags = numpy.zeros((0, lanes), dtype=numpy.uint8)
+        self.rows = 0
+
+    def row_indices(self, words):
+        # Rows of the given words, creating those that do not exist yet
+        rows = self.row_of_word[words]
+        missing = numpy.unique(words[rows < 0])
+        if len(missing):
+            needed = self.rows + len(missing)
+            if needed > len(self.bits):
+                capacity = max(needed, 2 * len(self.bits), 16)
+                self.bits = numpy.resize(self.bits, (capacity, self.lanes))
+                self.tags = numpy.resize(self.tags, (capacity, self.lanes))
+            new_rows = numpy.arange(self.rows, needed)
+            self.bits[new_rows] = self.initial[missing][:, None]
+            self.tags[new_rows] = self.initial_tags[missing][:, None]
+            self.row_of_word[missing] = new_rows
+            self.rows = needed
+            rows = self.row_of_word[words]
+        return rows
+
+    def check(self, addresses):
+        # (int64 addresses, {position: exception} or None), with the checks of Memory.check
+        size = self.memory.size
+        if addresses.dtype == object:
+            valid = numpy.zeros(len(addresses), dtype=bool)
+            for i, address in enumerate(addresses.tolist()):
+                try:
+                    self.memory.check(address)
+                    valid[i] = True
+                except EXECUTION_ERRORS:
+                    pass
+        else:
+            with numpy.errstate(all="ignore"):
+                valid = (addresses >= 0) & (addresses <= size - WORD_SIZE)
+                if addresses.dtype.kind == "f":
+                    valid &= addresses == numpy.floor(addresses)
+                valid &= numpy.where(valid, addresses, 0).astype(numpy.int64) % WORD_SIZE == 0
+        errors = None
+        if not valid.all():
+            errors = {}
+            for i in numpy.flatnonzero(~valid).tolist():
+                try:
+                    self.memory.check(addresses[i].item() if addresses.dtype != object else addresses[i])
+                except EXECUTION_ERRORS as error:
+                    errors[i] = error
+        checked = numpy.where(valid, addresses, 0)
+        if checked.dtype == object:
+            checked = numpy.array([int(address) for address in checked.tolist()], dtype=numpy.int64)
+        return checked.astype(numpy.int64), errors
+
+    def load(self, lanes, addresses):
+        # (values, tags) of the words at checked addresses, one per lane
+        rows = self.row_indices(addresses // WORD_SIZE)
+        bits = self.bits[rows, lanes]
+        tags = self.tags[rows, lanes]
+        return bits, tags
+
+    def store(self, lanes, addresses, values):
+        # Write a value per lane, wrapping integers to 64 bits as Memory.store does
+        rows = self.row_indices(addresses // WORD_SIZE)
+        if values.dtype.kind == "f":
+            self.bits[rows, lanes] = values.view(numpy.int64)
+            self.tags[rows, lanes] = FLOAT_WORD
+            return
+        if values.dtype == object:
+            floats = numpy.array([value.__class__ is float for value in values.tolist()], dtype=bool)
+            words = [int(value) if value.__class__ is not float else 0 for value in values.tolist()]
+            words = [(value - INT64_MIN) % (1 << 64) + INT64_MIN for value in words]
+            bits = numpy.array(words, dtype=numpy.int64)
+            if floats.any():
+                bits[floats] = numpy.array(values[floats].tolist(), dtype=numpy.float64).view(numpy.int64)
+            self.bits[rows, lanes] = bits
+            self.tags[rows, lanes] = numpy.where(floats, FLOAT_WORD, INT_WORD)
+            return
+        self.bits[rows, lanes] = values
+        self.tags[rows, lanes] = INT_WORD
+
+    def words(self, lanes, address):
+        # Python values of one word in each of the given lanes
+        row = self.row_of_word[address // WORD_SIZE]
+        if row < 0:
+            value = self.memory.load(address)
+            return [value] * len(lanes)
+        bits = self.bits[row, lanes]
+        tags = self.tags[row, lanes]
+        floats = bits.view(numpy.float64).tolist()
+        return [float_value if tag == FLOAT_WORD else int_value
+                for int_value, float_value, tag in zip(bits.tolist(), floats, tags.tolist())]
+
+
+# Lanes executing the same instruction stream
+class LaneGroup:
+    __slots__ = ("lanes", "pc", "values", "key", "recent", "executed")
+
+    def __init__(self, lanes, pc, values, key, recent, executed):
+        self.lanes = lanes             # Lane numbers
+        self.pc = pc                   # Program index of the next instruction
+        self.values = values           # Array of the lanes' values of each register
+        self.key = key                 # Per-lane hash of the path and address relations so far
+        self.recent = recent           # Addresses of the latest memory accesses, newest last
+        self.executed = executed       # Instructions executed
+
+    def subset(self, keep):
+        return LaneGroup(self.lanes[keep], self.pc, [values[keep] for values in self.values], self.key[keep],
+                         [addresses[keep] for addresses in self.recent], self.executed)
+
+
+class LaneResults:
+    """
+    Outcome of simulate_lanes: the final registers and cycles of every lane, in input order.
+    """
+
+    def __init__(self, cycles, registers, stats, errors, timing_runs):
+        self.cycles = cycles            # Cycles of each lane (None if its program raised)
+        self.registers = registers      # Final registers and named memory words of each lane, by name
+        self.stats = stats              # Counters of the timing simulation each lane shares
+        self.errors = errors            # First exception, in program order, raised by each lane's program, or None
+        self.timing_runs = timing_runs  # Detailed timing simulations run
+
+    def __len__(self):
+        return len(self.cycles)
+
+    def __getitem__(self, lane):
+        # SimulationResult of one lane; raises the lane's error if its program raised
+        if self.errors[lane] is not None:
+            raise self.errors[lane]
+        return SimulationResult(self.cycles[lane], self.registers[lane], self.stats[lane])
+
+    def as_dict(self):
+        return {"timing_runs": self.timing_runs,
+                "lanes": [{"cycles": cycles, "registers": registers,
+                           "error": repr(error) if error is not None else None}
+                          for cycles, registers, error in zip(self.cycles, self.registers, self.errors)]}
+
+    def __repr__(self):
+        failed = sum(error is not None for error in self.errors)
+        return f"LaneResults(lanes={len(self.cycles)}, timing_runs={self.timing_runs}, errors={failed})"
+
+
+def access_window(config):
+    # How many earlier memory accesses can still be in flight when one is checked for conflicts
+    memory_stations = sum(count for op_type, count in config["station_counts"].items()
+                          if any(op in MEMORY_OPERATIONS for op in config["optypes"].get(op_type, ())))
+    return max(1, memory_stations - 1 + config["rob"].get("size", 0))
+
+
+def simulate_lanes(program, initial_value_sets, config=None, engine="skip", max_cycles=None, max_instructions=None):
+    """
+    Simulates a program once per set of initial values and returns a LaneResults. Requires NumPy.
+
+    The program runs functionally for all lanes at once, then one detailed simulation (see simulate) is run
+    for each group of lanes with the same branch outcomes and memory address relations; every lane of a
+    group takes the same number of cycles. Registers are the same as those separate simulate calls return.
+    With a reorder buffer, loads and stores on mispredicted paths are not compared between lanes.
+
+    Args:
+    program: List of instruction strings, or an assembled program (see assembler.py).
+    initial_value_sets: One list of initial register values (strings like "R1 80") per lane.
+    config: Machine configuration (see simulate).
+    engine: Engine of the detailed simulations (see run_simulation).
+    max_cycles: Raise RuntimeError if a detailed simulation has not finished after this many cycles.
+    max_instructions: Stop lanes that execute more instructions than this, with a RuntimeError as their error.
+    A lane whose detailed simulation ends with other registers than its lane-parallel run also gets a RuntimeError.
+    """
+    if numpy is None:
+        raise ImportError("simulate_lanes requires NumPy (pip install numpy)")
+    # An assembled program is decoded as it is fetched, like in ReservationStationManager.add_instruction
+    decoded = getattr(program, "decoded", None)
+    if decoded is None:
+        program = list(program)
+        decoded = decode_program(program)
+    initial_value_sets = [list(values) for values in initial_value_sets]
+    config = make_config(config)
+    code = compile_program(decoded)
+    lane_count = len(initial_value_sets)
+    errors = [None] * lane_count
+    memory = make_memory(config)
+    try:
+        lane_memory = LaneMemory(memory, lane_count)
+        group = initial_group(initial_value_sets, lane_memory)
+        finished = run_lanes(group, code, lane_memory, access_window(config), errors, max_instructions)
+
+        # Final registers of every lane that ran to the end
+        registers = [None] * lane_count
+        keys = {}                      # Timing key -> first lane with it
+        lane_keys = {}
+        addresses = named_memory_words(decoded, memory.size)
+        for group in finished:
+            lanes = group.lanes.tolist()
+            columns = [values.tolist() for values in group.values]
+            columns += [lane_memory.words(group.lanes, address) for address in addresses]
+            names = list(REGISTER_NAMES) + [f"M{address}" for address in addresses]
+            for position, lane in enumerate(lanes):
+                registers[lane] = dict(zip(names, (column[position] for column in columns)))
+            for lane, key in zip(lanes, group.key.tolist()):
+                keys.setdefault(key, lane)
+                lane_keys[lane] = key
+    finally:
+        memory.close()
+
+    # One detailed simulation per timing key. When it ends with other registers than its lane, every lane of
+    # the key is simulated on its own, and those that still disagree get a RuntimeError as their error.
+    timings = {}
+    for key, lane in keys.items():
+        timings[key] = simulate(program, config, initial_value_sets[lane], engine, max_cycles)
+    timing_runs = len(timings)
+    cycles = [None] * lane_count
+    stats = [None] * lane_count
+    for lane, key in lane_keys.items():
+        result = timings[key]
+        if not same_registers(result.registers, registers[keys[key]]):
+            if lane != keys[key]:
+                result = simulate(program, config, initial_value_sets[lane], engine, max_cycles)
+                timing_runs += 1
+            if not same_registers(result.registers, registers[lane]):
+                errors[lane] = RuntimeError(f"Lane {lane} ended with different registers in the detailed simulation")
+                continue
+        cycles[lane] = result.cycles
+        stats[lane] = result.stats
+    return LaneResults(cycles, registers, stats, errors, timing_runs)
+
+
+def same_registers(expected, actual):
+    # Equal values of the same types (NaN equal to NaN)
+    if expected.keys() != actual.keys():
+        return False
+    for name, value in expected.items():
+        other = actual[name]
+        if value.__class__ is not other.__class__ or (value != other and (value == value or other == other)):
+            return False
+    return True
+
+
+def initial_group(initial_value_sets, lane_memory):
+    # Group of every lane, with its registers and memory words set from its initial values
+    base = RegisterFile().values
+    columns = {}
+    for lane, initial_values in enumerate(initial_value_sets):
+        overrides = {}
+        words = InitialWords(lane_memory.memory)
+        apply_initial_values(overrides, words, initial_values)
+        for index, value in overrides.items():
+            columns.setdefault(index, list(base[index:index + 1]) * len(initial_value_sets))[lane] = value
+        for address, value in words.stored:
+            lane_memory.store(numpy.array([lane]), numpy.array([address]), lane_array([value]))
+    count = len(initial_value_sets)
+    values = [lane_array(columns[index]) if index in columns else lane_array([value] * count)
+              for index, value in enumerate(base)]
+    return LaneGroup(numpy.arange(count), 0, values, numpy.zeros(count, dtype=numpy.uint64), [], 0)
+
+
+class InitialWords:
+    # Stands in for Memory in apply_initial_values, recording the words it sets
+    def __init__(self, memory):
+        self.memory = memory
+        self.stored = []
+
+    def store(self, address, value):
+        self.stored.append((self.memory.check(address), value))
+
+
+def run_lanes(group, code, lane_memory, window, errors, max_instructions):
+    # Execute the program for every lane of group, splitting it where lanes diverge; returns the finished groups
+    pending = [group]
+    finished = []
+    end = len(code)
+    multiplier = numpy.uint64(KEY_MULTIPLIER)
+
+    def drop(group, lane_errors):
+        # Record the errors of the lanes that raised; returns the group of the others and which they are
+        for position, error in lane_errors.items():
+            errors[group.lanes[position]] = error
+        keep = numpy.ones(len(group.lanes), dtype=bool)
+        keep[list(lane_errors)] = False
+        return group.subset(keep), keep
+
+    while pending:
+        group = pending.pop()
+        values = group.values
+        while len(group.lanes):
+            if group.pc >= end:
+                finished.append(group)
+                break
+            if max_instructions is not None and group.executed >= max_instructions:
+                for lane in group.lanes.tolist():
+                    errors[lane] = RuntimeError(f"Program did not finish within {max_instructions} instructions")
+                break
+            kind, function, dest, src1, src2, immediate, target = code[group.pc]
+            if kind == ALU or kind == ALU_IMMEDIATE:
+                second = values[src2] if kind == ALU else lane_array([immediate]).repeat(len(group.lanes))
+                result, lane_errors = lane_apply(function, values[src1], second)
+                if lane_errors:
+                    group, keep = drop(group, lane_errors)
+                    values = group.values
+                    result = result[keep]
+                values[dest] = result
+            elif kind == LOAD or kind == STORE:
+                base = values[src1 if kind == LOAD else src2]
+                addresses, lane_errors = lane_apply(operator.add, base, lane_array([immediate]).repeat(len(base)))
+                if not lane_errors:
+                    addresses, lane_errors = lane_memory.check(addresses)
+                if lane_errors:
+                    group = drop(group, lane_errors)[0]
+                    values = group.values
+                    continue  # Run the instruction again for the remaining lanes
+                if kind == LOAD:
+                    bits, tags = lane_memory.load(group.lanes, addresses)
+                    floats = tags == FLOAT_WORD
+                    if floats.any() and not floats.all():
+                        # Lanes loading a float and lanes loading an integer continue separately
+                        pending.append(group.subset(floats))
+                        group = group.subset(~floats)
+                        values = group.values
+                        continue
+                    values[dest] = bits.view(numpy.float64) if floats.any() else bits
+                else:
+                    lane_memory.store(group.lanes, addresses, values[src1])
+                # Fold which of the latest accesses share this address into the key
+                relations = numpy.zeros(len(addresses), dtype=numpy.uint64)
+                for bit, earlier in enumerate(group.recent):
+                    relations |= (earlier == addresses).astype(numpy.uint64) << numpy.uint64(bit)
+                group.key = group.key * multiplier + relations
+                group.recent.append(addresses)
+                if len(group.recent) > window:
+                    del group.recent[0]
+            else:
+                taken = numpy.broadcast_to(numpy.asarray(function(values[src1]), dtype=bool), group.lanes.shape)
+                branch_taken = bool(taken.all())
+                if not branch_taken and taken.any():
+                    # Lanes going different ways continue as two groups
+                    other = group.subset(~taken)
+                    other.pc += 1
+                    other.executed += 1
+                    other.key = other.key * multiplier + numpy.uint64(1)
+                    pending.append(other)
+                    group = group.subset(taken)
+                    values = group.values
+                    branch_taken = True
+                if branch_taken:
+                    group.pc = target - 1
+                group.key = group.key * multiplier + numpy.uint64(2 if branch_taken else 1)
+            group.pc += 1
+            group.executed += 1
+    return finished
+
+
+if __name__ == "__main__":
+    from batch import load_program
+
+    parser = argparse.ArgumentParser(description="Simulate a program over many sets of initial values")
+    parser.add_argument("program", help="Program file, assembly source or assembled binary")
+    parser.add_argument("inputs", help='File with the initial values of one lane per line, e.g. "R1 80, R2 10"')
+    parser.add_argument("--config", help="JSON file overriding parts of DEFAULT_CONFIG")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    parser.add_argument("--json", help="Write the per-lane results to this file")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+    with open(args.inputs) as file:
+        initial_value_sets = [[value.strip() for value in line.split(",") if value.strip()]
+                              for line in file if line.strip()]
+    program = load_program(args.program)
+    initial_value_sets = [program.initial_values + values for values in initial_value_sets]
+    results = simulate_lanes(program, initial_value_sets, config, max_cycles=args.max_cycles)
+    for lane, (cycles, error) in enumerate(zip(results.cycles, results.errors)):
+        print(f"{lane}, {cycles if error is None else repr(error)}")
+    print(f"{len(results)} lanes, {results.timing_runs} timing simulations")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results.as_dict(), file, indent=1)
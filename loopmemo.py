@@ -0,0 +1,193 @@
+# Loop timing memoization for the "memo" engine of run_simulation.
+#
+# Without a reorder buffer a branch resolves only once every older instruction has left its station, and
+# nothing younger issues before it resolves, so right after a resolution the pipeline holds nothing but the
+# instructions issued in that same cycle, with operands read from a register file and memory that are exactly
+# the architectural state. The timing from there on depends on the data only through the path the program
+# takes and on which of its memory accesses share an address. When the same timing state (the fingerprint)
+# is reached twice over the same path and address pattern, every later repetition takes the same cycles:
+# such periods are replayed by running their instructions functionally and adding the recorded deltas.
+from functional import ALU, ALU_IMMEDIATE, LOAD, STORE, compile_program
+
+# Errors an instruction can raise; a period that raises is left to the detailed engine
+EXECUTION_ERRORS = (ArithmeticError, IndexError, ValueError)
+
+
+def fingerprint(rs_manager):
+    # Everything that determines the timing of the following cycles, except data values
+    base = rs_manager.issued_instructions
+    cycle = rs_manager.cycle
+    stations = tuple(
+        (station.stage, station.remaining_cycles, station.instruction.index, station.instruction.Qj,
+         station.instruction.Qk, base - station.sequence, cycle - station.issue_cycle,
+         tuple((consumer.tag, slot) for consumer, slot in station.consumers))
+        if station.busy else None
+        for station in rs_manager.station_list)
+    branching = rs_manager.branching_station.tag if rs_manager.branching_station is not None else -1
+    return (rs_manager.instruction_queue_index, stations, tuple(rs_manager.register_producers),
+            tuple(station.tag for station in rs_manager.ready_stations),
+            tuple(station.tag for station in rs_manager.write_stage_stations), branching, rs_manager.last_granted)
+
+
+# Counters of the manager at one occurrence of a fingerprint
+class Snapshot:
+    __slots__ = ("cycle", "issued", "issue_stall_cycles", "cdb_stall_cycles", "branches", "branches_taken",
+                 "busy_cycles", "probe")
+
+    def __init__(self, rs_manager):
+        self.cycle = rs_manager.cycle
+        self.issued = rs_manager.issued_instructions
+        self.issue_stall_cycles = rs_manager.issue_stall_cycles
+        self.cdb_stall_cycles = rs_manager.cdb_stall_cycles
+        self.branches = rs_manager.branches
+        self.branches_taken = rs_manager.branches_taken
+        self.busy_cycles = [station.busy_cycles for station in rs_manager.station_list]
+        self.probe = None             # (path, address pattern, next pc) of the instructions following it
+
+
+# A stretch between two occurrences of a fingerprint, with the counter deltas it adds
+class Period:
+    __slots__ = ("start", "path", "pattern", "cycles", "issue_stall_cycles", "cdb_stall_cycles", "branches",
+                 "branches_taken", "busy_cycles")
+
+    def __init__(self, start, path, pattern, before, after):
+        self.start = start            # Program index of the first instruction of the period
+        self.path = path              # Program index of every instruction executed, in order
+        self.pattern = pattern        # For each memory access, the index of the first access to its address
+        self.cycles = after.cycle - before.cycle
+        self.issue_stall_cycles = after.issue_stall_cycles - before.issue_stall_cycles
+        self.cdb_stall_cycles = after.cdb_stall_cycles - before.cdb_stall_cycles
+        self.branches = after.branches - before.branches
+        self.branches_taken = after.branches_taken - before.branches_taken
+        self.busy_cycles = [new - old for new, old in zip(after.busy_cycles, before.busy_cycles)]
+
+
+class LoopMemo:
+    """
+    Detects repeating loop periods of a manager without a reorder buffer and replays them.
+    visit() is called at the end of every cycle in which a branch resolved.
+    """
+
+    def __init__(self, rs_manager):
+        self.rs_manager = rs_manager
+        self.code = compile_program(rs_manager.program)
+        self.seen = {}                # Fingerprint -> Snapshot at its latest occurrence
+        self.periods = {}             # Fingerprint -> Period known to follow it
+        self.replayed = 0             # Periods replayed so far
+        self.saved_registers = None   # Undo information of the last functional run
+        self.stored = []
+
+    def visit(self, cycles_left=None):
+        # Replay as many periods as possible from here; returns the number of cycles skipped
+        rs_manager = self.rs_manager
+        for station in rs_manager.station_list:
+            if station.busy and station.issue_cycle != rs_manager.cycle:
+                return 0              # Only the state right after a resolution is fully described by the fingerprint
+        key = fingerprint(rs_manager)
+        period = self.periods.get(key)
+        if period is None:
+            snapshot = Snapshot(rs_manager)
+            previous = self.seen.get(key)
+            self.seen[key] = snapshot
+            if previous is None:
+                return 0
+            start = self.start_pc()
+            length = snapshot.issued - previous.issued
+            probe = previous.probe
+            if probe is not None and len(probe[0]) == length and probe[2] == start:
+                # The detailed engine just ran the probed instructions from the same state to the same state
+                period = Period(start, probe[0], probe[1], previous, snapshot)
+                self.periods[key] = period
+            else:
+                # See which instructions the next stretch of that length executes
+                snapshot.probe = self.run_functional(start, length)
+                self.undo()
+                return 0
+        return self.replay(period, cycles_left)
+
+    def start_pc(self):
+        # Program index of the oldest instruction in flight (they were all issued in a row), or of the queue head
+        rs_manager = self.rs_manager
+        return rs_manager.instruction_queue_index - sum(station.busy for station in rs_manager.station_list)
+
+    def replay(self, period, cycles_left):
+        rs_manager = self.rs_manager
+        count = 0
+        while cycles_left is None or (count + 1) * period.cycles <= cycles_left:
+            result = self.run_functional(period.start, len(period.path))
+            if result is None or result[0] != period.path or result[1] != period.pattern or result[2] != period.start:
+                self.undo()
+                break
+            count += 1
+        if not count:
+            return 0
+
+        cycles = count * period.cycles
+        length = count * len(period.path)
+        rs_manager.cycle += cycles
+        rs_manager.issued_instructions += length
+        rs_manager.issue_stall_cycles += count * period.issue_stall_cycles
+        rs_manager.cdb_stall_cycles += count * period.cdb_stall_cycles
+        rs_manager.branches += count * period.branches
+        rs_manager.branches_taken += count * period.branches_taken
+        values = rs_manager.register_values
+        for station, busy in zip(rs_manager.station_list, period.busy_cycles):
+            station.busy_cycles += count * busy
+            if station.busy:
+                # The instructions in flight are now those of a later iteration, read from the current registers
+                station.sequence += length
+                station.issue_cycle += cycles
+                instruction = station.instruction
+                decoded = instruction.decoded
+                if instruction.Qj is None:
+                    instruction.Vj = values[decoded.src1_index]
+                if instruction.Qk is None and decoded.src2_index is not None:
+                    instruction.Vk = values[decoded.src2_index]
+        self.replayed += count
+        self.seen.clear()             # Older snapshots no longer describe a continuous detailed run
+        return cycles
+
+    def run_functional(self, pc, count):
+        # Execute up to `count` instructions from program index `pc` on the manager's registers and memory,
+        # keeping what undo() needs; returns (path, address pattern, next pc), or None if an instruction raised
+        rs_manager = self.rs_manager
+        code = self.code
+        values = rs_manager.register_values
+        memory = rs_manager.memory
+        self.saved_registers = values[:]
+        stored = self.stored = []
+        path = []
+        pattern = []
+        addresses = {}
+        end = len(code)
+        try:
+            while pc < end and len(path) < count:
+                path.append(pc)
+                kind, function, dest, src1, src2, immediate, target = code[pc]
+                if kind == ALU:
+                    values[dest] = function(values[src1], values[src2])
+                elif kind == ALU_IMMEDIATE:
+                    values[dest] = function(values[src1], immediate)
+                elif kind == LOAD or kind == STORE:
+                    base = src1 if kind == LOAD else src2
+                    address = values[base] + immediate
+                    pattern.append(addresses.setdefault(address, len(addresses)))
+                    if kind == LOAD:
+                        values[dest] = memory.load(address)
+                    else:
+                        stored.append((address, memory.load(address)))
+                        memory.store(address, values[src1])
+                elif function(values[src1]):
+                    pc = target - 1
+                pc += 1
+        except EXECUTION_ERRORS:
+            return None
+        return path, pattern, pc
+
+    def undo(self):
+        # Restore the registers and memory from before the last functional run
+        self.rs_manager.register_values[:] = self.saved_registers
+        memory = self.rs_manager.memory
+        for address, value in reversed(self.stored):
+            memory.store(address, value)
+        self.stored = []
@@ -0,0 +1,88 @@
+import mmap
+import struct
+
+# Memory is accessed in aligned 8-byte little-endian words
+WORD_SIZE = 8
+# Default size in bytes of the data memory
+MEMORY_SIZE = 1 << 16
+# Words shown by name ("M0" ... "M240") in the logs, as the memory registers of earlier versions were
+NAMED_WORDS = 31
+
+# Word tags: how the 8 bytes of a word are interpreted
+INT_WORD = 0
+FLOAT_WORD = 1
+
+_int = struct.Struct("<q")
+_float = struct.Struct("<d")
+
+
+class Memory:
+    """
+    Byte-addressable data memory, stored in a bytearray or in a copy-on-write mapping of a file.
+
+    Integers are stored as signed 64-bit words (wrapping like the hardware would) and floats as doubles;
+    one tag byte per word records which, so a LOAD returns the type the STORE wrote.
+    """
+
+    def __init__(self, size=MEMORY_SIZE, path=None):
+        self.file = None
+        if path is not None:
+            # Initial contents come from the file, which is never written to
+            self.file = open(path, "rb")
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_COPY)
+            size = len(self.data)
+        else:
+            self.data = bytearray(size)
+            # Word i starts out holding i, as the memory registers M0 ... M240 did
+            for i in range(min(NAMED_WORDS, size // WORD_SIZE)):
+                _int.pack_into(self.data, i * WORD_SIZE, i)
+        self.size = size
+        self.tags = bytearray(size // WORD_SIZE)
+
+    def check(self, address):
+        # Validate an effective address and return it as an int
+        if address.__class__ is not int:
+            if address.__class__ is float and address.is_integer():
+                address = int(address)
+            else:
+                raise ValueError(f"Memory address is not an integer: {address!r}")
+        if address % WORD_SIZE:
+            raise ValueError(f"Unaligned memory access at address {address}")
+        if not 0 <= address <= self.size - WORD_SIZE:
+            raise IndexError(f"Memory access out of range at address {address} (memory size {self.size})")
+        return address
+
+    def load(self, address):
+        # Value of the word at `address`
+        address = self.check(address)
+        if self.tags[address // WORD_SIZE] == FLOAT_WORD:
+            return _float.unpack_from(self.data, address)[0]
+        return _int.unpack_from(self.data, address)[0]
+
+    def store(self, address, value):
+        # Write an int or float to the word at `address`
+        address = self.check(address)
+        if value.__class__ is float:
+            _float.pack_into(self.data, address, value)
+            self.tags[address // WORD_SIZE] = FLOAT_WORD
+            return
+        value = int(value)
+        if not -(1 << 63) <= value < (1 << 63):
+            value = (value + (1 << 63)) % (1 << 64) - (1 << 63)
+        _int.pack_into(self.data, address, value)
+        self.tags[address // WORD_SIZE] = INT_WORD
+
+    def copy(self):
+        # Independent in-memory copy of the current contents (a mapped file is not shared or reopened)
+        other = Memory.__new__(Memory)
+        other.file = None
+        other.data = bytearray(self.data)
+        other.size = self.size
+        other.tags = bytearray(self.tags)
+        return other
+
+    def close(self):
+        if self.file is not None:
+            self.data.close()
+            self.file.close()
+            self.file = None
@@ -0,0 +1,184 @@
+import argparse
+import json
+
+from events import (BranchResolvedEvent, CommitEvent, CycleEndEvent, ExecuteStartEvent, IssueEvent, SquashEvent,
+                    StallEvent, WriteBackEvent)
+
+# Reasons the issue stage loses a slot (see ReservationStationManager.issue_stall_reason)
+STALL_REASONS = ("waw", "structural", "branch", "rob_full")
+
+
+class Profiler:
+    """
+    Records where the cycles of a run go. Creating one subscribes it to the pipeline events of
+    rs_manager; detach() unsubscribes it.
+
+    Counts lost issue slots by cause (WAW, structural, branch front end, full reorder buffer),
+    station-cycles spent waiting on operands (RAW) or on older memory accesses, write-backs delayed
+    by common data bus conflicts, per-station occupancy, and the issue/execute/write/commit cycle of
+    every instruction.
+    """
+
+    def __init__(self, rs_manager, keep_timings=True, max_timings=None):
+        self.rs_manager = rs_manager
+        self.keep_timings = keep_timings
+        self.max_timings = max_timings   # Stop recording instruction timestamps after this many instructions
+        self.cycles = 0
+        self.issue_slots_lost = dict.fromkeys(STALL_REASONS, 0)
+        self.structural_by_type = {}     # Structural stalls by the operation that could not find a station
+        self.raw_wait_cycles = 0         # Station-cycles with an operand still being produced (Qj/Qk set)
+        self.memory_wait_cycles = 0      # Station-cycles of ready loads/stores held back by older accesses
+        self.cdb_conflicts = 0           # Station-cycles lost waiting for a common data bus
+        self.station_busy = {name: 0 for name in rs_manager.stations}
+        # occupancy[op_type][n]: cycles in which n stations of that type were busy
+        counts = {}
+        for station in rs_manager.station_list:
+            counts[station.op_type] = counts.get(station.op_type, 0) + 1
+        self.occupancy = {op_type: [0] * (count + 1) for op_type, count in counts.items()}
+        self.timings = {}                # Issue sequence -> timestamps of the instruction
+        self.structural_stall = False
+
+        self.handlers = [
+            (self.issued, IssueEvent),
+            (self.executing, ExecuteStartEvent),
+            (self.written, WriteBackEvent),
+            (self.written, BranchResolvedEvent),
+            (self.committed, CommitEvent),
+            (self.squashed, SquashEvent),
+            (self.stalled, StallEvent),
+            (self.end_cycle, CycleEndEvent),
+        ]
+        for handler, event_type in self.handlers:
+            rs_manager.subscribe(handler, event_type)
+
+    def detach(self):
+        for handler, _ in self.handlers:
+            self.rs_manager.unsubscribe(handler)
+
+    # Instruction timestamps
+    def issued(self, event):
+        if self.keep_timings and (self.max_timings is None or len(self.timings) < self.max_timings):
+            self.timings[event.sequence] = {
+                "sequence": event.sequence, "pc": event.pc, "instruction": event.instruction,
+                "station": event.station.name, "issue": event.cycle, "execute": None, "write": None, "commit": None,
+                "squashed": False,
+            }
+
+    def stamp(self, sequence, stage, cycle):
+        record = self.timings.get(sequence)
+        if record is not None:
+            record[stage] = cycle
+
+    def executing(self, event):
+        self.stamp(event.sequence, "execute", event.cycle)
+
+    def written(self, event):
+        self.stamp(event.sequence, "write", event.cycle)
+
+    def committed(self, event):
+        self.stamp(event.sequence, "commit", event.cycle)
+
+    def squashed(self, event):
+        # Mark every recorded instruction younger than the mispredicted branch as squashed
+        for younger in reversed(self.timings):
+            if younger <= event.sequence:
+                break
+            self.timings[younger]["squashed"] = True
+
+    def stalled(self, event):
+        if event.reason == "cdb":
+            self.cdb_conflicts += event.slots
+            return
+        self.issue_slots_lost[event.reason] += event.slots
+        if event.reason == "structural":
+            self.structural_stall = True  # Attributed to the blocked operation at the end of the cycle
+
+    def end_cycle(self, event):
+        # Sample the machine at the end of a cycle; count > 1 for a stretch of identical skipped cycles
+        rs_manager = self.rs_manager
+        count = event.count
+        self.cycles += count
+        if self.structural_stall:
+            self.structural_stall = False
+            op = rs_manager.program[rs_manager.instruction_queue_index].op
+            self.structural_by_type[op] = self.structural_by_type.get(op, 0) + count
+        busy = dict.fromkeys(self.occupancy, 0)
+        for station in rs_manager.station_list:
+            if not station.busy:
+                continue
+            self.station_busy[station.name] += count
+            busy[station.op_type] += 1
+            if station.stage == 'Issue':
+                instruction = station.instruction
+                if instruction.Qj is not None or instruction.Qk is not None:
+                    self.raw_wait_cycles += count
+                elif instruction.op in ("LOAD", "STORE") and rs_manager.memory_conflict(station):
+                    self.memory_wait_cycles += count
+        for op_type, number in busy.items():
+            self.occupancy[op_type][number] += count
+
+    def summary(self, include_timings=False):
+        # Machine-readable results, as a JSON-compatible dictionary
+        cycles = self.cycles
+        summary = {
+            "cycles": cycles,
+            "issue_slots_lost": dict(self.issue_slots_lost),
+            "structural_stalls_by_op": dict(self.structural_by_type),
+            "raw_wait_station_cycles": self.raw_wait_cycles,
+            "memory_order_wait_station_cycles": self.memory_wait_cycles,
+            "cdb_conflict_station_cycles": self.cdb_conflicts,
+            "station_busy_fraction": {name: busy / cycles if cycles else 0.0 for name, busy in self.station_busy.items()},
+            "occupancy": {op_type: list(histogram) for op_type, histogram in self.occupancy.items()},
+        }
+        if include_timings:
+            summary["instructions"] = list(self.timings.values())
+        return summary
+
+    def report(self):
+        # Human-readable version of the summary
+        cycles = self.cycles or 1
+        lines = [f"Cycles: {self.cycles}", "", "Issue slots lost:"]
+        for reason in STALL_REASONS:
+            lost = self.issue_slots_lost[reason]
+            lines.append(f"  {reason:<12}{lost:>10}  {100 * lost / cycles:6.1f}%")
+        for op, stalls in sorted(self.structural_by_type.items()):
+            lines.append(f"    no free station for {op}: {stalls}")
+        lines += [
+            "",
+            f"RAW operand waits:      {self.raw_wait_cycles} station-cycles",
+            f"Memory ordering waits:  {self.memory_wait_cycles} station-cycles",
+            f"CDB conflicts:          {self.cdb_conflicts} station-cycles",
+            "",
+            "Station occupancy:",
+        ]
+        for name, busy in self.station_busy.items():
+            lines.append(f"  {name:<12}{100 * busy / cycles:6.1f}%")
+        lines += ["", "Busy stations per cycle (histogram, % of cycles):"]
+        for op_type, histogram in self.occupancy.items():
+            cells = "  ".join(f"{n}:{100 * count / cycles:.1f}" for n, count in enumerate(histogram))
+            lines.append(f"  {op_type:<12}{cells}")
+        return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    from Tomasulo import simulate
+    from batch import load_program
+
+    parser = argparse.ArgumentParser(description="Profile where the cycles of a program go")
+    parser.add_argument("program", help="Program file, assembly source or assembled binary")
+    parser.add_argument("--init", nargs="*", default=[], help='Initial register values, e.g. "R1 80"')
+    parser.add_argument("--config", help="JSON file overriding parts of DEFAULT_CONFIG")
+    parser.add_argument("--engine", default="skip", choices=["step", "skip"])
+    parser.add_argument("--json", help="Also write the summary, with per-instruction timestamps, to this file")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+    program = load_program(args.program)
+    result = simulate(program, config, program.initial_values + args.init, args.engine, profile=True)
+    print(result.profiler.report())
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result.profiler.summary(include_timings=True), file, indent=1)
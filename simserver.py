@@ -0,0 +1,381 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import stat
+import time
+from collections import deque
+
+from events import CycleEndEvent, IssueEvent
+from tracefile import _changed
+
+# Protocol: one JSON object per line in both directions.
+#
+# Server to client:
+#   {"type": "hello", "stations": [names], "registers": [names], "used_registers": [names in the program]}
+#   {"type": "keyframe", "cycle": c, "stations": [[fields]], "registers": [values]}
+#   {"type": "delta", "cycle": c, "stations": [[station, [[field, value], ...]], ...], "registers": [[i, value], ...]}
+#   {"type": "status", "state": "paused" | "running" | "finished", "cycle": c, "reason": str or null,
+#    "breakpoints": {"cycles": [...], "pcs": [...]}}
+#   {"type": "error", "message": str} (a rejected command, or an exception that ended the simulation)
+# Station fields are in tracefile.STATION_FIELDS order and registers are followed by the named memory words,
+# as in a binary trace. A delta applies to the state of the previous keyframe or delta the client received.
+#
+# Client to server:
+#   {"command": "run"}, {"command": "pause"}, {"command": "step", "count": n}, {"command": "run_to", "cycle": c},
+#   {"command": "break", "cycle": c} or {"command": "break", "pc": i} (pause after the cycle in which the
+#   instruction at program index i issues), {"command": "clear"}, {"command": "status"}
+
+# Messages queued for a client before its deltas are dropped and replaced by a keyframe
+MAX_PENDING = 256
+# Bytes buffered by a client's transport before the server waits for it to read
+WRITE_BUFFER_HIGH = 1 << 16
+# Longest stretch of simulation between two turns of the event loop, in seconds
+SLICE_SECONDS = 0.02
+
+PAUSED = "paused"
+RUNNING = "running"
+FINISHED = "finished"
+
+
+def parse_address(address):
+    # ("unix", path) or ("tcp", host, port) for "path/to/socket", "host:port" or ":port"
+    host, separator, port = address.rpartition(":")
+    if separator and port.isdigit() and not os.path.exists(address):
+        return "tcp", host or "127.0.0.1", int(port)
+    return "unix", address
+
+
+def encode_message(message):
+    return json.dumps(message, separators=(",", ":")).encode() + b"\n"
+
+
+def manager_state(rs_manager, stations, memory_addresses):
+    # (station fields, register values) shown to clients, in protocol order
+    registers = list(rs_manager.register_values)
+    registers += [rs_manager.memory.load(address) for address in memory_addresses]
+    return [station.trace_fields() for station in stations], registers
+
+
+def state_delta(old, new):
+    # (station changes, register changes) from one manager_state to the next
+    old_stations, old_registers = old
+    new_stations, new_registers = new
+    registers = [[i, value] for i, (before, value) in enumerate(zip(old_registers, new_registers))
+                 if value is not before and _changed(before, value)]
+    stations = []
+    for i, (before, fields) in enumerate(zip(old_stations, new_stations)):
+        changed = [[bit, b] for bit, (a, b) in enumerate(zip(before, fields)) if _changed(a, b)]
+        if changed:
+            stations.append([i, changed])
+    return stations, registers
+
+
+class Client:
+    # A connected viewer and the messages waiting to be written to it
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = deque()         # (kind, encoded message)
+        self.ready = asyncio.Event()   # Set when pending has something to write
+        self.dropped = 0               # Deltas dropped because the client fell behind
+
+    def send(self, kind, data):
+        self.pending.append((kind, data))
+        self.ready.set()
+
+    def send_state(self, kind, data, keyframe):
+        # Queue a delta or keyframe; a client too far behind loses its queued states and gets a keyframe instead
+        if len(self.pending) >= MAX_PENDING:
+            kept = [item for item in self.pending if item[0] not in ("delta", "keyframe")]
+            self.dropped += len(self.pending) - len(kept)
+            self.pending = deque(kept)
+            kind, data = "keyframe", keyframe()
+        self.send(kind, data)
+
+
+class SimulationServer:
+    """
+    Runs a ReservationStationManager inside an asyncio event loop and streams the state of every cycle to
+    the viewers connected over a Unix socket or localhost TCP (see the protocol above).
+
+    Viewers control the run with pause, run, step, run-to-cycle and breakpoint commands; any number can be
+    attached to the same simulation. A viewer that reads too slowly has its queued deltas replaced by a single
+    keyframe, so it always catches up with the latest cycle. Nothing is recorded while no viewer is attached.
+    """
+
+    def __init__(self, rs_manager, running=False, rate=None):
+        self.rs_manager = rs_manager
+        self.stations = list(rs_manager.stations.values())
+        self.memory_addresses = rs_manager.named_memory_words()
+        self.rate = rate               # Simulated cycles per second while running, unlimited if None
+        self.state = RUNNING if running else PAUSED
+        self.reason = None             # Why the simulation last paused
+        self.stop_cycle = None         # Pause at the end of this cycle (step and run_to)
+        self.break_cycles = set()
+        self.break_pcs = set()
+        self.hit_pc = None             # Program index of a breakpoint instruction issued this cycle
+        self.clients = []
+        self.last_state = None         # State last sent to the clients
+        self.wake = asyncio.Event()
+        self.server = None
+        self.hello = encode_message({
+            "type": "hello",
+            "stations": [station.name for station in self.stations],
+            "registers": list(rs_manager.registers.keys()) + [f"M{address}" for address in self.memory_addresses],
+            "used_registers": rs_manager.used_register_names(),
+        })
+        if rs_manager.cycle and rs_manager.finished():
+            self.state = FINISHED
+
+    async def start(self, address):
+        # Listen on a Unix socket path or on "host:port" (localhost unless a host is given)
+        kind, *where = parse_address(address)
+        if kind == "tcp":
+            self.server = await asyncio.start_server(self.serve_client, *where)
+        else:
+            path = where[0]
+            if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+                os.remove(path)  # Left behind by an earlier server
+            self.server = await asyncio.start_unix_server(self.serve_client, path)
+        return self.server
+
+    async def serve(self, address):
+        # Listen on address and simulate until cancelled
+        await self.start(address)
+        try:
+            await self.simulate()
+        finally:
+            self.server.close()
+            for client in list(self.clients):
+                client.writer.close()
+            self.detach()
+
+    # Per-cycle states
+    def attach(self):
+        self.rs_manager.subscribe(self.cycle_ended, CycleEndEvent)
+
+    def detach(self):
+        self.rs_manager.unsubscribe(self.cycle_ended)
+        self.last_state = None
+
+    def cycle_ended(self, event):
+        state = manager_state(self.rs_manager, self.stations, self.memory_addresses)
+        stations, registers = state_delta(self.last_state, state)
+        delta = encode_message({"type": "delta", "cycle": event.cycle, "stations": stations, "registers": registers})
+        keyframe = []
+
+        def encode_keyframe():
+            # Built at most once per cycle, and only for clients that fell behind
+            if not keyframe:
+                keyframe.append(self.keyframe(state))
+            return keyframe[0]
+
+        for client in self.clients:
+            client.send_state("delta", delta, encode_keyframe)
+        self.last_state = state
+
+    def keyframe(self, state):
+        stations, registers = state
+        return encode_message({"type": "keyframe", "cycle": self.rs_manager.cycle, "stations": stations,
+                               "registers": registers})
+
+    def issued(self, event):
+        if event.pc in self.break_pcs:
+            self.hit_pc = event.pc
+
+    # Run control
+    def status(self):
+        return encode_message({"type": "status", "state": self.state, "cycle": self.rs_manager.cycle,
+                               "reason": self.reason,
+                               "breakpoints": {"cycles": sorted(self.break_cycles), "pcs": sorted(self.break_pcs)}})
+
+    def broadcast_status(self):
+        data = self.status()
+        for client in self.clients:
+            client.send("status", data)
+
+    def set_state(self, state, reason=None):
+        self.state = state
+        self.reason = reason
+        if state != RUNNING:
+            self.stop_cycle = None
+        self.broadcast_status()
+        self.wake.set()
+
+    def command(self, message):
+        # Apply a client command; returns an error message or None
+        command = message.get("command")
+        cycle = self.rs_manager.cycle
+        if command == "status":
+            return None
+        if command == "break":
+            if "cycle" in message:
+                self.break_cycles.add(int(message["cycle"]))
+            elif "pc" in message:
+                if not self.break_pcs:
+                    self.rs_manager.subscribe(self.issued, IssueEvent)
+                self.break_pcs.add(int(message["pc"]))
+            else:
+                return "break needs a cycle or a pc"
+            self.broadcast_status()
+            return None
+        if command == "clear":
+            self.break_cycles.clear()
+            if self.break_pcs:
+                self.rs_manager.unsubscribe(self.issued)
+            self.break_pcs.clear()
+            self.broadcast_status()
+            return None
+        if command == "pause":
+            if self.state == RUNNING:
+                self.set_state(PAUSED, "pause")
+            return None
+        if command not in ("run", "step", "run_to"):
+            return f"Unknown command: {command!r}"
+        if self.state == FINISHED:
+            return f"The simulation finished at cycle {cycle}"
+        if command == "step":
+            self.stop_cycle = cycle + max(1, int(message.get("count", 1)))
+        elif command == "run_to":
+            target = int(message["cycle"])
+            if target <= cycle:
+                return f"Cycle {target} is not after the current cycle {cycle}"
+            self.stop_cycle = target
+        else:
+            self.stop_cycle = None
+        self.set_state(RUNNING)
+        return None
+
+    def advance(self):
+        # Simulate one cycle, or a quiet stretch when no one is watching; pauses at breakpoints and targets
+        rs_manager = self.rs_manager
+        limits = [cycle for cycle in self.break_cycles if cycle > rs_manager.cycle]
+        if self.stop_cycle is not None:
+            limits.append(self.stop_cycle)
+        quiet = rs_manager.quiet_cycles() if rs_manager.hooks is None else 0
+        if quiet:
+            rs_manager.skip_cycles(min([quiet] + [limit - rs_manager.cycle for limit in limits]))
+            all_idle = False
+        else:
+            all_idle = rs_manager.execute_cycle()
+        cycle = rs_manager.cycle
+        if all_idle and rs_manager.instruction_queue_index == len(rs_manager.instruction_queue):
+            self.set_state(FINISHED)
+        elif self.hit_pc is not None:
+            self.set_state(PAUSED, f"breakpoint at pc {self.hit_pc}")
+        elif cycle in self.break_cycles:
+            self.set_state(PAUSED, f"breakpoint at cycle {cycle}")
+        elif self.stop_cycle is not None and cycle >= self.stop_cycle:
+            self.set_state(PAUSED, "target reached")
+        self.hit_pc = None
+
+    def fail(self, error):
+        # An exception raised by the simulation ends it; every viewer is told why
+        data = encode_message({"type": "error",
+                               "message": f"Simulation failed at cycle {self.rs_manager.cycle}: {error!r}"})
+        for client in self.clients:
+            client.send("error", data)
+        self.set_state(FINISHED, f"error: {error!r}")
+
+    async def simulate(self):
+        # Advance the manager while running, yielding to the connections regularly
+        while True:
+            if self.state != RUNNING:
+                self.wake.clear()
+                await self.wake.wait()
+                continue
+            try:
+                if self.rate:
+                    self.advance()
+                else:
+                    deadline = time.monotonic() + SLICE_SECONDS
+                    while self.state == RUNNING and time.monotonic() < deadline:
+                        self.advance()
+            except Exception as error:
+                self.fail(error)
+            await asyncio.sleep(1 / self.rate if self.rate else 0)
+
+    # Connections
+    async def serve_client(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        client = Client(reader, writer)
+        if not self.clients:
+            self.attach()
+        # Every client is in step with last_state between cycles, so a newcomer starts from a keyframe of it
+        self.last_state = manager_state(self.rs_manager, self.stations, self.memory_addresses)
+        self.clients.append(client)
+        client.send("hello", self.hello)
+        client.send("keyframe", self.keyframe(self.last_state))
+        client.send("status", self.status())
+        sender = asyncio.create_task(self.write_client(client))
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    error = self.command(json.loads(line))
+                except (ValueError, TypeError, KeyError, AttributeError) as exc:
+                    error = f"Bad command {line.strip()[:80]!r}: {exc}"
+                client.send("status" if error is None else "error",
+                            self.status() if error is None else encode_message({"type": "error", "message": error}))
+        except (ConnectionError, asyncio.CancelledError):
+            # The viewer disconnected, or the server is shutting down
+            pass
+        finally:
+            sender.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await sender
+            self.clients.remove(client)
+            if not self.clients:
+                self.detach()
+            writer.close()
+
+    async def write_client(self, client):
+        # Write whatever is queued, waiting for the client to read when its buffer is full
+        try:
+            while True:
+                await client.ready.wait()
+                client.ready.clear()
+                while client.pending:
+                    client.writer.write(b"".join(data for kind, data in client.pending))
+                    client.pending.clear()
+                    await client.writer.drain()
+        except ConnectionError:
+            pass
+
+
+if __name__ == "__main__":
+    import Tomasulo
+    from Tomasulo import make_config, make_manager
+    from batch import load_program
+
+    parser = argparse.ArgumentParser(description="Serve a live simulation to GUI viewers (python GUI.py --connect ADDRESS)")
+    parser.add_argument("program", nargs="?", help="Program file, assembly source or binary (default: the demo)")
+    parser.add_argument("--init", nargs="*", default=None, help='Initial register values, e.g. "R1 80"')
+    parser.add_argument("--config", help="JSON file overriding parts of DEFAULT_CONFIG")
+    parser.add_argument("--listen", default="127.0.0.1:8765", help="Unix socket path or host:port")
+    parser.add_argument("--run", action="store_true", help="Start running instead of paused")
+    parser.add_argument("--rate", type=float, default=None, help="Limit the simulation to this many cycles per second")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+    if args.program:
+        program = load_program(args.program)
+        initial_values = program.initial_values + (args.init or [])
+    else:
+        program = Tomasulo.instructions
+        initial_values = args.init if args.init is not None else Tomasulo.initial_values
+    rs_manager = make_manager(make_config(config), initial_values)
+    rs_manager.add_instruction(program)
+    server = SimulationServer(rs_manager, running=args.run, rate=args.rate)
+    print(f"Serving on {args.listen}")
+    try:
+        asyncio.run(server.serve(args.listen))
+    except KeyboardInterrupt:
+        pass
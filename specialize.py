@@ -0,0 +1,485 @@
+# Program specialization for the "compiled" engine of run_simulation.
+#
+# The generated source of a program and machine is a bind function returning replacements for the
+# process_cycle, execute_cycle and quiet_cycles methods of its ReservationStationManager, with the stations
+# unrolled and the issue, operand read and write-back code of every instruction written out with its registers
+# and operation.
+# Machines with a reorder buffer, and cycles with event subscribers, keep using the generic code.
+
+import argparse
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import Tomasulo
+from Tomasulo import (BRANCH_CONDITIONS, BRANCH_OPCODES, MEMORY_OPCODES, Instruction, Opcode, ReservationStation,
+                      ReservationStationManager)
+
+# Changes to the generator or to any simulator module the generated code relies on invalidate every cached
+# specialization
+GENERATOR_HASH = Tomasulo.source_hash()
+
+# Longer programs are not specialized: compiling the generated source takes about half a millisecond and
+# a tenth of a megabyte per instruction
+MAX_INSTRUCTIONS = 1000
+
+# Cycles run side by side with the generic engine before a new specialization is cached on disk, and before
+# one that is only kept in this process is used
+VERIFY_CYCLES = 20000
+PROCESS_VERIFY_CYCLES = 1000
+
+# Sources and compiled code of the specializations most recently used by this process, by specialization_key
+# (each takes up to a tenth of a megabyte per instruction)
+PROCESS_CACHE_SIZE = 16
+_compiled = OrderedDict()
+
+# Result expression of each ALU opcode, in terms of the instruction's operands
+EXPRESSIONS = {
+    Opcode.ADD: "ins.Vj + ins.Vk", Opcode.DADDI: "ins.Vj + ins.Vk",
+    Opcode.SUB: "ins.Vj - ins.Vk", Opcode.DSUBI: "ins.Vj - ins.Vk",
+    Opcode.MUL: "ins.Vj * ins.Vk", Opcode.MULI: "ins.Vj * ins.Vk",
+    Opcode.DIV: "ins.Vj / ins.Vk", Opcode.DIVI: "ins.Vj / ins.Vk",
+}
+
+
+class SpecializationError(RuntimeError):
+    # The specialized code does not behave like the generic engine
+    pass
+
+
+def can_specialize(rs_manager):
+    return rs_manager.rob is None and len(rs_manager.program) <= MAX_INSTRUCTIONS
+
+
+def specialization_key(rs_manager):
+    # Hash of everything the generated source depends on
+    payload = {
+        "generator": GENERATOR_HASH,
+        "program": [(decoded.text, decoded.key()) for decoded in rs_manager.program],
+        "stations": [(station.name, sorted(station.op_types), station.execution_time)
+                     for station in rs_manager.station_list],
+        "widths": (rs_manager.issue_width, rs_manager.cdb_width),
+    }
+    return hashlib.sha256(json.dumps(payload).encode()).hexdigest()
+
+
+def generate_source(rs_manager):
+    # Python source of the specialized process_cycle, execute_cycle and quiet_cycles of rs_manager's program
+    # and machine
+    program = rs_manager.program
+    stations = rs_manager.station_list
+    # Module-level functions compile in time linear in the program; bind sets the globals they share
+    lines = [f"# Specialized cycle functions for {len(program)} instructions on {len(stations)} stations (specialize.py)"]
+
+    # Issue of each instruction: WAW check, free station, operand read and destination claim
+    for pc, decoded in enumerate(program):
+        candidates = [f"s{station.tag}" for station in stations if decoded.op in station.op_types]
+        lines += ["", f"def issue_{pc}():  # {decoded.text}"]
+        if decoded.dest_index is not None:
+            lines += [f"    if producers[{decoded.dest_index}] >= 0:", "        return None"]
+        if not candidates:
+            lines.append("    return None")
+            continue
+        for i, candidate in enumerate(candidates):
+            keyword = "if" if i == 0 else "elif"
+            lines += [f"    {keyword} not {candidate}.busy:", f"        station = {candidate}"]
+        lines += [
+            "    else:",
+            "        return None",
+            f"    ins = new_instruction(program[{pc}])",
+            f"    m.instruction_queue_index = {pc + 1}",
+            f"    ins.index = {pc + 1}",
+            "    station.instruction = ins",
+            "    station.stage = 'Issue'",
+            "    station.remaining_cycles = station.execution_time + 1",
+            "    station.issue_cycle = m.cycle",
+            "    station.sequence = m.issued_instructions",
+            "    m.issued_instructions += 1",
+        ]
+        waits = []
+        for slot, index, name in (("j", decoded.src1_index, decoded.src1), ("k", decoded.src2_index, decoded.src2)):
+            if index is None:
+                lines.append(f"    ins.Vk = {decoded.immediate!r}")
+                continue
+            lines += [
+                f"    tag = producers[{index}]",
+                "    if tag >= 0:",
+                "        producer = station_list[tag]",
+                f"        ins.V{slot} = {name!r}",
+                f"        ins.Q{slot} = producer.name",
+                f"        producer.consumers.append((station, {slot!r}))",
+                "    else:",
+                f"        ins.V{slot} = values[{index}]",
+            ]
+            waits.append(f"ins.Q{slot} is None")
+        if waits:
+            lines += [f"    if {' and '.join(waits)}:", "        m.ready_stations.append(station)"]
+        else:
+            lines.append("    m.ready_stations.append(station)")
+        if decoded.opcode in BRANCH_OPCODES:
+            lines.append("    m.branching_station = station")
+        elif decoded.dest_index is not None:
+            lines.append(f"    producers[{decoded.dest_index}] = station.tag")
+        lines += ["    station.busy = True", "    return station"]
+
+    # Whether each instruction could issue now, for quiet_cycles
+    for pc, decoded in enumerate(program):
+        candidates = [f"not s{station.tag}.busy" for station in stations if decoded.op in station.op_types]
+        condition = f"({' or '.join(candidates)})" if candidates else "False"
+        if decoded.dest_index is not None and candidates:
+            condition = f"producers[{decoded.dest_index}] < 0 and {condition}"
+        lines += ["", f"def can_issue_{pc}():", f"    return {condition}"]
+
+    # Write-back of each instruction; branches resolve in their station and never get here
+    for pc, decoded in enumerate(program):
+        if decoded.opcode in BRANCH_OPCODES:
+            continue
+        lines += ["", f"def write_{pc}(station, ins):  # {decoded.text}"]
+        if decoded.opcode == Opcode.STORE:
+            lines += ["    memory.store(ins.A, ins.Vj)", "    return None"]
+            continue
+        expression = "memory.load(ins.A)" if decoded.opcode == Opcode.LOAD else EXPRESSIONS[decoded.opcode]
+        lines += [
+            f"    result = {expression}",
+            f"    values[{decoded.dest_index}] = result",
+            f"    if producers[{decoded.dest_index}] == station.tag:",
+            f"        producers[{decoded.dest_index}] = -1",
+            "    return result",
+        ]
+
+    # Tables indexed by the 1-based index of an in-flight instruction
+    lines += [
+        "",
+        "issue_table = (" + "".join(f"issue_{pc}, " for pc in range(len(program))) + "lambda: None)",
+        "can_issue_table = (" + "".join(f"can_issue_{pc}, " for pc in range(len(program))) + "lambda: False)",
+        "write_table = (None, " + "".join("None, " if decoded.opcode in BRANCH_OPCODES else f"write_{pc}, "
+                                               for pc, decoded in enumerate(program)) + ")",
+        "memory_table = (False, " + "".join(f"{decoded.opcode in MEMORY_OPCODES}, " for decoded in program) + ")",
+    ]
+
+    lines += [
+        "",
+        "def issue():",
+        "    if m.branching_station:",
+        "        return None",
+        "    return issue_table[m.instruction_queue_index]()",
+        "",
+        "def execute_cycle():",
+        "    if m.hooks is not None:",
+        "        return generic_execute()",
+        "    m.cycle += 1",
+        "    issued = m.issued_instructions",
+        "    all_stations_idle = process_cycle()",
+        f"    if m.issued_instructions == issued and m.instruction_queue_index != {len(program)}:",
+        "        m.issue_stall_cycles += 1",
+        "    return all_stations_idle",
+        "",
+        "def process_cycle():",
+        "    if m.hooks is not None:",
+        "        return generic()",
+        "    write_stage = m.write_stage_stations",
+        "    if write_stage:",
+        "        for station in write_stage:",
+        "            ins = station.instruction",
+        "            result = write_table[ins.index](station, ins)",
+        "            for consumer, slot in station.consumers:",
+        "                waiting = consumer.instruction",
+        "                if slot == 'j':",
+        "                    waiting.Vj = result",
+        "                    waiting.Qj = None",
+        "                else:",
+        "                    waiting.Vk = result",
+        "                    waiting.Qk = None",
+        "                if waiting.Qj is None and waiting.Qk is None:",
+        "                    m.ready_stations.append(consumer)",
+        "            station.busy_cycles += m.cycle - station.issue_cycle",
+        "            station.reset()",
+        "        m.write_stage_stations = []",
+        "",
+        "    if m.ready_stations:",
+        "        waiting = []",
+        "        for station in m.ready_stations:",
+        "            ins = station.instruction",
+        "            if memory_table[ins.index]:",
+        "                if m.memory_conflict(station):",
+        "                    waiting.append(station)",
+        "                    continue",
+        "                ins.A = memory.check(m.memory_address(station))",
+        "            station.stage = 'Execute'",
+        "        m.ready_stations = waiting",
+        "",
+    ]
+    if rs_manager.issue_width > 1:
+        lines += [
+            "    if issue() is not None:",
+            f"        for _ in range({rs_manager.issue_width - 1}):",
+            "            if issue() is None:",
+            "                break",
+        ]
+    else:
+        lines.append("    issue()")
+    lines += ["", "    all_stations_idle = True", "    finished = []"]
+
+    for station in stations:
+        s = f"s{station.tag}"
+        lines += [
+            f"    # {station.name}",
+            f"    if {s}.instruction and {s}.stage == 'Execute':",
+            f"        if {s}.remaining_cycles > 1:",
+            f"            {s}.remaining_cycles -= 1",
+        ]
+        if not station.op_types & {opcode.name for opcode in BRANCH_OPCODES}:
+            lines += ["        else:", f"            finished.append({s})"]
+        else:
+            lines += [
+                "        else:",
+                f"            ins = {s}.instruction",
+                "            condition = branch_table[ins.index]",
+                "            if condition is None:",
+                f"                finished.append({s})",
+                "            else:",
+                "                # Resolve the branch once every older instruction has left its station",
+                "                queue_index = m.instruction_queue_index",
+                "                for other in station_list:",
+                "                    if other.busy and other.instruction.index < queue_index:",
+                "                        all_stations_idle = False",
+                "                        break",
+                "                if all_stations_idle:",
+                "                    m.branches += 1",
+                "                    if condition(ins.Vj):",
+                "                        m.branches_taken += 1",
+                "                        m.instruction_queue_index = ins.A",
+                "                    m.branching_station = None",
+                f"                    {s}.busy_cycles += m.cycle - {s}.issue_cycle",
+                f"                    {s}.reset()",
+                "                    # The rest of the cycle runs again, and may issue into stations already passed",
+                "                    if not process_cycle():",
+                "                        all_stations_idle = False",
+            ]
+        lines += [f"    if {s}.stage != 'Idle':", "        all_stations_idle = False"]
+    lines += [
+        "",
+        "    if finished:",
+        "        # Enough free buses for every finished station: no arbitration",
+        f"        if len(finished) > {rs_manager.cdb_width} - len(m.write_stage_stations):",
+        "            m.arbitrate(finished)",
+        "        else:",
+        "            write_stage = m.write_stage_stations",
+        "            for station in finished:",
+        "                if station.stage == 'Execute':",
+        "                    station.stage = 'Write'",
+        "                    station.remaining_cycles -= 1",
+        "                    write_stage.append(station)",
+        "                    m.last_granted = station.tag",
+        "    return all_stations_idle",
+        "",
+        "def quiet_cycles():",
+        "    if m.write_stage_stations or m.ready_stations:",
+        "        return 0",
+        "    if not m.branching_station and can_issue_table[m.instruction_queue_index]():",
+        "        return 0",
+        "    quiet = None",
+    ]
+    for station in stations:
+        s = f"s{station.tag}"
+        lines += [
+            f"    if {s}.stage == 'Execute':",
+            f"        remaining = {s}.remaining_cycles",
+            "        if remaining > 1:",
+            "            if quiet is None or remaining - 1 < quiet:",
+            "                quiet = remaining - 1",
+        ]
+        if not station.op_types & {opcode.name for opcode in BRANCH_OPCODES}:
+            lines += ["        else:", "            return 0"]
+        else:
+            lines += [
+                f"        elif branch_table[{s}.instruction.index] is None:",
+                "            return 0",
+                "        else:",
+                "            # A finished branch only waits while an older instruction still holds a station",
+                "            queue_index = m.instruction_queue_index",
+                "            for other in station_list:",
+                "                if other.busy and other.instruction.index < queue_index:",
+                "                    break",
+                "            else:",
+                "                return 0",
+            ]
+    lines += [
+        "    return quiet or 0",
+        "",
+        "",
+    ]
+    names = ["m", "values", "producers", "memory", "station_list", "program", "generic", "generic_execute",
+             "new_instruction", "branch_table"] + [f"s{tag}" for tag in range(len(stations))]
+    lines += [
+        "def bind(manager, generic_process_cycle, generic_execute_cycle, instruction_factory, conditions):",
+        f"    global {', '.join(names)}",
+        "    m = manager",
+        "    values = m.register_values",
+        "    producers = m.register_producers",
+        "    memory = m.memory",
+        "    station_list = m.station_list",
+        "    program = m.program",
+        "    generic = generic_process_cycle",
+        "    generic_execute = generic_execute_cycle",
+        "    new_instruction = instruction_factory",
+        "    branch_table = (None, *conditions)",
+    ]
+    lines += [f"    s{tag} = station_list[{tag}]" for tag in range(len(stations))]
+    lines += [
+        "    return process_cycle, execute_cycle, quiet_cycles",
+        "",
+    ]
+    return "\n".join(lines)
+
+
+def install_code(rs_manager, code):
+    # Replace the cycle functions of rs_manager by those of compiled generated source, run in a namespace of
+    # their own; the generic methods stay reachable
+    namespace = {}
+    exec(code, namespace)
+    bind = namespace["bind"]
+    manager_type = type(rs_manager)
+    conditions = [BRANCH_CONDITIONS.get(decoded.opcode) for decoded in rs_manager.program]
+    (rs_manager.process_cycle, rs_manager.execute_cycle,
+     rs_manager.quiet_cycles) = bind(rs_manager, manager_type.process_cycle.__get__(rs_manager),
+                                     manager_type.execute_cycle.__get__(rs_manager), Instruction.from_decoded,
+                                     conditions)
+
+
+def uninstall(rs_manager):
+    # Go back to the generic cycle functions
+    for name in ("process_cycle", "execute_cycle", "quiet_cycles"):
+        rs_manager.__dict__.pop(name, None)
+
+
+def state_of(rs_manager):
+    # Everything compared between the two engines after each cycle
+    return (rs_manager.cycle, rs_manager.instruction_queue_index, rs_manager.issued_instructions,
+            rs_manager.issue_stall_cycles, rs_manager.branches, rs_manager.branches_taken, rs_manager.cdb_stall_cycles,
+            rs_manager.last_granted, [repr(value) for value in rs_manager.register_values],
+            list(rs_manager.register_producers), bytes(rs_manager.memory.data), bytes(rs_manager.memory.tags),
+            [(station.trace_fields(), station.busy, station.busy_cycles, station.sequence,
+              [(consumer.tag, slot) for consumer, slot in station.consumers])
+             for station in rs_manager.station_list],
+            [station.tag for station in rs_manager.ready_stations],
+            [station.tag for station in rs_manager.write_stage_stations],
+            rs_manager.branching_station.tag if rs_manager.branching_station is not None else -1)
+
+
+def verify(code, rs_manager, cycles=VERIFY_CYCLES):
+    # Run copies of rs_manager's initial state with the generic and the specialized process_cycle, comparing
+    # them after every cycle; raises SpecializationError at the first difference
+    from checkpoint import restore_checkpoint, save_checkpoint
+
+    state = save_checkpoint(rs_manager)
+    managers = []
+    for specialized in (False, True):
+        other = ReservationStationManager({}, {}, {}, (), rs_manager.memory.copy(), 0, None, rs_manager.issue_width,
+                                          rs_manager.cdb_width, rs_manager.arbitration)
+        # Same stations (names, operation types, latencies) as rs_manager
+        for station in rs_manager.station_list:
+            copy = ReservationStation(station.name, station.op_type, station.execution_time, station.op_types,
+                                      station.tag)
+            other.stations[station.name] = copy
+            other.station_list.append(copy)
+        other.registers.station_names = [station.name for station in other.station_list]
+        other.add_instruction(rs_manager.instruction_queue)
+        restore_checkpoint(other, state)
+        if specialized:
+            install_code(other, code)
+        managers.append(other)
+
+    generic, specialized = managers
+    for _ in range(cycles):
+        outcomes = []
+        for manager in managers:
+            try:
+                outcomes.append(("idle", manager.execute_cycle()))
+            except Exception as error:
+                outcomes.append(("error", repr(error)))
+        if outcomes[0] != outcomes[1] or state_of(generic) != state_of(specialized):
+            raise SpecializationError(f"Specialized code differs from the generic engine at cycle {generic.cycle}")
+        if outcomes[0][0] == "error" or generic.finished():
+            break
+
+
+def _write_source(path, source):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written under a temporary name first, so concurrent workers never read a partial file
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as file:
+        file.write(source)
+    os.replace(temporary, path)
+
+
+def specialize(rs_manager, cache_dir=None, check=True):
+    """
+    Replaces the cycle functions of rs_manager by code generated for its program and stations, and returns
+    whether it did (machines with a reorder buffer and very long programs keep the generic code).
+
+    The code is kept in this process under a hash of the program, the stations and the simulator, for the
+    PROCESS_CACHE_SIZE most recently used specializations, once it has run like the generic engine for up to
+    PROCESS_VERIFY_CYCLES cycles. Its source is also cached in cache_dir, if given, once it has run like the
+    generic engine for up to VERIFY_CYCLES cycles.
+
+    Args:
+    rs_manager: The reservation station manager object, with its instructions already added.
+    cache_dir: Directory of generated sources (e.g. ".specialize_cache"), or None (the default) to keep them
+               in this process only.
+    check: Whether a newly generated source is verified against the generic engine first.
+    """
+    if not can_specialize(rs_manager):
+        return False
+    key = specialization_key(rs_manager)
+    path = os.path.join(cache_dir, f"{key}.py") if cache_dir else None
+    source, code = _compiled.pop(key, (None, None))
+    if code is None and path and os.path.exists(path):
+        with open(path) as file:
+            source = file.read()
+        code = compile(source, path, "exec")
+    elif code is None:
+        source = generate_source(rs_manager)
+        code = compile(source, path or "<specialized>", "exec")
+        if check:
+            verify(code, rs_manager, VERIFY_CYCLES if path else PROCESS_VERIFY_CYCLES)
+        if path:
+            _write_source(path, source)
+    elif path and not os.path.exists(path):
+        # Generated by this process without a cache directory, so only verified over PROCESS_VERIFY_CYCLES
+        if check:
+            verify(code, rs_manager)
+        _write_source(path, source)
+    _compiled[key] = source, code
+    if len(_compiled) > PROCESS_CACHE_SIZE:
+        _compiled.popitem(last=False)
+    install_code(rs_manager, code)
+    return True
+
+
+if __name__ == "__main__":
+    from batch import load_program
+    from Tomasulo import make_config, make_manager
+
+    parser = argparse.ArgumentParser(description="Generate, verify and cache the specialized code of a program")
+    parser.add_argument("program", help="Program file, assembly source or assembled binary")
+    parser.add_argument("--init", nargs="*", default=[], help='Initial register values when verifying, e.g. "R1 80"')
+    parser.add_argument("--config", help="JSON file overriding parts of DEFAULT_CONFIG")
+    parser.add_argument("--cache-dir", default=".specialize_cache")
+    parser.add_argument("--print", action="store_true", help="Print the generated source")
+    args = parser.parse_args()
+
+    config = None
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+    program = load_program(args.program)
+    rs_manager = make_manager(make_config(config), program.initial_values + args.init)
+    rs_manager.add_instruction(program)
+    if args.print:
+        print(generate_source(rs_manager))
+    elif specialize(rs_manager, args.cache_dir):
+        print(f"Specialized code cached in {args.cache_dir}/{specialization_key(rs_manager)}.py")
+    else:
+        print("This machine is not specialized (reorder buffer or program too long)")
@@ -0,0 +1,131 @@
+# Reorder buffer and branch predictors used when the simulator issues past unresolved branches
+
+
+# One in-flight instruction, in program order
+class ReorderBufferEntry:
+    __slots__ = ("tag", "sequence", "opcode", "pc", "dest_index", "station", "value", "address", "done", "error",
+                 "predicted_taken", "taken")
+
+    def __init__(self, tag):
+        self.tag = tag                # Slot of the entry, used as the producer tag of its destination register
+        self.sequence = 0             # Issue order of the instruction
+        self.opcode = None
+        self.pc = 0                   # Index of the instruction in the program
+        self.dest_index = None        # Register written at commit, if any
+        self.station = None           # Station executing the instruction until its write-back
+        self.value = None             # Result (or the value a STORE writes)
+        self.address = None           # Effective address of a LOAD or STORE
+        self.done = False             # Whether the result is available
+        self.error = None             # Exception raised while executing speculatively, re-raised at commit
+        self.predicted_taken = False  # Branch direction the front end followed
+        self.taken = False            # Branch direction once resolved
+
+
+class ReorderBuffer:
+    """
+    Circular buffer of ReorderBufferEntry objects; instructions enter at issue and leave at commit, oldest first.
+    """
+
+    def __init__(self, size):
+        if size < 1:
+            raise ValueError(f"Reorder buffer size must be positive, got {size}")
+        self.size = size
+        self.entries = [ReorderBufferEntry(tag) for tag in range(size)]
+        self.head = 0                 # Slot of the oldest entry
+        self.count = 0                # Number of entries in use
+
+    def full(self):
+        return self.count == self.size
+
+    def allocate(self):
+        # Claim the slot after the youngest entry
+        entry = self.entries[(self.head + self.count) % self.size]
+        self.count += 1
+        entry.station = None
+        entry.value = None
+        entry.address = None
+        entry.done = False
+        entry.error = None
+        return entry
+
+    def oldest(self):
+        return self.entries[self.head] if self.count else None
+
+    def retire(self):
+        # Remove the oldest entry
+        self.head = (self.head + 1) % self.size
+        self.count -= 1
+
+    def squash_after(self, sequence):
+        # Remove every entry issued after `sequence` and return how many were removed
+        removed = 0
+        while self.count and self.entries[(self.head + self.count - 1) % self.size].sequence > sequence:
+            self.count -= 1
+            removed += 1
+        return removed
+
+    def __iter__(self):
+        # Entries from oldest to youngest
+        for i in range(self.count):
+            yield self.entries[(self.head + i) % self.size]
+
+    def __len__(self):
+        return self.count
+
+
+# Predicts every conditional branch taken
+class StaticTakenPredictor:
+    def __init__(self, bits=0):
+        pass
+
+    def predict(self, pc):
+        return True
+
+    def update(self, pc, taken):
+        pass
+
+
+# Table of 2-bit saturating counters indexed by the low bits of the branch address
+class TwoBitPredictor:
+    def __init__(self, bits=10):
+        self.mask = (1 << bits) - 1
+        self.counters = bytearray([2]) * (1 << bits)  # Every counter starts weakly taken
+
+    def slot(self, pc):
+        return pc & self.mask
+
+    def predict(self, pc):
+        return self.counters[self.slot(pc)] >= 2
+
+    def update(self, pc, taken):
+        slot = self.slot(pc)
+        counter = self.counters[slot]
+        if taken:
+            self.counters[slot] = min(counter + 1, 3)
+        else:
+            self.counters[slot] = max(counter - 1, 0)
+
+
+# 2-bit counters indexed by the branch address XOR the global history of committed branch outcomes
+class GsharePredictor(TwoBitPredictor):
+    def __init__(self, bits=10):
+        super().__init__(bits)
+        self.history = 0
+
+    def slot(self, pc):
+        return (pc ^ self.history) & self.mask
+
+    def update(self, pc, taken):
+        super().update(pc, taken)
+        self.history = ((self.history << 1) | bool(taken)) & self.mask
+
+
+PREDICTORS = {"taken": StaticTakenPredictor, "2bit": TwoBitPredictor, "gshare": GsharePredictor}
+
+
+def make_predictor(name, bits=10):
+    # Create a predictor by its configuration name
+    try:
+        return PREDICTORS[name](bits)
+    except KeyError:
+        raise ValueError(f"Unknown branch predictor {name!r} (expected one of {', '.join(PREDICTORS)})") from None
@@ -0,0 +1,179 @@
+import argparse
+import copy
+import csv
+import functools
+import hashlib
+import itertools
+import json
+import os
+
+import Tomasulo
+from Tomasulo import decode_program, make_config
+from batch import load_program, run_batch
+
+# Changes to any simulator module invalidate every cached result
+SIMULATOR_HASH = Tomasulo.source_hash()
+
+
+@functools.lru_cache(maxsize=None)
+def _file_digest(path, size, mtime_ns):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_digest(path):
+    # SHA-256 of a file's contents, hashed again only when its size or modification time changes
+    stat = os.stat(path)
+    return _file_digest(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def cache_key(program, config, initial_values):
+    # Hash of (decoded program, full configuration, memory file contents, initial values) identifying one simulation
+    config = make_config(config)
+    memory_file = config["memory"].get("file")
+    payload = {
+        "simulator": SIMULATOR_HASH,
+        "program": [decoded.key() for decoded in decode_program(program)],
+        "config": config,
+        "memory_file": file_digest(memory_file) if memory_file else None,
+        "initial_values": list(initial_values),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def set_parameter(config, path, value):
+    # Set a dotted parameter such as "execution_times.DIV" in a configuration
+    section, key = path.split(".", 1)
+    if section not in config:
+        raise ValueError(f"Unknown configuration section {section!r} in {path!r}")
+    config[section][key] = value
+
+
+def grid_points(axes):
+    # Cartesian product of the axes, as dictionaries {parameter: value}
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*(list(axes[name]) for name in names))]
+
+
+def flatten_result(point, result):
+    # One output row: the swept parameters followed by the counters of the run
+    row = dict(point)
+    row["cycles"] = result["cycles"]
+    stats = result["stats"]
+    for key, value in stats.items():
+        if key == "station_utilization":
+            for op_type, utilization in value.items():
+                row[f"utilization_{op_type}"] = utilization
+        else:
+            row[key] = value
+    return row
+
+
+def run_sweep(program, axes, base_config=None, initial_values=(), cache_dir=None, engine="skip",
+              max_cycles=None, processes=None, specialize_cache_dir=None):
+    """
+    Simulates a program at every point of a parameter grid and returns one row (dict) per point, in grid order.
+
+    Args:
+    program: List of instruction strings.
+    axes: Dictionary mapping dotted parameters (e.g. "station_counts.ADD") to the values to try.
+    base_config: Configuration the swept parameters are applied to (defaults to DEFAULT_CONFIG).
+    initial_values: Initial register values, as strings like "R1 80".
+    cache_dir: Directory of memoized results (e.g. ".sweep_cache"), or None (the default) to disable caching.
+    engine: "step", "skip", "memo" or "compiled" (all give the same results).
+    max_cycles: Raise RuntimeError if a point has not finished after this many cycles.
+    processes: Number of worker processes (defaults to the number of CPUs).
+    specialize_cache_dir: Directory where the "compiled" engine caches generated code (e.g. ".specialize_cache"),
+                          shared by the workers, or None (the default) to keep it in each worker only.
+    """
+    points = grid_points(axes)
+    configs = []
+    for point in points:
+        config = copy.deepcopy(make_config(base_config))
+        for path, value in point.items():
+            set_parameter(config, path, value)
+        configs.append(config)
+
+    results = [None] * len(points)
+    keys = [cache_key(program, config, initial_values) for config in configs]
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        for i, key in enumerate(keys):
+            path = os.path.join(cache_dir, f"{key}.json")
+            if os.path.exists(path):
+                with open(path) as file:
+                    results[i] = json.load(file)
+
+    # Only the points missing from the cache are simulated
+    missing = [i for i, result in enumerate(results) if result is None]
+    jobs = [(program, configs[i], initial_values, engine, max_cycles, False, specialize_cache_dir) for i in missing]
+    for i, result in zip(missing, run_batch(jobs, processes)):
+        results[i] = result.as_dict()
+        if cache_dir:
+            # Written under a temporary name first, so concurrent sweeps never read a partial file
+            path = os.path.join(cache_dir, f"{keys[i]}.json")
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "w") as file:
+                json.dump(results[i], file)
+            os.replace(temporary, path)
+
+    return [flatten_result(point, result) for point, result in zip(points, results)]
+
+
+def write_table(rows, path):
+    # Write sweep rows as CSV, or as Parquet when the path ends in .parquet (requires pyarrow)
+    if path.endswith(".parquet"):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Writing Parquet output requires pyarrow (pip install pyarrow)") from None
+        pyarrow.parquet.write_table(pyarrow.Table.from_pylist(rows), path)
+        return
+
+    fieldnames = []
+    for row in rows:
+        fieldnames += [key for key in row if key not in fieldnames]
+    with open(path, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def parse_axis(text):
+    # "execution_times.DIV=10:80:10" (inclusive range) or "station_counts.ADD=1,2,4"
+    path, values = text.split("=", 1)
+    if ":" in values:
+        bounds = [int(value) for value in values.split(":")]
+        start, stop = bounds[0], bounds[1]
+        step = bounds[2] if len(bounds) > 2 else 1
+        return path, range(start, stop + 1, step)
+    return path, [int(value) for value in values.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate a program over a grid of machine configurations")
+    parser.add_argument("program", help="Program file, assembly source or assembled binary")
+    parser.add_argument("--axis", action="append", default=[], required=True,
+                        help='Swept parameter, e.g. "station_counts.ADD=1:8" or "execution_times.MUL=1,5,10"')
+    parser.add_argument("--init", nargs="*", default=[], help='Initial register values, e.g. "R1 80"')
+    parser.add_argument("--output", default="sweep.csv", help="Output table (.csv or .parquet)")
+    parser.add_argument("--engine", default="skip", choices=["step", "skip", "memo", "compiled"])
+    parser.add_argument("--cache-dir", default=".sweep_cache")
+    parser.add_argument("--specialize-cache-dir", default=".specialize_cache",
+                        help="Where the compiled engine caches generated code")
+    parser.add_argument("--no-cache", action="store_true", help="Cache neither results nor generated code")
+    parser.add_argument("--max-cycles", type=int, default=None)
+    parser.add_argument("--processes", type=int, default=None)
+    args = parser.parse_args()
+
+    axes = dict(parse_axis(axis) for axis in args.axis)
+    program = load_program(args.program)
+    rows = run_sweep(program, axes, None, program.initial_values + args.init,
+                     None if args.no_cache else args.cache_dir, args.engine, args.max_cycles, args.processes,
+                     None if args.no_cache else args.specialize_cache_dir)
+    write_table(rows, args.output)
+    print(f"Wrote {len(rows)} points to {args.output}")
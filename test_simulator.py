@@ -0,0 +1,748 @@
+import asyncio
+import json
+import os
+import pickle
+import socket
+import threading
+import zlib
+from collections import OrderedDict
+
+import pytest
+
+import batch
+import checkpoint
+import cyclelog
+import lanes
+import specialize
+import sweep
+from assembler import open_program
+from events import (BranchResolvedEvent, CommitEvent, CycleEndEvent, ExecuteStartEvent, OperandCaptureEvent,
+                    SquashEvent, WriteBackEvent)
+from checkpoint import restore_checkpoint, run_to_cycle, save_checkpoint
+from functional import FunctionalSimulator, measure_window, sample, verify
+from simserver import FINISHED, MAX_PENDING, Client, SimulationServer, encode_message, manager_state
+from tracefile import TraceReader, TraceWriter, export_text
+import Tomasulo
+from Tomasulo import collect_stats, execution_times, make_config, make_manager, run_simulation, simulate
+
+# A loop followed by a short tail: the tail issues in the cycle the loop's last branch resolves
+LOOP_TAIL = ["DADDI R10, I0, #1", "DSUBI R10, R10, #1", "BNEQZ R10, 1", "ADD R9, R1, R10", "STORE M56, R9, X"]
+
+# Loop programs with their initial values, run on each configuration of PIPELINE_CONFIGS
+LOOP_PROGRAMS = [
+    (["DADDI R10, I0, #3", "DSUBI R10, R10, #1", "BNEQZ R10, 1", "STORE M8, R1, X"], ["R1 7"]),
+    (LOOP_TAIL, ["R1 5"]),
+    (["DADDI R10, I0, #4", "ADD R2, R2, R1", "MUL R3, R2, R1", "DIV R4, R3, R1", "STORE M16, R4, X",
+      "LOAD R5, M16, X", "ADD R6, R6, R5", "DSUBI R10, R10, #1", "BNEQZ R10, 1", "STORE M24, R6, X"],
+     ["R1 2", "R2 1"]),
+    (["DADDI R10, I0, #3", "DADDI R11, I0, #2", "ADD R1, R1, R2", "DSUBI R11, R11, #1", "BNEQZ R11, 2",
+      "DSUBI R10, R10, #1", "BNEQZ R10, 1", "STORE M0, R1, X"], ["R2 3"]),
+]
+
+PIPELINE_CONFIGS = [
+    {},
+    {"pipeline": {"issue_width": 2}},
+    {"pipeline": {"issue_width": 4, "cdb_width": 2}},
+    {"pipeline": {"issue_width": 2, "arbitration": "longest_latency"}},
+    {"pipeline": {"issue_width": 2, "cdb_width": 2, "arbitration": "round_robin"}},
+    {"rob": {"size": 8}},
+    {"rob": {"size": 16, "predictor": "gshare"}, "pipeline": {"issue_width": 2, "cdb_width": 2}},
+    {"rob": {"size": 4, "predictor": "taken"},
+     "station_counts": {"ADD": 1, "MUL": 1, "DIV": 1, "STORE": 1, "BRANCH": 1}},
+]
+
+ENGINES = ["step", "skip", "memo", "compiled"]
+
+# Every test program finishes well within this many cycles; a run that does not has hung
+MAX_CYCLES = 10 ** 5
+
+
+def _config_id(config):
+    return ",".join(f"{key}={value}" for section in config.values() for key, value in section.items()) or "default"
+
+
+@pytest.mark.parametrize("issue_width", [1, 2, 4])
+@pytest.mark.parametrize("engine", ["step", "skip", "memo"])
+def test_tail_after_loop_completes(issue_width, engine):
+    config = {"pipeline": {"issue_width": issue_width}}
+    result, mismatches = verify(LOOP_TAIL, config, ["R1 5"], engine)
+    assert mismatches == {}
+    assert result.registers["R9"] == 5 and result.registers["M56"] == 5
+
+
+@pytest.mark.parametrize("issue_width", [1, 2])
+def test_tail_after_loop_completes_when_stepped(issue_width):
+    config = make_config({"pipeline": {"issue_width": issue_width}})
+    expected = simulate(LOOP_TAIL, config, ["R1 5"]).cycles
+
+    rs_manager = make_manager(config, ["R1 5"])
+    rs_manager.add_instruction(LOOP_TAIL)
+    assert run_to_cycle(rs_manager, 10 ** 6) == expected
+    assert rs_manager.finished()
+
+    rs_manager = make_manager(config, ["R1 5"])
+    rs_manager.add_instruction(LOOP_TAIL)
+    assert measure_window(rs_manager, 100)[1] == 5
+    assert rs_manager.finished()
+
+
+class _Crafted:
+    def __reduce__(self):
+        return os.system, ("echo crafted",)
+
+
+def test_crafted_checkpoint_is_refused():
+    rs_manager = make_manager(make_config(), ["R1 5"])
+    rs_manager.add_instruction(LOOP_TAIL)
+    data = checkpoint._header.pack(checkpoint.MAGIC, checkpoint.VERSION) + zlib.compress(pickle.dumps(_Crafted()))
+    with pytest.raises(pickle.UnpicklingError):
+        checkpoint.restore_checkpoint(rs_manager, data)
+
+
+def test_lanes_report_a_detailed_mismatch_per_lane(monkeypatch):
+    pytest.importorskip("numpy")
+    inputs = [["R1 5"], ["R1 6"], ["R1 7"]]
+    config = {"pipeline": {"issue_width": 2}}
+    results = lanes.simulate_lanes(LOOP_TAIL, inputs, config)
+    assert results.errors == [None, None, None]
+    assert [results[lane].registers["M56"] for lane in range(3)] == [5, 6, 7]
+
+    # A detailed simulation that disagrees for the lane timing the others fails that lane only
+    def simulate(program, config, initial_values, *args):
+        result = lanes_simulate(program, config, initial_values, *args)
+        if initial_values == ["R1 5"]:
+            result.registers["R9"] += 1
+        return result
+
+    lanes_simulate = lanes.simulate
+    monkeypatch.setattr(lanes, "simulate", simulate)
+    mismatched = lanes.simulate_lanes(LOOP_TAIL, inputs, config)
+    assert isinstance(mismatched.errors[0], RuntimeError) and mismatched.cycles[0] is None
+    assert mismatched.errors[1:] == [None, None]
+    assert mismatched.cycles[1:] == results.cycles[1:]
+
+
+@pytest.mark.parametrize("program, initial_values", LOOP_PROGRAMS, ids=range(len(LOOP_PROGRAMS)))
+def test_pipeline_configs_agree_on_results(program, initial_values):
+    expected = simulate(program, None, initial_values, max_cycles=MAX_CYCLES).registers
+    for config in PIPELINE_CONFIGS[1:]:
+        assert simulate(program, config, initial_values, max_cycles=MAX_CYCLES).registers == expected, config
+
+
+def test_countdown_loop_stores_its_input():
+    program, initial_values = LOOP_PROGRAMS[0]
+    for config in PIPELINE_CONFIGS:
+        assert simulate(program, config, initial_values, max_cycles=MAX_CYCLES).registers["M8"] == 7
+
+
+def test_wider_cdb_removes_write_back_stalls():
+    # Both ADDs and both MULs finish together; one bus makes one of each pair wait
+    program = ["ADD R1, R2, R3", "ADD R4, R2, R3", "MUL R5, R2, R3", "MUL R6, R2, R3"]
+    narrow = simulate(program, {"pipeline": {"issue_width": 4}}, ["R2 1", "R3 2"])
+    wide = simulate(program, {"pipeline": {"issue_width": 4, "cdb_width": 2}}, ["R2 1", "R3 2"])
+    assert narrow.stats["cdb_stall_cycles"] > 0 and wide.stats["cdb_stall_cycles"] == 0
+    assert wide.cycles < narrow.cycles
+    assert wide.registers == narrow.registers
+
+
+@pytest.mark.parametrize("config", PIPELINE_CONFIGS, ids=_config_id)
+@pytest.mark.parametrize("program, initial_values", LOOP_PROGRAMS, ids=range(len(LOOP_PROGRAMS)))
+def test_loop_programs_match_the_functional_model(program, initial_values, config):
+    result, mismatches = verify(program, config, initial_values, max_cycles=MAX_CYCLES)
+    assert mismatches == {}
+
+
+@pytest.mark.parametrize("config", PIPELINE_CONFIGS, ids=_config_id)
+@pytest.mark.parametrize("program, initial_values", LOOP_PROGRAMS, ids=range(len(LOOP_PROGRAMS)))
+def test_engines_agree(program, initial_values, config):
+    expected = simulate(program, config, initial_values, max_cycles=MAX_CYCLES).as_dict()
+    for engine in ENGINES[1:]:
+        assert simulate(program, config, initial_values, engine, MAX_CYCLES).as_dict() == expected, engine
+
+
+# Enough load/store stations for every access, and a slow MUL to wait on
+SLOW_MUL = {"station_counts": dict(Tomasulo.DEFAULT_CONFIG["station_counts"], STORE=4),
+            "execution_times": dict(Tomasulo.DEFAULT_CONFIG["execution_times"], MUL=10)}
+MEMORY_CONFIGS = [dict(SLOW_MUL, **config) for config in ({}, {"pipeline": {"issue_width": 2}}, {"rob": {"size": 8}})]
+MEMORY_CONFIG_IDS = ["in_order", "issue_width=2", "rob"]
+
+
+def _memory_accesses(program, config):
+    # Cycle each instruction starts executing and cycle it writes back, by sequence; R3 = 4, so R3 * R3 = 16
+    result, mismatches = verify(program, config, ["R3 4"])
+    assert mismatches == {}
+    rs_manager = make_manager(make_config(config), ["R3 4"])
+    rs_manager.add_instruction(program)
+    events = []
+    rs_manager.subscribe(events.append, ExecuteStartEvent, WriteBackEvent)
+    run_simulation(rs_manager, trace=False)
+    starts = {event.sequence: event.cycle for event in events if isinstance(event, ExecuteStartEvent)}
+    written = {event.sequence: event.cycle for event in events if isinstance(event, WriteBackEvent)}
+    return result.registers, starts, written
+
+
+@pytest.mark.parametrize("config", MEMORY_CONFIGS, ids=MEMORY_CONFIG_IDS)
+def test_load_waits_for_an_older_store_to_its_address(config):
+    # Memory word i starts out holding i
+    registers, starts, written = _memory_accesses(
+        ["MUL R1, R3, R3", "STORE M16, R1, X", "LOAD R2, M16, X", "LOAD R4, M24, X"], config)
+    assert starts[2] >= written[1] and registers["R2"] == 16
+    # A load of another address bypasses the store still waiting for its data
+    assert starts[3] < written[0] and registers["R4"] == 3
+
+
+@pytest.mark.parametrize("config", MEMORY_CONFIGS, ids=MEMORY_CONFIG_IDS)
+def test_accesses_wait_for_an_older_unknown_address(config):
+    registers, starts, written = _memory_accesses(
+        ["MUL R4, R3, R3", "STORE 8(R4), R3", "LOAD R2, M32, X"], config)
+    assert starts[2] >= written[0] and registers["M24"] == 4 and registers["R2"] == 4
+    # A store waits for an older load whose address is unknown, which still reads the old value
+    registers, starts, written = _memory_accesses(["MUL R4, R3, R3", "LOAD R2, 0(R4)", "STORE M16, R3, X"], config)
+    assert starts[2] >= written[0] and registers["R2"] == 2 and registers["M16"] == 4
+
+
+def _finish(rs_manager):
+    # Run a manager to the end; returns what simulate would report, bar the named memory words
+    cycles = run_simulation(rs_manager, trace=False, max_cycles=MAX_CYCLES)
+    return cycles, list(rs_manager.register_values), collect_stats(rs_manager, cycles)
+
+
+def _state(data):
+    return pickle.loads(zlib.decompress(data[checkpoint._header.size:]))
+
+
+@pytest.mark.parametrize("config", [{}, {"pipeline": {"issue_width": 2, "cdb_width": 2}}, {"rob": {"size": 8}}],
+                         ids=_config_id)
+@pytest.mark.parametrize("cycle", [1, 7, 20, 45])
+def test_checkpoint_round_trip(config, cycle):
+    program, initial_values = LOOP_PROGRAMS[2]
+    config = make_config(config)
+
+    original = make_manager(config, initial_values)
+    original.add_instruction(program)
+    run_to_cycle(original, cycle)
+    data = save_checkpoint(original)
+
+    restored = make_manager(config, initial_values)
+    restored.add_instruction(program)
+    restore_checkpoint(restored, data)
+    assert _state(save_checkpoint(restored)) == _state(data)
+    assert _finish(restored) == _finish(original)
+
+
+def test_checkpoint_of_another_program_is_refused():
+    config = make_config()
+    rs_manager = make_manager(config, ["R1 5"])
+    rs_manager.add_instruction(LOOP_TAIL)
+    data = save_checkpoint(rs_manager)
+
+    other = make_manager(config, ["R1 7"])
+    other.add_instruction(LOOP_PROGRAMS[0][0])
+    with pytest.raises(ValueError):
+        restore_checkpoint(other, data)
+
+
+@pytest.mark.parametrize("config", PIPELINE_CONFIGS, ids=_config_id)
+@pytest.mark.parametrize("program, initial_values", LOOP_PROGRAMS, ids=range(len(LOOP_PROGRAMS)))
+def test_compiled_engine_caches_its_code_on_disk(program, initial_values, config, tmp_path):
+    expected = simulate(program, config, initial_values, max_cycles=MAX_CYCLES).as_dict()
+    # The first run writes the generated code, the second loads it back
+    for _ in range(2):
+        result = simulate(program, config, initial_values, "compiled", MAX_CYCLES, cache_dir=str(tmp_path))
+        assert result.as_dict() == expected
+    # Machines with a reorder buffer run on the skip engine and cache nothing
+    assert bool(os.listdir(tmp_path)) == ("rob" not in config)
+
+
+
+def test_compiled_engine_generates_its_code_once_per_process(monkeypatch, tmp_path):
+    generated = []
+    generate_source = specialize.generate_source
+
+    def counting_generate_source(rs_manager):
+        generated.append(rs_manager)
+        return generate_source(rs_manager)
+
+    monkeypatch.setattr(specialize, "generate_source", counting_generate_source)
+    monkeypatch.setattr(specialize, "_compiled", OrderedDict())
+    results = [simulate(LOOP_TAIL, None, ["R1 5"], "compiled").as_dict() for _ in range(3)]
+    assert len(generated) == 1 and results == results[:1] * 3
+    # A cache directory given later receives the code generated earlier
+    assert simulate(LOOP_TAIL, None, ["R1 5"], "compiled", cache_dir=str(tmp_path)).as_dict() == results[0]
+    assert len(generated) == 1 and len(os.listdir(tmp_path)) == 1
+
+    # Only the most recently used specializations are kept
+    monkeypatch.setattr(specialize, "PROCESS_CACHE_SIZE", 2)
+    for value in range(1, 5):
+        simulate(LOOP_TAIL, {"execution_times": dict(execution_times, ADD=value)}, ["R1 5"], "compiled")
+    assert len(specialize._compiled) == 2
+
+
+ASSEMBLY_SOURCE = """\
+; Sum of a countdown, with labels, directives and comments
+        .data
+        .reg R1, 4
+        .word 8, 10, 20
+        .text
+start:  LOAD R2, M8, X        // first word
+        DADDI R10, I0, #3
+loop:
+        ADD R2, R2, R1        # accumulate
+        DSUBI R10, R10, #1
+        BNEQZ R10, loop
+        BEQZ R10, done
+        ADD R2, R2, R2
+done:   STORE M16, R2, X
+"""
+
+ASSEMBLED_PROGRAM = ["LOAD R2, M8, X", "DADDI R10, I0, #3", "ADD R2, R2, R1", "DSUBI R10, R10, #1",
+                     "BNEQZ R10, 2", "BEQZ R10, 7", "ADD R2, R2, R2", "STORE M16, R2, X"]
+
+
+def test_assembler_round_trip(tmp_path):
+    path = tmp_path / "sum.s"
+    path.write_text(ASSEMBLY_SOURCE)
+    program = open_program(str(path))
+    try:
+        assert list(program) == ASSEMBLED_PROGRAM
+        assert program.initial_values == ["R1 4", "M8 10", "M16 20"]
+        for engine in ENGINES:
+            assembled = simulate(program, None, program.initial_values, engine)
+            listed = simulate(ASSEMBLED_PROGRAM, None, program.initial_values, engine)
+            assert assembled.as_dict() == listed.as_dict()
+        assert assembled.registers["M16"] == 22
+    finally:
+        program.close()
+
+
+def test_trace_header_names_base_registers(tmp_path):
+    config = make_config()
+    rs_manager = make_manager(config, ["R3 8", "R4 16", "R5 3"])
+    rs_manager.add_instruction(["LOAD R2, 16(R3)", "STORE 8(R4), R5", "STORE M40, R2, X"])
+    run_simulation(rs_manager, base_file_name=str(tmp_path / "log"))
+    log = cyclelog.TraceCycleLog(str(tmp_path / "log.trc"))
+    try:
+        assert log.integer_registers_used == {"R2", "R3", "R4", "R5"}
+        assert log.mem_registers_used == {"M40"}
+    finally:
+        log.close()
+
+
+def test_empty_text_log_has_no_cycles(tmp_path):
+    path = tmp_path / "log.txt"
+    path.write_text("")
+    log = cyclelog.open_cycle_log(str(path))
+    try:
+        assert len(log) == 0 and 0 not in log
+    finally:
+        log.close()
+
+
+def _serve_messages(messages, close):
+    # Address of a one-client server sending `messages`, then closing the connection or waiting for the client to
+    listener = socket.create_server(("127.0.0.1", 0))
+
+    def serve():
+        connection, _ = listener.accept()
+        with listener, connection:
+            connection.sendall(b"".join(encode_message(message) for message in messages))
+            if not close:
+                connection.recv(1)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return f"127.0.0.1:{listener.getsockname()[1]}"
+
+
+HELLO = [{"type": "hello", "stations": [], "registers": ["R1"], "used_registers": ["R1"]},
+         {"type": "keyframe", "cycle": 0, "stations": [], "registers": [5]}]
+
+
+@pytest.mark.parametrize("close", [False, True])
+def test_live_log_reports_a_message_it_cannot_handle(close):
+    log = cyclelog.LiveCycleLog(_serve_messages(HELLO + [{"type": "delta", "cycle": 1, "stations": [],
+                                                          "registers": [[7, 6]]}], close))
+    try:
+        log.thread.join(5)
+        assert not log.connected and "IndexError" in log.error
+        assert log[0]["register_values"] == ["R1, 5"]
+    finally:
+        log.close()
+
+
+def test_live_log_disconnects_quietly_when_the_server_closes():
+    log = cyclelog.LiveCycleLog(_serve_messages(HELLO, True))
+    try:
+        log.thread.join(5)
+        assert not log.connected and log.error is None
+    finally:
+        log.close()
+
+
+def test_sweep_cache_hits_misses_and_invalidation(tmp_path, monkeypatch):
+    memory_file = tmp_path / "memory.bin"
+    memory_file.write_bytes(bytes(256))
+    base_config = {"memory": {"file": str(memory_file)}}
+    cache_dir = tmp_path / "cache"
+    simulated = []
+
+    def run_batch(jobs, processes=None):
+        simulated.append(len(jobs))
+        return batch.run_batch(jobs, 1)
+
+    def run(values):
+        return sweep.run_sweep(["LOAD R2, M8, X", "MUL R3, R2, R2"], {"execution_times.MUL": values}, base_config,
+                               cache_dir=str(cache_dir))
+
+    monkeypatch.setattr(sweep, "run_batch", run_batch)
+    rows = run([2, 4])
+    assert simulated == [2] and rows[1]["cycles"] == rows[0]["cycles"] + 2
+    assert run([2, 4]) == rows and simulated[-1] == 0
+    assert run([4, 6])[0] == rows[1] and simulated[-1] == 1
+    # New memory contents of the same size; the modification time moves on, as a later write would make it
+    modified = memory_file.stat().st_mtime_ns
+    memory_file.write_bytes(bytes([1]) * 256)
+    os.utime(memory_file, ns=(modified + 10 ** 9, modified + 10 ** 9))
+    assert run([2, 4]) == rows and simulated[-1] == 2
+    monkeypatch.setattr(sweep, "SIMULATOR_HASH", "changed")
+    run([2])
+    assert simulated[-1] == 1
+    assert sorted(name.rsplit(".", 1)[1] for name in os.listdir(cache_dir)) == ["json"] * 6
+
+
+SERVED_PROGRAM = ["DADDI R10, I0, #100", "ADD R2, R2, R1", "DSUBI R10, R10, #1", "BNEQZ R10, 1", "STORE M8, R2, X"]
+
+
+def _served_manager():
+    rs_manager = make_manager(make_config(), ["R1 3"])
+    rs_manager.add_instruction(SERVED_PROGRAM)
+    return rs_manager
+
+
+def _final_state():
+    rs_manager = _served_manager()
+    run_simulation(rs_manager, trace=False)
+    # As a viewer receives it
+    return json.loads(json.dumps(manager_state(rs_manager, list(rs_manager.stations.values()),
+                                               rs_manager.named_memory_words())))
+
+
+def _replay(messages):
+    # Final (stations, registers) seen by a viewer applying the messages it received, as LiveCycleLog does
+    stations = registers = None
+    for message in messages:
+        if message["type"] == "keyframe":
+            stations, registers = message["stations"], message["registers"]
+        elif message["type"] == "delta":
+            for i, value in message["registers"]:
+                registers[i] = value
+            for i, changes in message["stations"]:
+                for bit, value in changes:
+                    stations[i][bit] = value
+    return stations, registers
+
+
+def test_server_replaces_the_deltas_of_a_viewer_that_falls_behind():
+    # A viewer that never reads: its queue is bounded, statuses survive and it still ends on the final state
+    server = SimulationServer(_served_manager())
+    client = Client(None, None)
+    server.attach()
+    server.last_state = manager_state(server.rs_manager, server.stations, server.memory_addresses)
+    server.clients.append(client)
+    client.send("keyframe", server.keyframe(server.last_state))
+    assert server.command({"command": "run"}) is None
+    longest = 0
+    while server.state != FINISHED:
+        server.advance()
+        longest = max(longest, len(client.pending))
+    assert server.rs_manager.cycle > MAX_PENDING and longest <= MAX_PENDING
+    assert client.dropped > 0
+    messages = [json.loads(data) for kind, data in client.pending]
+    assert [message["type"] for message in messages].count("keyframe") == 1
+    assert [message["state"] for message in messages if message["type"] == "status"] == ["running", FINISHED]
+    # Each delta follows the keyframe or delta before it, so nothing after the keyframe is missing
+    cycles = [message["cycle"] for message in messages if message["type"] in ("keyframe", "delta")]
+    assert cycles == list(range(cycles[0], server.rs_manager.cycle + 1))
+    assert list(_replay(messages)) == _final_state()
+
+
+def _serve_in_thread(server, address):
+    # Run server on a background event loop; returns a function stopping it
+    started = threading.Event()
+    loop_and_stop = []
+
+    async def main():
+        await server.start(address)
+        loop_and_stop.append((asyncio.get_running_loop(), asyncio.Event()))
+        started.set()
+        simulation = asyncio.create_task(server.simulate())
+        try:
+            await loop_and_stop[0][1].wait()
+        finally:
+            simulation.cancel()
+            server.server.close()
+
+    thread = threading.Thread(target=asyncio.run, args=(main(),), daemon=True)
+    thread.start()
+    started.wait(5)
+
+    def stop():
+        loop, stopped = loop_and_stop[0]
+        loop.call_soon_threadsafe(stopped.set)
+        thread.join(5)
+
+    return stop
+
+
+def test_server_streams_a_run_to_a_live_viewer(tmp_path):
+    server = SimulationServer(_served_manager())
+    stop = _serve_in_thread(server, str(tmp_path / "server.sock"))
+    log = cyclelog.LiveCycleLog(str(tmp_path / "server.sock"))
+    try:
+        log.send("run")
+        for _ in range(500):
+            if log.status.get("state") == FINISHED:
+                break
+            threading.Event().wait(0.01)
+        assert log.status["state"] == FINISHED and log.error is None
+        assert log.last_cycle == server.rs_manager.cycle
+        assert [log.stations, log.registers] == _final_state()
+    finally:
+        log.close()
+        stop()
+
+
+def test_functional_model_fetches_assembled_programs_lazily(tmp_path):
+    # Longer than FETCH_BLOCKS blocks of FETCH_BLOCK instructions, so the whole program never fits the windows
+    body = [f"DADDI R{i % 30 + 1}, R{i % 30 + 1}, #{i % 7}" for i in range(20000)]
+    path = tmp_path / "long.s"
+    path.write_text("\n".join(["DADDI R31, I0, #1", "loop:"] + body + ["DSUBI R31, R31, #1", "BNEQZ R31, loop",
+                                                                      "STORE M8, R5, X"]))
+    program = open_program(str(path))
+    try:
+        functional = FunctionalSimulator(program)
+        functional.run()
+        expected = FunctionalSimulator(list(program))
+        expected.run()
+        assert functional.register_dict() == expected.register_dict()
+        assert functional.executed == expected.executed
+        assert len(functional.code.blocks) <= functional.code.max_blocks
+        assert len(program.decoded.blocks) <= program.decoded.max_blocks
+
+        estimate = sample(program, interval=5000, window=200, warmup=100)
+        assert estimate.instructions == expected.executed and estimate.registers == expected.register_dict()
+
+        if lanes.numpy is not None:
+            results = lanes.simulate_lanes(program, [[], ["R5 3"]])
+            assert results.errors == [None, None]
+            assert results[0].registers == expected.register_dict()
+            assert results[1].registers["M8"] == results[0].registers["M8"] + 3
+    finally:
+        program.close()
+
+
+def test_trace_records_integers_longer_than_a_short_length(tmp_path):
+    # Squaring 3 nineteen times gives an integer of about 100 KB, longer than a u16 length and than str() accepts
+    program = ["DADDI R10, I0, #19", "MUL R1, R1, R1", "DSUBI R10, R10, #1", "BNEQZ R10, 1"]
+    rs_manager = make_manager(make_config(), ["R1 3"])
+    rs_manager.add_instruction(program)
+    cycles = run_simulation(rs_manager, base_file_name=str(tmp_path / "log"))
+    with TraceReader(str(tmp_path / "log.trc")) as reader:
+        stations, registers = reader.state(cycles)
+        assert registers[reader.register_names.index("R1")] == 3 ** (1 << 19)
+
+
+def _record_demo(path, keyframe_interval, close=True):
+    # Trace the demo program; returns the (cycle, stations, registers) written for every cycle
+    rs_manager = make_manager(make_config(), Tomasulo.initial_values)
+    rs_manager.add_instruction(Tomasulo.instructions)
+    writer = TraceWriter(path, rs_manager, keyframe_interval)
+    expected = []
+    while True:
+        writer.record(rs_manager.cycle)
+        expected.append((rs_manager.cycle, [list(station.trace_fields()) for station in writer.stations],
+                         list(rs_manager.register_values) + [rs_manager.memory.load(address)
+                                                             for address in writer.memory_addresses]))
+        if rs_manager.finished():
+            break
+        rs_manager.execute_cycle()
+    if close:
+        writer.close()
+    else:
+        # As after an aborted run: the records are there but not the keyframe index
+        writer.file.close()
+    return expected
+
+
+@pytest.mark.parametrize("close", [True, False])
+def test_trace_round_trip_and_keyframe_seeking(tmp_path, close):
+    path = str(tmp_path / "log.trc")
+    expected = _record_demo(path, 10, close)
+    with TraceReader(path) as reader:
+        assert [(cycle, [list(fields) for fields in stations], list(registers))
+                for cycle, stations, registers in reader] == expected
+        # A keyframe every 10 records, from the footer or, for a trace that was not closed, from a scan
+        assert reader.keyframe_cycles == [cycle for cycle, _, _ in expected[::10]]
+        assert reader.last_cycle == expected[-1][0]
+        # Any cycle is rebuilt from the keyframe before it, in any order
+        for cycle, stations, registers in reversed(expected):
+            assert reader.state(cycle) == (stations, registers)
+        with pytest.raises(KeyError):
+            reader.state(expected[-1][0] + 1)
+
+
+def test_text_log_cycle_index(tmp_path, monkeypatch):
+    trace_path, text_path = str(tmp_path / "log.trc"), str(tmp_path / "log.txt")
+    expected = _record_demo(trace_path, 10)
+    export_text(trace_path, text_path)
+    last = expected[-1][0]
+
+    trace = cyclelog.TraceCycleLog(trace_path)
+    text = cyclelog.TextCycleLog(text_path)
+    try:
+        assert os.path.exists(text_path + ".idx")
+        assert (text.first_cycle, text.last_cycle, len(text)) == (0, last, last + 1)
+        for cycle in [last, 0, last // 2, 1, last - 1]:
+            assert text[cycle] == trace[cycle]
+        assert last + 1 not in text
+        shown = {cycle: trace[cycle] for cycle in (3, 7)}
+        with pytest.raises(KeyError):
+            text[last + 1]
+    finally:
+        trace.close()
+        text.close()
+
+    # The sidecar index is used as long as it matches the log, and rebuilt once the log changes; cycles missing
+    # from the log are not in it
+    def build_index(log):
+        raise AssertionError("index rebuilt")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(cyclelog.TextCycleLog, "build_index", build_index)
+        text = cyclelog.TextCycleLog(text_path)
+        assert text.last_cycle == last and text[3] == shown[3]
+        text.close()
+    with open(text_path) as file:
+        cycles = file.read().split("\n\n")
+    with open(text_path, "w") as file:
+        file.write("\n\n".join(cycles[:4] + cycles[7:9]) + "\n\n")
+    text = cyclelog.TextCycleLog(text_path)
+    try:
+        assert list(text.cycles) == [0, 1, 2, 3, 7, 8]
+        assert 3 in text and 5 not in text and 8 in text and 9 not in text
+        assert text[7] == shown[7]
+    finally:
+        text.close()
+
+
+def _profile(program, config=None, engine="step"):
+    result = simulate(program, config, ["R2 6", "R3 2"], engine, MAX_CYCLES, profile=True)
+    summary = result.profiler.summary(include_timings=True)
+    assert summary["cycles"] == result.cycles
+    for histogram in summary["occupancy"].values():
+        assert sum(histogram) == result.cycles
+    return result, summary, summary.pop("instructions")
+
+
+def test_profiler_counts_each_stall_cause():
+    # The second DIV waits for the only DIV station
+    _, summary, timings = _profile(["DIV R1, R2, R3", "DIV R4, R2, R3", "ADD R5, R2, R3"])
+    assert summary["issue_slots_lost"]["structural"] == timings[1]["issue"] - timings[0]["issue"] - 1
+    assert summary["structural_stalls_by_op"] == {"DIV": summary["issue_slots_lost"]["structural"]}
+    assert summary["occupancy"]["DIV"] == [timings[0]["issue"], summary["cycles"] - timings[0]["issue"]]
+
+    # The ADD waits for the DIV writing the same register to finish
+    _, summary, timings = _profile(["DIV R1, R2, R3", "ADD R1, R2, R3"])
+    assert summary["issue_slots_lost"] == {"waw": timings[0]["write"] - 2, "structural": 0, "branch": 0,
+                                           "rob_full": 0}
+
+    # The second ADD waits for its operand from the first
+    _, summary, timings = _profile(["ADD R1, R2, R3", "ADD R4, R1, R1"])
+    assert summary["raw_wait_station_cycles"] == timings[1]["execute"] - timings[1]["issue"]
+
+    # The LOAD waits for the older STORE to the same address
+    _, summary, timings = _profile(["STORE M8, R2, X", "LOAD R4, M8, X"])
+    assert summary["memory_order_wait_station_cycles"] == timings[1]["execute"] - timings[1]["issue"]
+
+    # Results finishing together wait for the single common data bus
+    result, summary, timings = _profile(["ADD R1, R2, R3", "ADD R4, R2, R3", "MUL R5, R2, R3", "MUL R6, R2, R3"],
+                                        {"pipeline": {"issue_width": 4}})
+    assert summary["cdb_conflict_station_cycles"] == result.stats["cdb_stall_cycles"] == 2
+    busy = sum(timing["write"] - timing["issue"] for timing in timings)
+    assert sum(summary["station_busy_fraction"].values()) * summary["cycles"] == pytest.approx(busy)
+
+
+@pytest.mark.parametrize("program, initial_values", LOOP_PROGRAMS, ids=range(len(LOOP_PROGRAMS)))
+def test_profiler_sees_skipped_cycles(program, initial_values):
+    # The skip engine reports stretches of identical cycles at once; the profile must not change
+    profiles = [simulate(program, None, initial_values, engine, MAX_CYCLES, profile=True).profiler.summary(True)
+                for engine in ("step", "skip")]
+    assert profiles[0] == profiles[1]
+
+
+def _events(engine, config=None):
+    # Every event of a two-instruction dependency chain, and the number of cycles of the run
+    rs_manager = make_manager(make_config(config), ["R2 6", "R3 2"])
+    rs_manager.add_instruction(["ADD R1, R2, R3", "MUL R4, R1, R3"])
+    events = []
+    rs_manager.subscribe(events.append)
+    return events, run_simulation(rs_manager, engine, trace=False)
+
+
+def test_event_bus_publishes_the_pipeline_of_each_instruction():
+    events, cycles = _events("step")
+    assert [event.as_dict()["event"] for event in events if not isinstance(event, CycleEndEvent)] == [
+        "IssueEvent", "OperandCaptureEvent", "OperandCaptureEvent", "ExecuteStartEvent",
+        "IssueEvent", "OperandCaptureEvent", "CompleteEvent", "WriteBackEvent", "OperandCaptureEvent",
+        "ExecuteStartEvent", "CompleteEvent", "WriteBackEvent"]
+    write_back = next(event for event in events if isinstance(event, WriteBackEvent))
+    forwarded = [event.as_dict() for event in events
+                 if isinstance(event, OperandCaptureEvent) and event.producer is not None]
+    assert forwarded == [{"event": "OperandCaptureEvent", "cycle": write_back.cycle, "station": "MUL_1", "slot": "j",
+                          "value": 8, "producer": "ADD_1"}]
+    assert [event.cycle for event in events if isinstance(event, CycleEndEvent)] == list(range(1, cycles + 1))
+
+    # The skip engine publishes the same events, with one CycleEndEvent per stretch of skipped cycles
+    skipped, skipped_cycles = _events("skip")
+    assert skipped_cycles == cycles
+    assert sum(event.count for event in skipped if isinstance(event, CycleEndEvent)) == cycles
+    assert [event.as_dict() for event in skipped if not isinstance(event, CycleEndEvent)] == [
+        event.as_dict() for event in events if not isinstance(event, CycleEndEvent)]
+
+
+def test_event_bus_delivers_subscribed_types_in_subscription_order():
+    rs_manager = make_manager(make_config(), ["R2 6", "R3 2"])
+    rs_manager.add_instruction(["ADD R1, R2, R3", "MUL R4, R1, R3"])
+    assert rs_manager.hooks is None
+    received = []
+
+    def first(event):
+        received.append(("first", event))
+
+    def second(event):
+        received.append(("second", event))
+
+    rs_manager.subscribe(first, WriteBackEvent, OperandCaptureEvent)
+    rs_manager.subscribe(second, WriteBackEvent)
+    rs_manager.execute_cycle()
+    assert {type(event) for _, event in received} == {OperandCaptureEvent}
+    rs_manager.unsubscribe(first)
+    while not rs_manager.finished():
+        rs_manager.execute_cycle()
+    assert [(name, type(event)) for name, event in received[2:]] == [("second", WriteBackEvent)] * 2
+    # With nothing subscribed the manager goes back to publishing nothing at all
+    rs_manager.unsubscribe(second)
+    assert rs_manager.hooks is None
+
+
+def test_event_bus_reports_squashes_and_commits():
+    # Predicted taken, the branch is not: the instruction fetched at its target is squashed
+    rs_manager = make_manager(make_config({"rob": {"size": 8, "predictor": "taken"}}))
+    rs_manager.add_instruction(["DADDI R10, I0, #0", "BNEQZ R10, 0", "ADD R1, R2, R3"])
+    events = []
+    rs_manager.subscribe(events.append, BranchResolvedEvent, SquashEvent, CommitEvent)
+    run_simulation(rs_manager, trace=False)
+    resolved, squash = events[1], events[2]
+    assert isinstance(resolved, BranchResolvedEvent) and (resolved.taken, resolved.predicted_taken) == (False, True)
+    assert isinstance(squash, SquashEvent) and (squash.sequence, squash.cycle) == (resolved.sequence, resolved.cycle)
+    commits = [event for event in events if isinstance(event, CommitEvent)]
+    assert [(event.sequence, event.pc) for event in commits] == [(0, 0), (1, 1), (3, 2)]
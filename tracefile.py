@@ -0,0 +1,354 @@
+import argparse
+import bisect
+import json
+import math
+import mmap
+import struct
+
+# Binary trace layout
+#   header:  MAGIC, version (u16), length (u32) and JSON with the station and register names and the registers
+#            the program uses (traces written before used_registers stored the whole program instead)
+#   records: kind (u8), cycle (u32), then either a keyframe (every register and station field)
+#            or a delta (only the registers and station fields that changed since the previous cycle)
+#   values:  tag (u8), then an i64, an f64, or a length (u32) followed by UTF-8 text for strings, or by the
+#            little-endian two's complement bytes of larger integers
+#            (version 1 traces stored lengths, and station indices in deltas, as u16, and larger integers as text)
+#   footer:  INDEX_MAGIC, keyframe count (u32), (cycle u32, offset u64) per keyframe,
+#            last cycle (u32), footer offset (u64), END_MAGIC
+MAGIC = b"TOMTRACE"
+INDEX_MAGIC = b"TOMINDEX"
+END_MAGIC = b"TOMTREND"
+VERSION = 2
+
+KEYFRAME = 0
+DELTA = 1
+
+# Value tags
+NONE, INT, FLOAT, STR, BIGINT = range(5)
+
+# Fields recorded for every station (its name is stored once in the header)
+STATION_FIELDS = ("instruction", "stage", "remaining_cycles", "src1", "src2", "dest", "Vj", "Vk", "Qj", "Qk")
+
+_record = struct.Struct("<BI")
+_count = struct.Struct("<I")
+_station_delta = struct.Struct("<IH")
+_index_entry = struct.Struct("<IQ")
+_footer_tail = struct.Struct("<IQ8s")
+_int = struct.Struct("<q")
+_float = struct.Struct("<d")
+_length = struct.Struct("<I")
+# Layouts of version 1 traces, which are still read
+_station_delta_v1 = struct.Struct("<HH")
+_length_v1 = struct.Struct("<H")
+
+
+def format_station(name, fields):
+    # Text form of a station used by the logs and the GUI
+    if fields[0] is None:
+        return f"{name}, Idle, {fields[2]}"
+    instruction, stage, remaining_cycles, src1, src2, dest, vj, vk, qj, qk = fields
+    return f"{instruction}, {name}, {stage}, {remaining_cycles}, {src1}, {src2}, {dest}, {vj}, {vk}, {qj}, {qk}"
+
+
+def encode_value(value, out):
+    if value is None:
+        out.append(NONE)
+    elif value.__class__ is int:
+        if -(1 << 63) <= value < (1 << 63):
+            out.append(INT)
+            out += _int.pack(value)
+        else:
+            data = value.to_bytes(value.bit_length() // 8 + 1, "little", signed=True)
+            out.append(BIGINT)
+            out += _length.pack(len(data)) + data
+    elif value.__class__ is float:
+        out.append(FLOAT)
+        out += _float.pack(value)
+    else:
+        data = str(value).encode()
+        out.append(STR)
+        out += _length.pack(len(data)) + data
+
+
+def decode_value(buffer, offset, version=VERSION):
+    # Return (value, offset just past it)
+    tag = buffer[offset]
+    offset += 1
+    if tag == NONE:
+        return None, offset
+    if tag == INT:
+        return _int.unpack_from(buffer, offset)[0], offset + 8
+    if tag == FLOAT:
+        return _float.unpack_from(buffer, offset)[0], offset + 8
+    length_struct = _length if version == VERSION else _length_v1
+    length = length_struct.unpack_from(buffer, offset)[0]
+    offset += length_struct.size
+    data = bytes(buffer[offset:offset + length])
+    if tag == STR:
+        return data.decode(), offset + length
+    if version == VERSION:
+        return int.from_bytes(data, "little", signed=True), offset + length
+    return int(data), offset + length
+
+
+def _changed(old, new):
+    # 4 and 4.0, or 0.0 and -0.0, compare equal but are logged differently
+    if old.__class__ is not new.__class__:
+        return True
+    if old.__class__ is float and old == new:
+        return math.copysign(1.0, old) != math.copysign(1.0, new)
+    return old != new
+
+
+class TraceWriter:
+    """
+    Streams the state of a ReservationStationManager to a binary trace, one record per cycle.
+
+    Only the registers and station fields that changed since the previous record are written,
+    with a full keyframe every keyframe_interval records so any cycle can be rebuilt quickly.
+    """
+
+    def __init__(self, path, rs_manager, keyframe_interval=1000):
+        self.rs_manager = rs_manager
+        self.keyframe_interval = keyframe_interval
+        self.stations = list(rs_manager.stations.values())
+        self.register_values = rs_manager.register_values
+        # Memory words are logged after the registers, under the names "M<address>"
+        self.memory = rs_manager.memory
+        self.memory_addresses = rs_manager.named_memory_words()
+        self.last_registers = None
+        self.last_stations = None
+        self.records = 0
+        self.last_cycle = None
+        self.index = []
+        header = json.dumps({
+            "stations": [station.name for station in self.stations],
+            "registers": list(rs_manager.registers.keys()) + [f"M{address}" for address in self.memory_addresses],
+            "used_registers": rs_manager.used_register_names(),
+            "keyframe_interval": keyframe_interval,
+        }).encode()
+        self.file = open(path, "wb", buffering=1 << 20)
+        self.file.write(MAGIC + struct.pack("<HI", VERSION, len(header)) + header)
+
+    def record(self, cycle):
+        # Append the state at the end of `cycle`
+        registers = list(self.register_values)
+        registers += [self.memory.load(address) for address in self.memory_addresses]
+        stations = [station.trace_fields() for station in self.stations]
+        out = bytearray()
+        if self.records % self.keyframe_interval == 0:
+            self.index.append((cycle, self.file.tell()))
+            out += _record.pack(KEYFRAME, cycle)
+            for value in registers:
+                encode_value(value, out)
+            for fields in stations:
+                for value in fields:
+                    encode_value(value, out)
+        else:
+            out += _record.pack(DELTA, cycle)
+            last_registers = self.last_registers
+            changed = [i for i, value in enumerate(registers)
+                       if value is not last_registers[i] and _changed(last_registers[i], value)]
+            out += _count.pack(len(changed))
+            for i in changed:
+                out += _count.pack(i)
+                encode_value(registers[i], out)
+
+            last_stations = self.last_stations
+            changed = [i for i, fields in enumerate(stations) if fields != last_stations[i]]
+            out += _count.pack(len(changed))
+            for i in changed:
+                old, new = last_stations[i], stations[i]
+                mask = 0
+                for bit, (a, b) in enumerate(zip(old, new)):
+                    if _changed(a, b):
+                        mask |= 1 << bit
+                out += _station_delta.pack(i, mask)
+                for bit, value in enumerate(new):
+                    if mask & (1 << bit):
+                        encode_value(value, out)
+        self.file.write(out)
+        self.last_registers = registers
+        self.last_stations = stations
+        self.last_cycle = cycle
+        self.records += 1
+
+    def close(self):
+        # Write the keyframe index and close the file
+        if self.file.closed:
+            return
+        footer_offset = self.file.tell()
+        self.file.write(INDEX_MAGIC + _count.pack(len(self.index)))
+        for cycle, offset in self.index:
+            self.file.write(_index_entry.pack(cycle, offset))
+        last_cycle = self.last_cycle if self.last_cycle is not None else 0
+        self.file.write(_footer_tail.pack(last_cycle, footer_offset, END_MAGIC))
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TraceReader:
+    """
+    Random access to a binary trace: state(cycle) decodes the nearest keyframe and the deltas after it.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a Tomasulo trace")
+        version, length = struct.unpack_from("<HI", self.buffer, len(MAGIC))
+        if version not in (1, VERSION):
+            raise ValueError(f"Unsupported trace version {version}")
+        self.version = version
+        self.station_delta = _station_delta if version == VERSION else _station_delta_v1
+        start = len(MAGIC) + 6
+        header = json.loads(self.buffer[start:start + length])
+        self.station_names = header["stations"]
+        self.register_names = header["registers"]
+        self.program = header.get("program", [])
+        self.used_registers = header.get("used_registers")
+        self.keyframe_interval = header["keyframe_interval"]
+        self.data_start = start + length
+        self.load_index()
+
+    def load_index(self):
+        # Read the keyframe index from the footer, or rebuild it if the trace was not closed
+        if len(self.buffer) >= self.data_start + _footer_tail.size and self.buffer[-8:] == END_MAGIC:
+            self.last_cycle, footer_offset, _ = _footer_tail.unpack_from(self.buffer, len(self.buffer) - _footer_tail.size)
+            count = _count.unpack_from(self.buffer, footer_offset + len(INDEX_MAGIC))[0]
+            offset = footer_offset + len(INDEX_MAGIC) + _count.size
+            self.index = [_index_entry.unpack_from(self.buffer, offset + i * _index_entry.size) for i in range(count)]
+            self.data_end = footer_offset
+        else:
+            self.data_end = len(self.buffer)
+            self.index = []
+            self.last_cycle = None
+            for kind, cycle, offset, end in self.scan(self.data_start):
+                if kind == KEYFRAME:
+                    self.index.append((cycle, offset))
+                self.last_cycle = cycle
+        self.keyframe_cycles = [cycle for cycle, offset in self.index]
+        self.first_cycle = self.keyframe_cycles[0] if self.index else None
+
+    def scan(self, offset, registers=None, stations=None):
+        # Walk the records from offset, yielding (kind, cycle, offset, next offset);
+        # when state lists are given they are updated in place with each record
+        version = self.version
+        while offset < self.data_end:
+            start = offset
+            kind, cycle = _record.unpack_from(self.buffer, offset)
+            offset += _record.size
+            if kind == KEYFRAME:
+                for i in range(len(self.register_names)):
+                    value, offset = decode_value(self.buffer, offset, version)
+                    if registers is not None:
+                        registers[i] = value
+                for i in range(len(self.station_names)):
+                    fields = []
+                    for _ in STATION_FIELDS:
+                        value, offset = decode_value(self.buffer, offset, version)
+                        fields.append(value)
+                    if stations is not None:
+                        stations[i] = fields
+            else:
+                count = _count.unpack_from(self.buffer, offset)[0]
+                offset += _count.size
+                for _ in range(count):
+                    i = _count.unpack_from(self.buffer, offset)[0]
+                    value, offset = decode_value(self.buffer, offset + _count.size, version)
+                    if registers is not None:
+                        registers[i] = value
+                count = _count.unpack_from(self.buffer, offset)[0]
+                offset += _count.size
+                for _ in range(count):
+                    i, mask = self.station_delta.unpack_from(self.buffer, offset)
+                    offset += self.station_delta.size
+                    fields = list(stations[i]) if stations is not None else None
+                    for bit in range(len(STATION_FIELDS)):
+                        if mask & (1 << bit):
+                            value, offset = decode_value(self.buffer, offset, version)
+                            if fields is not None:
+                                fields[bit] = value
+                    if stations is not None:
+                        stations[i] = fields
+            yield kind, cycle, start, offset
+
+    def state(self, cycle):
+        # Return (stations, registers) at the end of `cycle`: lists of field lists and of values
+        position = bisect.bisect_right(self.keyframe_cycles, cycle) - 1
+        if position < 0 or cycle > self.last_cycle:
+            raise KeyError(cycle)
+        registers = [None] * len(self.register_names)
+        stations = [None] * len(self.station_names)
+        for kind, record_cycle, start, end in self.scan(self.index[position][1], registers, stations):
+            if record_cycle == cycle:
+                return stations, registers
+            if record_cycle > cycle:
+                break
+        raise KeyError(cycle)
+
+    def __iter__(self):
+        # Yield (cycle, stations, registers) for every record in order; the lists are reused between records
+        registers = [None] * len(self.register_names)
+        stations = [None] * len(self.station_names)
+        for kind, cycle, start, end in self.scan(self.data_start, registers, stations):
+            yield cycle, stations, registers
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def cycle_log_data(reader, stations, registers):
+    # The per-cycle dictionary of the legacy log.txt / log.json files
+    return {
+        "reservation_stations": [format_station(name, fields) for name, fields in zip(reader.station_names, stations)],
+        "register_values": [f"{name}, {value}" for name, value in zip(reader.register_names, registers)],
+    }
+
+
+def export_text(trace_path, text_path):
+    # Write a trace in the log.txt format read by the GUI
+    with TraceReader(trace_path) as reader, open(text_path, "w", buffering=1 << 20) as file:
+        for cycle, stations, registers in reader:
+            file.write(f"Cycle {cycle}:\n")
+            for key, value in cycle_log_data(reader, stations, registers).items():
+                file.write(f"{key}: {value}\n")
+            file.write("\n")  # Adding a newline for separation between cycles
+
+
+def export_json(trace_path, json_path, indent=None):
+    # Write a trace as a JSON array with one {cycle, reservation_stations, register_values} object per cycle
+    with TraceReader(trace_path) as reader, open(json_path, "w", buffering=1 << 20) as file:
+        file.write("[")
+        for i, (cycle, stations, registers) in enumerate(reader):
+            if i:
+                file.write(",\n")
+            log_data = {"cycle": cycle}
+            log_data.update(cycle_log_data(reader, stations, registers))
+            json.dump(log_data, file, indent=indent)
+        file.write("]\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a binary Tomasulo trace")
+    parser.add_argument("trace")
+    parser.add_argument("--text", help="Write the log.txt format to this file")
+    parser.add_argument("--json", help="Write a JSON array to this file")
+    args = parser.parse_args()
+    if args.text:
+        export_text(args.trace, args.text)
+    if args.json:
+        export_json(args.trace, args.json)